@@ -0,0 +1,207 @@
+"""
+Checks that the optimized code paths give the same results as the reference
+ones, on a synthetic corpus (see redditnetwork.synthetic):
+
+    embedding   SIFEmbedder.embed_block against _get_embedding, doc by doc
+    parallel    extract_month_network_multisubreddits with processes=2 against processes=None
+    sliding     SlidingWeekExtractor(window=1) against extract_week_network, week by week
+    index       week records read through the record indexes against use_index=False
+    freqs       extract_month_network with precomputed_freqs against counting the words
+    compressed  records and networks from a .gzb copy of the corpus against the original
+    compiled    records and networks from a compiled copy of the corpus against the original
+
+    python benchmarks/check_equivalence.py --data /tmp/reddit_synth
+
+The corpus is generated under --data unless it already exists there (the same
+corpus run_benchmarks.py uses); the compressed and compiled checks work on
+temporary copies of it. Exits with status 1 if any check fails.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import traceback
+import numpy as np
+
+from collections import Counter
+
+YEAR = 2014
+MONTH = 3
+WEEK = 10
+SUBREDDITS = ["sub_a", "sub_b"]
+# docs embedded by the embedding check
+NUM_DOCS = 2000
+
+def _same_value(a, b):
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return np.shape(a) == np.shape(b) and np.allclose(a, b, rtol=1e-5, atol=1e-6)
+    return a == b
+
+def compare_graphs(graph, expected):
+    """
+    Asserts that two networkx graphs have the same nodes, node attributes and edges.
+    """
+    assert set(graph.nodes()) == set(expected.nodes()), "different nodes: {:d} vs {:d}".format(
+            graph.number_of_nodes(), expected.number_of_nodes())
+    for node, attrs in expected.nodes(data=True):
+        other = graph.node[node]
+        assert set(other) == set(attrs), "different attributes for {}".format(node)
+        for key, value in attrs.iteritems():
+            assert _same_value(other[key], value), "different {} for {}".format(key, node)
+    edges = set((source, target, attrs["type"]) for source, target, attrs in graph.edges(data=True))
+    expected_edges = set((source, target, attrs["type"])
+            for source, target, attrs in expected.edges(data=True))
+    assert edges == expected_edges, "different edges: {:d} vs {:d}".format(
+            len(edges), len(expected_edges))
+
+def _records(iterator):
+    """
+    The metadata and raw doc bytes of every record, in order.
+    """
+    return [(sorted((key, value) for key, value in dict.items(record)
+        if not key in ("doc", "text")), record.byte_string) for record in iterator]
+
+def _week_records(week, **kw_args):
+    from redditnetwork.corpus_reader import WeekIterWrapper, SpacyComments, PostIterator
+    return [_records(WeekIterWrapper(cls, week, subreddit, YEAR, **kw_args))
+            for cls in [SpacyComments, PostIterator] for subreddit in SUBREDDITS]
+
+def _corpus_copy():
+    from redditnetwork import constants
+    copy = os.path.join(tempfile.mkdtemp(), "corpus/")
+    shutil.copytree(constants.DATA_HOME, copy)
+    return copy
+
+def _with_data_home(data_home, func, *args):
+    from redditnetwork import constants
+    original = constants.DATA_HOME
+    constants.DATA_HOME = data_home
+    try:
+        return func(*args)
+    finally:
+        constants.DATA_HOME = original
+
+def check_embedding():
+    from redditnetwork.corpus_reader import SpacyComments
+    from redditnetwork.embedding import SIFEmbedder, digest_doc
+    from redditnetwork.network_extractor import _get_embedding
+    docs = []
+    for comment in SpacyComments(SUBREDDITS[0], YEAR, MONTH):
+        docs.append(comment["doc"])
+        if len(docs) == NUM_DOCS:
+            break
+    counter = Counter(word.lower_ for doc in docs for word in doc)
+    total_count = float(sum(counter.values()))
+    embeddings = SIFEmbedder(counter, total_count).embed_block([digest_doc(doc) for doc in docs])
+    for i, doc in enumerate(docs):
+        assert _same_value(embeddings[i], _get_embedding(doc, counter, total_count)), \
+                "different embedding for doc {:d}".format(i)
+
+def check_parallel():
+    from redditnetwork.network_extractor import extract_month_network_multisubreddits
+    compare_graphs(extract_month_network_multisubreddits(SUBREDDITS, YEAR, MONTH, processes=2),
+            extract_month_network_multisubreddits(SUBREDDITS, YEAR, MONTH, processes=None))
+
+def check_sliding():
+    from redditnetwork.network_extractor import SlidingWeekExtractor, extract_week_network
+    extractor = SlidingWeekExtractor(SUBREDDITS[0], YEAR, window=1)
+    # consecutive weeks, so weeks get evicted from the window as well
+    for week in range(WEEK, WEEK + 3):
+        compare_graphs(extractor.advance_to(week), extract_week_network(SUBREDDITS[0], YEAR, week))
+
+def check_index():
+    for week in range(WEEK, WEEK + 2):
+        assert _week_records(week) == _week_records(week, use_index=False), \
+                "different records for week {:d}".format(week)
+
+def check_freqs():
+    from redditnetwork.network_extractor import (extract_month_network,
+            extract_month_network_multisubreddits)
+    compare_graphs(extract_month_network(SUBREDDITS[0], YEAR, MONTH, precomputed_freqs=True),
+            extract_month_network(SUBREDDITS[0], YEAR, MONTH))
+    compare_graphs(extract_month_network_multisubreddits(SUBREDDITS, YEAR, MONTH,
+        precomputed_freqs=True), extract_month_network_multisubreddits(SUBREDDITS, YEAR, MONTH))
+
+def _week_results():
+    from redditnetwork.network_extractor import extract_week_network
+    return _week_records(WEEK), extract_week_network(SUBREDDITS[0], YEAR, WEEK)
+
+def check_compressed():
+    from redditnetwork.block_compression import compress_corpus
+    copy = _corpus_copy()
+    try:
+        # without the plain files, so every read (and index seek) goes through the .gzb files
+        compress_corpus(copy, remove=True)
+        records, graph = _with_data_home(copy, _week_results)
+        expected_records, expected_graph = _week_results()
+        assert records == expected_records, "different records"
+        compare_graphs(graph, expected_graph)
+    finally:
+        shutil.rmtree(os.path.dirname(copy.rstrip("/")))
+
+def _compiled_results():
+    from redditnetwork.corpus_reader import SpacyComments, text_from_doc
+    from redditnetwork.compiled_corpus import compile_corpus, CompiledComments
+    from redditnetwork.network_extractor import (extract_compiled_network,
+            extract_month_network_multisubreddits)
+    compile_corpus(SUBREDDITS, YEAR, [MONTH])
+    for subreddit in SUBREDDITS:
+        texts = [comment["text"] for comment in CompiledComments(subreddit, YEAR, MONTH)]
+        expected = [text_from_doc(comment["doc"])
+                for comment in SpacyComments(subreddit, YEAR, MONTH)]
+        assert texts == expected, "different texts for " + subreddit
+    return (extract_compiled_network(SUBREDDITS, YEAR, [MONTH]),
+            extract_month_network_multisubreddits(SUBREDDITS, YEAR, MONTH))
+
+def check_compiled():
+    copy = _corpus_copy()
+    try:
+        compare_graphs(*_with_data_home(copy, _compiled_results))
+    finally:
+        shutil.rmtree(os.path.dirname(copy.rstrip("/")))
+
+CHECKS = [("embedding", check_embedding),
+        ("parallel", check_parallel),
+        ("sliding", check_sliding),
+        ("index", check_index),
+        ("freqs", check_freqs),
+        ("compressed", check_compressed),
+        ("compiled", check_compiled)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="/tmp/redditnetwork_synthetic/",
+            help="synthetic corpus directory (generated if missing)")
+    parser.add_argument("--scale", type=int, default=2000,
+            help="comments per subreddit-month when generating")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in CHECKS],
+            help="checks to run (default: all)")
+    args = parser.parse_args()
+    data = args.data if args.data.endswith("/") else args.data + "/"
+
+    from redditnetwork import constants
+    constants.DATA_HOME = data
+    if not os.path.exists(data + "filtered_users.txt"):
+        from redditnetwork.synthetic import write_corpus
+        print "Generating synthetic corpus in", data
+        print write_corpus(data, subreddits=SUBREDDITS, year=YEAR,
+                comments_per_month=args.scale, posts_per_month=max(1, args.scale/10))
+
+    failed = []
+    for name, func in CHECKS:
+        if args.only and not name in args.only:
+            continue
+        try:
+            func()
+            print "{:<12} ok".format(name)
+        except AssertionError:
+            traceback.print_exc()
+            print "{:<12} FAILED".format(name)
+            failed.append(name)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
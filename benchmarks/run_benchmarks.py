@@ -0,0 +1,184 @@
+"""
+Throughput (records/sec) and peak memory benchmarks for the corpus readers and
+network extractors, run on a synthetic corpus (see redditnetwork.synthetic).
+
+    python benchmarks/run_benchmarks.py --data /tmp/reddit_synth --output baseline.json
+    python benchmarks/run_benchmarks.py --data /tmp/reddit_synth --compare baseline.json
+
+The corpus is generated under --data unless it already exists there; the sidecar
+record indexes are written next to it by the first run that needs them.
+Every benchmark runs in a fresh interpreter, so peak memory is not shared between
+them. base_mb is the peak resident size once the spacy vocab is loaded, peak_mb
+the peak after the benchmark. For the extractors, records are the post and comment
+nodes of the extracted network.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+YEAR = 2014
+MONTH = 3
+WEEK = 10
+SUBREDDITS = ["sub_a", "sub_b"]
+
+def _count(iterator, decode=False):
+    count = 0
+    for record in iterator:
+        if decode:
+            record["doc"]
+        count += 1
+    return count
+
+def _graph_records(graph):
+    if hasattr(graph, "nodes_of_type"):
+        return len(graph.nodes_of_type("post")) + len(graph.nodes_of_type("comment"))
+    return sum(1 for _, attrs in graph.nodes(data=True) if attrs["type"] != "user")
+
+def bench_info_iterator():
+    from redditnetwork.corpus_reader import InfoIterator
+    return _count(InfoIterator(SUBREDDITS[0], YEAR))
+
+def bench_spacy_comments():
+    from redditnetwork.corpus_reader import SpacyComments
+    return _count(SpacyComments(SUBREDDITS[0], YEAR, MONTH), decode=True)
+
+def bench_post_map():
+    from redditnetwork.corpus_reader import PostMap
+    return sum(len(PostMap(SUBREDDITS[0], YEAR, month).post_map) for month in range(1,13))
+
+def bench_week_iter():
+    from redditnetwork.corpus_reader import WeekIterWrapper, SpacyComments
+    return _count(WeekIterWrapper(SpacyComments, WEEK, SUBREDDITS[0], YEAR), decode=True)
+
+def bench_year_prefetch():
+    from redditnetwork.corpus_reader import MultiIterWrapper, SpacyComments
+    return _count(MultiIterWrapper([SpacyComments(SUBREDDITS[0], YEAR, month)
+        for month in range(1,13)], prefetch=10000), decode=True)
+
+def bench_month_network():
+    from redditnetwork.network_extractor import extract_month_network
+    return _graph_records(extract_month_network(SUBREDDITS[0], YEAR, MONTH))
+
+def bench_week_network():
+    from redditnetwork.network_extractor import extract_week_network
+    return _graph_records(extract_week_network(SUBREDDITS[0], YEAR, WEEK))
+
+def bench_year_network():
+    from redditnetwork.network_extractor import extract_year_network
+    return _graph_records(extract_year_network(SUBREDDITS[0], YEAR))
+
+def bench_month_network_multisubreddits():
+    from redditnetwork.network_extractor import extract_month_network_multisubreddits
+    return _graph_records(extract_month_network_multisubreddits(SUBREDDITS, YEAR, MONTH))
+
+def bench_week_network_multisubreddits():
+    from redditnetwork.network_extractor import extract_week_network_multisubreddits
+    return _graph_records(extract_week_network_multisubreddits(SUBREDDITS, YEAR, WEEK))
+
+BENCHMARKS = [("info_iterator", bench_info_iterator),
+        ("spacy_comments", bench_spacy_comments),
+        ("post_map", bench_post_map),
+        ("week_iter", bench_week_iter),
+        ("year_prefetch", bench_year_prefetch),
+        ("month_network", bench_month_network),
+        ("week_network", bench_week_network),
+        ("year_network", bench_year_network),
+        ("month_network_multisubreddits", bench_month_network_multisubreddits),
+        ("week_network_multisubreddits", bench_week_network_multisubreddits)]
+
+def _peak_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def run_one(name, data):
+    """
+    Runs one benchmark in this process and returns its measurements.
+    """
+    from redditnetwork import constants, corpus_reader
+    constants.DATA_HOME = data
+    corpus_reader.get_vocab()
+    base_mb = _peak_mb()
+    func = dict(BENCHMARKS)[name]
+    start = time.time()
+    records = func()
+    seconds = time.time() - start
+    return {"records" : records, "seconds" : seconds,
+            "records_per_sec" : records / seconds if seconds > 0 else float("inf"),
+            "base_mb" : base_mb, "peak_mb" : _peak_mb()}
+
+def run_all(data, names, repeat=1):
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                "--data", data, "--run", name])
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        # best throughput of the repeats, highest peak
+        best = max(runs, key=lambda run : run["records_per_sec"])
+        best["peak_mb"] = max(run["peak_mb"] for run in runs)
+        results[name] = best
+    return results
+
+def print_results(results, baseline=None):
+    header = "{:<32} {:>9} {:>9} {:>12} {:>9} {:>9}".format(
+            "benchmark", "records", "seconds", "records/sec", "base_mb", "peak_mb")
+    if baseline:
+        header += " {:>9} {:>9}".format("speedup", "mem")
+    print header
+    for name, _ in BENCHMARKS:
+        if not name in results:
+            continue
+        result = results[name]
+        line = "{:<32} {:>9d} {:>9.2f} {:>12.1f} {:>9.1f} {:>9.1f}".format(name,
+                result["records"], result["seconds"], result["records_per_sec"],
+                result["base_mb"], result["peak_mb"])
+        if baseline and name in baseline:
+            line += " {:>8.2f}x {:>8.2f}x".format(
+                    result["records_per_sec"] / baseline[name]["records_per_sec"],
+                    result["peak_mb"] / baseline[name]["peak_mb"])
+        print line
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="/tmp/redditnetwork_synthetic/",
+            help="synthetic corpus directory (generated if missing)")
+    parser.add_argument("--scale", type=int, default=2000,
+            help="comments per subreddit-month when generating")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _ in BENCHMARKS],
+            help="benchmarks to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--output", help="write the results as json")
+    parser.add_argument("--compare", help="json results to compare against")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    data = args.data if args.data.endswith("/") else args.data + "/"
+
+    if args.run:
+        print json.dumps(run_one(args.run, data))
+        return
+
+    if not os.path.exists(data + "filtered_users.txt"):
+        from redditnetwork.synthetic import write_corpus
+        print "Generating synthetic corpus in", data
+        print write_corpus(data, subreddits=SUBREDDITS, year=YEAR,
+                comments_per_month=args.scale, posts_per_month=max(1, args.scale/10))
+    names = args.only if args.only else [name for name, _ in BENCHMARKS]
+    results = run_all(data, names, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Block-compressed variants of the corpus files.
+
+compress_file turns e.g. AskReddit.bin into AskReddit.bin.gzb: a series of
+independent gzip members of BLOCK_SIZE uncompressed bytes each (so the file is
+still a valid gzip file for zcat), plus a small AskReddit.bin.gzb.blocks sidecar
+with the compressed and uncompressed start offset of every block. A
+BlockCompressedFile reads it back as the original file, with seek support: a
+seek only decompresses the one block it lands in, so the record indexes
+(which store uncompressed offsets) work unchanged.
+
+The readers open every .bin/.info file through open_corpus_file, which falls
+back to the compressed variant when the plain file does not exist.
+"""
+
+import os
+import zlib
+import struct
+import bisect
+
+from redditnetwork import constants
+
+COMPRESSED_SUFFIX = ".gzb"
+BLOCKS_SUFFIX = ".blocks"
+BLOCK_SIZE = 1024*1024
+# zlib wbits for a gzip wrapper around each block
+_GZIP_WBITS = 31
+_OFFSETS = struct.Struct("<qq")
+
+def corpus_filename(filename):
+    """
+    The name on disk of a corpus file: filename itself, its compressed variant,
+    or None if neither exists.
+    """
+    if os.path.exists(filename):
+        return filename
+    if os.path.exists(filename + COMPRESSED_SUFFIX):
+        return filename + COMPRESSED_SUFFIX
+    return None
+
+def corpus_file_size(filename):
+    """
+    Size in bytes of the (uncompressed) contents of a corpus file, -1 if it does not exist.
+    """
+    if os.path.exists(filename):
+        return os.path.getsize(filename)
+    blocks = filename + COMPRESSED_SUFFIX + BLOCKS_SUFFIX
+    if not os.path.exists(blocks):
+        return -1
+    with open(blocks, "rb") as fp:
+        fp.seek(-_OFFSETS.size, 2)
+        return _OFFSETS.unpack(fp.read(_OFFSETS.size))[1]
+
+def open_corpus_file(filename):
+    """
+    Opens a corpus file for (binary) reading, or its compressed variant if only that exists.
+    """
+    if os.path.exists(filename) or not os.path.exists(filename + COMPRESSED_SUFFIX):
+        return open(filename, "rb")
+    return BlockCompressedFile(filename)
+
+def compress_file(filename, block_size=BLOCK_SIZE, level=6, remove=False):
+    """
+    Writes filename + COMPRESSED_SUFFIX and its block offsets;
+    with remove, the original file is deleted afterwards.
+    """
+    compressed = filename + COMPRESSED_SUFFIX
+    offsets = [(0, 0)]
+    with open(filename, "rb") as src:
+        with open(compressed + ".tmp", "wb") as dst:
+            while True:
+                data = src.read(block_size)
+                if len(data) == 0:
+                    break
+                compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+                block = compressor.compress(data) + compressor.flush()
+                dst.write(block)
+                offsets.append((offsets[-1][0] + len(block), offsets[-1][1] + len(data)))
+    with open(compressed + BLOCKS_SUFFIX, "wb") as fp:
+        for offset_pair in offsets:
+            fp.write(_OFFSETS.pack(*offset_pair))
+    # the blocks sidecar is in place before the data file appears
+    os.rename(compressed + ".tmp", compressed)
+    if remove:
+        os.remove(filename)
+    return compressed
+
+def compress_corpus(data_home=None, block_size=BLOCK_SIZE, level=6, remove=False):
+    """
+    Compresses every .bin/.info file under spacy_comments/ and spacy_posts/
+    that does not have a compressed variant yet.
+    """
+    data_home = constants.DATA_HOME if data_home is None else data_home
+    compressed = []
+    for directory in ["spacy_comments", "spacy_posts"]:
+        for root, _, names in os.walk(os.path.join(data_home, directory)):
+            for name in sorted(names):
+                if not (name.endswith(".bin") or name.endswith(".info")):
+                    continue
+                filename = os.path.join(root, name)
+                if os.path.exists(filename + COMPRESSED_SUFFIX):
+                    continue
+                compressed.append(compress_file(filename, block_size, level, remove))
+    return compressed
+
+
+class BlockCompressedFile():
+    """
+    Read only file object over a compressed variant, giving the bytes of the
+    original file. Supports read, readline, line iteration, seek and tell;
+    the last decompressed block is kept.
+    """
+    def __init__(self, filename):
+        self.name = filename
+        compressed = filename + COMPRESSED_SUFFIX
+        with open(compressed + BLOCKS_SUFFIX, "rb") as fp:
+            data = fp.read()
+        offsets = [_OFFSETS.unpack_from(data, start)
+                for start in xrange(0, len(data), _OFFSETS.size)]
+        self._compressed = [offset for offset, _ in offsets]
+        self._uncompressed = [offset for _, offset in offsets]
+        self.size = self._uncompressed[-1]
+        self._fp = open(compressed, "rb")
+        self._pos = 0
+        self._block = None
+        self._data = ""
+
+    def _load(self):
+        """
+        Decompresses the block holding the current position; returns the
+        position within it.
+        """
+        block = bisect.bisect_right(self._uncompressed, self._pos) - 1
+        if block != self._block:
+            self._fp.seek(self._compressed[block])
+            raw = self._fp.read(self._compressed[block+1] - self._compressed[block])
+            self._data = zlib.decompress(raw, _GZIP_WBITS)
+            self._block = block
+        return self._pos - self._uncompressed[block]
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self._pos + size, self.size)
+        chunks = []
+        while self._pos < end:
+            start = self._load()
+            chunk = self._data[start:start + end - self._pos]
+            chunks.append(chunk)
+            self._pos += len(chunk)
+        return "".join(chunks)
+
+    def readline(self):
+        chunks = []
+        while self._pos < self.size:
+            start = self._load()
+            newline = self._data.find("\n", start)
+            stop = len(self._data) if newline < 0 else newline + 1
+            chunks.append(self._data[start:stop])
+            self._pos += stop - start
+            if newline >= 0:
+                break
+        return "".join(chunks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if len(line) == 0:
+            raise StopIteration
+        return line
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Negative seek position {:d}".format(offset))
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,417 @@
+"""
+Compiled token-id corpus: the spacy .bin files turned into flat arrays once, so
+that word counting, word_vecs and text cleaning run on memory-mapped arrays
+instead of deserializing Doc objects.
+
+For every compiled .bin (or .title.bin) file, next to it:
+    <path>[.title].tokens.npy    uint32 lexeme table row of every token
+    <path>[.title].offsets.npy   int64 start of every doc in tokens (plus the end)
+    <path>[.title].tags.npy      uint16 code of the tag of every token
+and one LexemeTable shared by the whole corpus (DATA_HOME/compiled_lexemes/)
+with, per distinct token string, its lowercase form (a row) and has_vector/like_url/
+like_num/is_punct flags. Orth ids depend on the vocab of the process (see
+embedding.VectorTable), so they are looked up from the strings when needed.
+Rows are only ever appended, so compiling more files never invalidates older ones;
+compile files one at a time (the table is not locked).
+The .info files are read as they are.
+"""
+
+import os
+import json
+import numpy as np
+
+from spacy.attrs import ORTH, TAG
+from spacy.tokens.doc import Doc
+
+from redditnetwork import constants
+from redditnetwork.corpus_reader import (SpacyComments, PostIterator, get_vocab,
+        decode_doc)
+from redditnetwork.word_freqs import WordFreqs
+from redditnetwork.embedding import default_vectors
+from redditnetwork.block_compression import open_corpus_file
+from redditnetwork.utils.ioutils import mkdir
+
+LEXEME_DIR = "compiled_lexemes/"
+HAS_VECTOR = 1
+LIKE_URL = 2
+LIKE_NUM = 4
+IS_PUNCT = 8
+# tokens copied per chunk when a raw array file is turned into .npy
+COPY_CHUNK = 10000000
+
+def _prefix(path, bin_suffix):
+    # ".bin" -> path, ".title.bin" -> path.title
+    return path + bin_suffix[:-len(".bin")]
+
+def is_compiled(path, bin_suffix=".bin"):
+    return os.path.exists(_prefix(path, bin_suffix) + ".offsets.npy")
+
+
+class LexemeTable():
+    """
+    Attributes of every distinct token string of the compiled corpus, by row.
+    The arrays are memory-mapped; strings and tags are only read when needed.
+    """
+    ARRAYS = ["lower_rows", "flags"]
+
+    def __init__(self, directory, lower_rows, flags):
+        self.directory = directory
+        self.lower_rows = lower_rows
+        self.flags = flags
+        self._strings = None
+        self._tags = None
+        self._orth_ids = None
+
+    @classmethod
+    def load(cls, directory=None):
+        """
+        Loads the table in directory (default: DATA_HOME/compiled_lexemes/);
+        empty if nothing was compiled yet.
+        """
+        directory = constants.DATA_HOME + LEXEME_DIR if directory is None else directory
+        if not os.path.exists(os.path.join(directory, "flags.npy")):
+            return cls(directory, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8))
+        return cls(directory, *[np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+            for name in cls.ARRAYS])
+
+    def __len__(self):
+        return len(self.flags)
+
+    @property
+    def strings(self):
+        if self._strings is None:
+            self._strings = _read_lines(os.path.join(self.directory, "strings.txt"))
+        return self._strings
+
+    @property
+    def orth_ids(self):
+        """
+        Orth id of every row in the vocab of this process.
+        """
+        if self._orth_ids is None:
+            strings = get_vocab().strings
+            self._orth_ids = np.array([strings[string] for string in self.strings],
+                    dtype=np.int64)
+        return self._orth_ids
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = _read_lines(os.path.join(self.directory, "tags.txt"))
+        return self._tags
+
+    def vector_ids(self, rows):
+        """
+        Orth ids of the tokens (table rows) that have a vector, as digest_doc returns them.
+        """
+        flags = self.flags[rows]
+        return self.orth_ids[rows][(flags & HAS_VECTOR) > 0].astype(np.int64)
+
+    def text(self, rows, tags, include_punct=True):
+        """
+        Same as corpus_reader.text_from_doc, from table rows and tag codes.
+        """
+        words = []
+        for row, tag in zip(rows, tags):
+            flags = self.flags[row]
+            if flags & LIKE_URL:
+                words.append("<URL>")
+            elif flags & LIKE_NUM:
+                words.append("<NUM>")
+            elif (not include_punct) and flags & IS_PUNCT and self.tags[tag] != ".":
+                words.append("")
+            else:
+                words.append(self.strings[self.lower_rows[row]])
+        return " ".join(words)
+
+def _read_lines(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as fp:
+        return [json.loads(line) for line in fp]
+
+_LEXEME_TABLE = None
+
+def get_lexeme_table():
+    """
+    The LexemeTable of constants.DATA_HOME, loaded on first use.
+    """
+    global _LEXEME_TABLE
+    if _LEXEME_TABLE is None or _LEXEME_TABLE.directory != constants.DATA_HOME + LEXEME_DIR:
+        _LEXEME_TABLE = LexemeTable.load()
+    return _LEXEME_TABLE
+
+
+class LexemeTableWriter():
+    """
+    Extends a LexemeTable while files are compiled. Lexemes are resolved once per
+    distinct spacy orth id in this process. The has_vector flags come from vectors
+    (default: embedding.default_vectors()), which also works when the vocab was
+    loaded without vectors.
+    """
+    def __init__(self, directory=None, vocab=None, vectors=None):
+        table = LexemeTable.load(directory)
+        self.directory = table.directory
+        self.vocab = get_vocab() if vocab is None else vocab
+        self.vectors = default_vectors() if vectors is None else vectors
+        self.strings = list(table.strings)
+        self.lower_rows = table.lower_rows.tolist()
+        self.flags = table.flags.tolist()
+        self.tags = list(table.tags)
+        self._string_rows = {string : row for row, string in enumerate(self.strings)}
+        self._tag_codes = {tag : code for code, tag in enumerate(self.tags)}
+        self._orth_rows = {}
+        self._tag_ids = {}
+
+    def _row(self, orth):
+        if orth in self._orth_rows:
+            return self._orth_rows[orth]
+        lexeme = self.vocab[orth]
+        string = lexeme.orth_
+        if not string in self._string_rows:
+            row = len(self.strings)
+            self._string_rows[string] = row
+            self.strings.append(string)
+            has_vector = bool(self.vectors.has_vector([lexeme.orth])[0])
+            self.flags.append(HAS_VECTOR * has_vector | LIKE_URL * lexeme.like_url |
+                    LIKE_NUM * lexeme.like_num | IS_PUNCT * lexeme.is_punct)
+            self.lower_rows.append(row)
+            if lexeme.lower != lexeme.orth:
+                self.lower_rows[row] = self._row(lexeme.lower)
+        self._orth_rows[orth] = self._string_rows[string]
+        return self._orth_rows[orth]
+
+    def rows(self, orth_ids):
+        return np.array([self._row(int(orth)) for orth in orth_ids], dtype=np.uint32)
+
+    def tag_codes(self, tag_ids):
+        codes = np.zeros(len(tag_ids), dtype=np.uint16)
+        for i, tag_id in enumerate(tag_ids):
+            tag_id = int(tag_id)
+            if not tag_id in self._tag_ids:
+                tag = self.vocab.strings[tag_id]
+                if not tag in self._tag_codes:
+                    self._tag_codes[tag] = len(self.tags)
+                    self.tags.append(tag)
+                self._tag_ids[tag_id] = self._tag_codes[tag]
+            codes[i] = self._tag_ids[tag_id]
+        return codes
+
+    def save(self):
+        mkdir(self.directory)
+        for name, values, dtype in [("lower_rows", self.lower_rows, np.int64),
+                ("flags", self.flags, np.uint8)]:
+            np.save(os.path.join(self.directory, name + ".npy"), np.array(values, dtype=dtype))
+        for name, values in [("strings", self.strings), ("tags", self.tags)]:
+            with open(os.path.join(self.directory, name + ".txt"), "w") as fp:
+                for value in values:
+                    fp.write(json.dumps(value) + "\n")
+
+
+class _ArrayWriter():
+    """
+    Appends to a raw file and converts it to .npy at the end, so a file's tokens
+    never have to be in memory at once.
+    """
+    def __init__(self, filename, dtype):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._fp = open(filename + ".tmp", "wb")
+
+    def write(self, values):
+        self._fp.write(np.asarray(values, dtype=self.dtype).tobytes())
+        self.length += len(values)
+
+    def finish(self):
+        self._fp.close()
+        array = np.lib.format.open_memmap(self.filename, mode="w+", dtype=self.dtype,
+                shape=(self.length,))
+        if self.length > 0:
+            raw = np.memmap(self.filename + ".tmp", dtype=self.dtype, mode="r", shape=(self.length,))
+            for start in xrange(0, self.length, COPY_CHUNK):
+                array[start:start+COPY_CHUNK] = raw[start:start+COPY_CHUNK]
+            del raw
+        array.flush()
+        del array
+        os.remove(self.filename + ".tmp")
+
+def compile_file(path, bin_suffix=".bin", writer=None):
+    """
+    Compiles the docs of path + bin_suffix. Saves the lexeme table unless a
+    writer is given (then the caller saves it). Returns the number of docs.
+    """
+    global _LEXEME_TABLE
+    save = writer is None
+    writer = LexemeTableWriter() if writer is None else writer
+    prefix = _prefix(path, bin_suffix)
+    tokens = _ArrayWriter(prefix + ".tokens.npy", np.uint32)
+    tags = _ArrayWriter(prefix + ".tags.npy", np.uint16)
+    offsets = [0]
+    with open_corpus_file(path + bin_suffix) as bin:
+        for byte_string in Doc.read_bytes(bin):
+            doc = decode_doc(byte_string)
+            if len(doc) > 0:
+                ids = doc.to_array([ORTH, TAG])
+                tokens.write(writer.rows(ids[:,0]))
+                tags.write(writer.tag_codes(ids[:,1]))
+            offsets.append(tokens.length)
+    tokens.finish()
+    tags.finish()
+    # written last: its presence marks the file as compiled
+    np.save(prefix + ".offsets.npy", np.array(offsets, dtype=np.int64))
+    if save:
+        writer.save()
+        _LEXEME_TABLE = None
+    return len(offsets) - 1
+
+def compile_corpus(subreddits, year, months, path=None, post_path=None):
+    """
+    Compiles the comments and post titles of every subreddit-month.
+    """
+    global _LEXEME_TABLE
+    writer = LexemeTableWriter()
+    for subreddit in subreddits:
+        for month in months:
+            compile_file(SpacyComments(subreddit, year, month, path=path).path, ".bin", writer)
+            compile_file(PostIterator(subreddit, year, month, path=post_path).path,
+                    ".title.bin", writer)
+            # saved after every month, so an interrupted run keeps what it compiled
+            writer.save()
+    _LEXEME_TABLE = None
+
+
+class CompiledRecord(dict):
+    """
+    Post/comment record whose text comes from a compiled file.
+    It carries "length" and "vector_ids" (what extract_network needs, so it is
+    never decoded there), and builds "text" on first access; there is no "doc".
+    """
+    def __init__(self, info, compiled, position, with_text=False, include_punct=True):
+        dict.__init__(self, info)
+        start, end = compiled.offsets[position], compiled.offsets[position+1]
+        self.rows = compiled.tokens[start:end]
+        self.table = compiled.table
+        self._tag_codes = compiled.tags[start:end]
+        self.with_text = with_text
+        self.include_punct = include_punct
+        self["length"] = int(end - start)
+        self["vector_ids"] = compiled.table.vector_ids(self.rows)
+
+    def __missing__(self, key):
+        if key == "text" and self.with_text:
+            value = self.table.text(self.rows, self._tag_codes, self.include_punct)
+            self[key] = value
+            return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key == "text" and self.with_text)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class CompiledFile():
+    """
+    The memory-mapped arrays of one compiled file.
+    """
+    def __init__(self, path, bin_suffix, table=None):
+        prefix = _prefix(path, bin_suffix)
+        self.table = get_lexeme_table() if table is None else table
+        self.tokens = np.load(prefix + ".tokens.npy", mmap_mode="r")
+        self.tags = np.load(prefix + ".tags.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + ".offsets.npy")
+
+    def lower_counts(self, keep):
+        """
+        Counts of the lowercase forms (by table row) of the tokens of the docs
+        where the boolean array keep is set.
+        """
+        token_mask = np.repeat(keep, np.diff(self.offsets))
+        return np.bincount(self.table.lower_rows[self.tokens[token_mask]],
+                minlength=len(self.table))
+
+class CompiledMixin():
+    """
+    Iteration over compiled files for a SpacyComments/PostIterator subclass:
+    records are filtered from the .info lines like the originals, but their
+    text comes from the compiled arrays.
+    """
+    _with_text = False
+    table = None
+    # (week, selected records) kept by lower_counts for the iteration that follows
+    _selection = None
+
+    def _compiled(self):
+        return CompiledFile(self.path, self._bin_suffix, self.table)
+
+    def __iter__(self, week=None):
+        return self._timed(self._iter_compiled(week))
+
+    def can_prefetch(self):
+        # nothing to read ahead, the compiled arrays are memory mapped
+        return False
+
+    def _selected(self, week=None):
+        records = self._candidates(week)
+        sampler = getattr(self, "down_sample", None)
+        if not sampler is None:
+            records = sampler.select(records, key=self.path)
+        return records
+
+    def _take_selected(self, week=None):
+        # the selection lower_counts made, so the .info file is only read once
+        selection, self._selection = self._selection, None
+        if not selection is None and selection[0] == week:
+            return selection[1]
+        return self._selected(week)
+
+    def _iter_compiled(self, week=None):
+        compiled = self._compiled()
+        for position, record_info in self._take_selected(week):
+            yield CompiledRecord(record_info, compiled, position, self._with_text,
+                    getattr(self, "include_punct", True))
+
+    def lower_counts(self, week=None):
+        """
+        Word counts (by lexeme table row) of the records this iterator yields.
+        The selected records are kept for the next iteration over the same week.
+        """
+        compiled = self._compiled()
+        selected = list(self._selected(week))
+        self._selection = (week, selected)
+        keep = np.zeros(len(compiled.offsets) - 1, dtype=bool)
+        keep[[position for position, _ in selected]] = True
+        return compiled.lower_counts(keep)
+
+class CompiledComments(CompiledMixin, SpacyComments):
+    """
+    SpacyComments over a compiled file.
+    """
+    _with_text = True
+
+    def __init__(self, subreddit, year, month=None, table=None, **kw_args):
+        SpacyComments.__init__(self, subreddit, year, month, **kw_args)
+        self.table = table
+
+class CompiledPosts(CompiledMixin, PostIterator):
+    """
+    PostIterator over a compiled title file.
+    """
+    def __init__(self, subreddit, year, month, table=None, **kw_args):
+        PostIterator.__init__(self, subreddit, year, month, **kw_args)
+        self.table = table
+
+def compiled_word_freqs(comment_iters, week=None, table=None):
+    """
+    WordFreqs over the lowercase words of the given compiled comment iterators;
+    the same counts extract_network gathers when it reads them.
+    """
+    table = get_lexeme_table() if table is None else table
+    counts = np.zeros(len(table), dtype=np.int64)
+    for comment_iter in comment_iters:
+        counts += comment_iter.lower_counts(week)
+    rows = np.flatnonzero(counts)
+    strings = table.strings
+    return WordFreqs([strings[row] for row in rows], counts[rows])
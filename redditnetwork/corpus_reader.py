@@ -3,23 +3,244 @@ Various objects for iterating over and accessing processed Reddit data.
 """
 
 import json
+import zlib
+import random
+from itertools import izip
 
 from redditnetwork import constants
 from redditnetwork.utils.datautils import read_filtered_users
 from redditnetwork.utils.stringutils import is_bot
-from redditnetwork.utils.dateutils import get_week
+from redditnetwork.utils.dateutils import get_week, week_range
+from redditnetwork.record_index import RecordIndex, INDEX_SUFFIX
+from redditnetwork.manifest import manifest_len, path_exists
+from redditnetwork.block_compression import open_corpus_file, corpus_file_size
+from redditnetwork.prefetch import prefetch_sources, iter_prefetched
 
 from spacy.tokens.doc import Doc
-from spacy.en import English
 
-SPACY_VOCAB = English().vocab
-FILTERED_USERS = read_filtered_users()
+# Both are loaded on first use (see get_vocab and get_filtered_users), so importing
+# this module neither builds the English model nor needs the data directory.
+_SPACY_VOCAB = None
+_VOCAB_VECTORS = True
+_FILTERED_USERS = None
+
+def configure_vocab(vectors=True):
+    """
+    Chooses how get_vocab loads the vocab; must be called before it is first used.
+    With vectors=False only the strings and lexemes that Doc deserialization needs are
+    loaded, not the word vectors (the bulk of the model). Such a vocab cannot be used
+    for word_vecs, unless the vectors come from a VectorTable.
+    """
+    global _VOCAB_VECTORS
+    if not _SPACY_VOCAB is None and vectors != _VOCAB_VECTORS:
+        raise ValueError("The spacy vocab has already been loaded with vectors={}".format(
+            _VOCAB_VECTORS))
+    _VOCAB_VECTORS = vectors
+
+def get_vocab():
+    """
+    The shared spacy vocab used to decode all docs, loaded on first use.
+    Only the vocab is loaded, not the tagger/parser/entity models.
+    """
+    global _SPACY_VOCAB
+    if _SPACY_VOCAB is None:
+        from spacy.en import English
+        if _VOCAB_VECTORS:
+            nlp = English(tagger=False, parser=False, entity=False, matcher=False)
+        else:
+            nlp = English(tagger=False, parser=False, entity=False, matcher=False,
+                    add_vectors=False)
+        _SPACY_VOCAB = nlp.vocab
+    return _SPACY_VOCAB
+
+def vocab_has_vectors():
+    return _VOCAB_VECTORS
+
+def get_filtered_users():
+    """
+    The set of filtered (bot/spam) users, read on first use.
+    """
+    global _FILTERED_USERS
+    if _FILTERED_USERS is None:
+        _FILTERED_USERS = read_filtered_users()
+    return _FILTERED_USERS
+
+def filter_reason(info, clean_deleted=True, clean_bots=True):
+    """
+    Why an iterator drops a record: "filtered_deleted", "filtered_bot",
+    "filtered_user" (listed in filtered_users.txt), or None if it is kept.
+    """
+    author = info["author"]
+    if clean_deleted and author == "[deleted]":
+        return "filtered_deleted"
+    if clean_bots:
+        if is_bot(author):
+            return "filtered_bot"
+        if author in get_filtered_users():
+            return "filtered_user"
+    return None
+
+def spacy_string_clean(token, include_punct=True):
+    if token.like_url:
+        return "<URL>"
+    elif token.like_num:
+        return "<NUM>"
+    elif (not include_punct) and token.is_punct and (not token.tag_ == "."):
+        return ""
+    else:
+        return token.lower_
+
+def text_from_doc(doc, include_punct=True):
+    return " ".join([spacy_string_clean(token, include_punct) for token in doc])
+
+def count_records(path):
+    """
+    Number of records in the files at path: from the corpus manifest if there
+    is one, else by counting the lines of the .info file.
+    """
+    count = manifest_len(path)
+    if count is None:
+        count = 0
+        with open_corpus_file(path + ".info") as fp:
+            for _ in fp:
+                count += 1
+    return count
+
+def decode_doc(byte_string):
+    return Doc(get_vocab()).from_bytes(byte_string)
+
+class LazyRecord(dict):
+    """
+    Post/comment record that keeps the raw spacy bytes and only decodes
+    the "doc" entry (and builds the "text" entry from it) on first access.
+    Lazy entries show up in `in` and get(), but not in keys() until accessed.
+    """
+    def __init__(self, info, byte_string, with_text=False, include_punct=True):
+        dict.__init__(self, info)
+        self.byte_string = byte_string
+        self.with_text = with_text
+        self.include_punct = include_punct
+
+    def _is_lazy(self, key):
+        return key == "doc" or (key == "text" and self.with_text)
+
+    def __missing__(self, key):
+        if key == "doc":
+            value = decode_doc(self.byte_string)
+        elif key == "text" and self.with_text:
+            value = text_from_doc(self["doc"], self.include_punct)
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._is_lazy(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+class HashSample():
+    """
+    Down-sampling that keeps each record with probability fraction, decided by a
+    hash of its id: the same records are kept on every run and in every file.
+    """
+    def __init__(self, fraction, salt=""):
+        self.fraction = fraction
+        self.salt = salt
+        self._threshold = int(fraction * 2**32)
+
+    def keep(self, info):
+        return (zlib.crc32(self.salt + info["id"]) & 0xffffffff) < self._threshold
+
+    def select(self, records, key=""):
+        return [record for record in records if self.keep(record[1])]
+
+class _Reservoir():
+    def __init__(self, size, rng):
+        self.size = size
+        self.rng = rng
+        self.seen = 0
+        self.records = []
+
+    def offer(self, record):
+        if self.seen < self.size:
+            self.records.append(record)
+        else:
+            slot = self.rng.randint(0, self.seen)
+            if slot < self.size:
+                self.records[slot] = record
+        self.seen += 1
+
+def _sample_rng(seed, key):
+    # deterministic for a given seed and file
+    return random.Random(zlib.crc32("{}:{}".format(seed, key)))
+
+class ReservoirSample():
+    """
+    Down-sampling to a uniform sample of (at most) size records per file.
+    """
+    def __init__(self, size, seed=0):
+        self.size = size
+        self.seed = seed
+
+    def select(self, records, key=""):
+        reservoir = _Reservoir(self.size, _sample_rng(self.seed, key))
+        for record in records:
+            reservoir.offer(record)
+        return sorted(reservoir.records, key=lambda record : record[0])
+
+class WeekStratifiedSample():
+    """
+    Down-sampling to a uniform sample of (at most) per_week records of every week in a file.
+    """
+    def __init__(self, per_week, seed=0):
+        self.per_week = per_week
+        self.seed = seed
+
+    def select(self, records, key=""):
+        rng = _sample_rng(self.seed, key)
+        reservoirs = {}
+        for record in records:
+            week = get_week(record[1]["timestamp"])
+            if not week in reservoirs:
+                reservoirs[week] = _Reservoir(self.per_week, rng)
+            reservoirs[week].offer(record)
+        return sorted((record for reservoir in reservoirs.values() for record in reservoir.records),
+                key=lambda record : record[0])
+
+def make_sampler(down_sample):
+    """
+    A float down_sample is a HashSample fraction, an int a ReservoirSample size;
+    sampler objects (anything with select(records, key)) are used as they are.
+    """
+    if down_sample is None or hasattr(down_sample, "select"):
+        return down_sample
+    if isinstance(down_sample, float):
+        if not 0. < down_sample <= 1.:
+            raise ValueError("Sampling fraction must be in (0, 1], got {}".format(down_sample))
+        return HashSample(down_sample)
+    return ReservoirSample(int(down_sample))
 
 class MultiIterWrapper():
-    def __init__(self, iters):
+    """
+    Chains iterators. With prefetch (a number of records), the raw records of
+    the upcoming files are read in a background thread while the current ones
+    are decoded (see prefetch).
+    """
+    def __init__(self, iters, prefetch=0):
         self.iters = iters
+        self.prefetch = prefetch
+
+    def sources(self):
+        return [source for _iter in self.iters for source in prefetch_sources(_iter)]
 
     def __iter__(self):
+        if self.prefetch:
+            return iter_prefetched(self.sources(), self.prefetch)
+        return self._iter_chained()
+
+    def _iter_chained(self):
         for _iter in self.iters:
             for item in _iter:
                 yield item
@@ -30,28 +251,196 @@ class WeekIterWrapper():
     Takes a comment or post iterator class as an argument.
     Annoyingly weeks and months are not aligned....
     """
-    def __init__(self, cls, week, subreddit, year, **kw_args):
+    def __init__(self, cls, week, subreddit, year, prefetch=0, **kw_args):
         # Throws an assertion if you try to get weeks that cross between
         # years
         assert week != 0 and week < 51
         self.week = week
+        self.prefetch = prefetch
         month = week / 4 + 1
         ## Week 1 for us == week 2 for ISO weeks
         self.iter1 = cls(subreddit, year, month, **kw_args)
         self.iter2 = cls(subreddit, year, month+1, **kw_args)
 
+    def sources(self):
+        return [(self.iter1, self.week), (self.iter2, self.week)]
+
     def __iter__(self):
+        if self.prefetch:
+            return iter_prefetched(self.sources(), self.prefetch)
+        return self._iter_months()
+
+    def _iter_months(self):
         for item in self.iter1.__iter__(week=self.week):
             yield item
         for item in self.iter2.__iter__(week=self.week):
             yield item
 
+class RandomAccessMixin():
+    """
+    Random access into a .bin/.info file pair through a sidecar RecordIndex.
+    Subclasses define _bin_suffix, _record_key(line), _parse_info(line) and
+    _decode(info, byte_string).
+    Records fetched through get_record(s) are not filtered for deleted users or bots,
+    records from iter_time_range are.
+    Iteration is split into raw_records (reading the info lines and doc bytes)
+    and records_from_raw (parsing, filtering and decoding them), so that the
+    reads can run ahead in a background thread (see prefetch).
+    """
+    _index = None
+    _kind = "records"
+    stats = None
+
+    def build_index(self, save=True):
+        """
+        Scans the files once and (optionally) writes the sidecar index next to them.
+        """
+        self._index = RecordIndex.build(self.path, self._bin_suffix, self._record_key)
+        if save:
+            self._index.save(self.path + INDEX_SUFFIX)
+        return self._index
+
+    def source_sizes(self):
+        """
+        Sizes of the .bin and .info files, to tell whether a sidecar file is stale.
+        """
+        return (corpus_file_size(self.path + self._bin_suffix),
+                corpus_file_size(self.path + ".info"))
+
+    def get_index(self, build=True):
+        """
+        Loads the sidecar index, building it if it does not exist yet
+        or was built from files of a different size.
+        """
+        if self._index is None:
+            try:
+                self._index = RecordIndex.load(self.path + INDEX_SUFFIX, self.source_sizes())
+            except IOError:
+                if not build:
+                    raise
+                self.build_index(save=False)
+                try:
+                    self._index.save(self.path + INDEX_SUFFIX)
+                except IOError:
+                    # read-only corpus location, keep the index in memory only
+                    pass
+        return self._index
+
+    def iter_records(self, positions):
+        """
+        Generates the records at the given record numbers, in the given order.
+        """
+        index = self.get_index()
+        with open_corpus_file(self.path + self._bin_suffix) as bin:
+            with open_corpus_file(self.path + ".info") as info:
+                for line, byte_string in index.read(bin, info, positions):
+                    yield self._make_record(line, byte_string)
+
+    def iter_time_range(self, start, end):
+        """
+        Generates the (filtered) records with start <= timestamp < end, in file order.
+        Only those records are read and decoded.
+        """
+        return self._from_raw(self._raw_time_range(start, end))
+
+    def _raw_time_range(self, start, end):
+        index = self.get_index()
+        with open_corpus_file(self.path + self._bin_suffix) as bin:
+            with open_corpus_file(self.path + ".info") as info:
+                for raw in index.read(bin, info, index.time_range(start, end)):
+                    yield raw
+
+    def _raw_file(self):
+        with open_corpus_file(self.path + self._bin_suffix) as bin:
+            with open_corpus_file(self.path + ".info") as info:
+                for byte_string in Doc.read_bytes(bin):
+                    yield info.next(), byte_string
+
+    def can_prefetch(self):
+        return True
+
+    def raw_records(self, week=None):
+        """
+        Generates the (info line, byte string) pairs that __iter__(week) goes through:
+        through the index only the week's records, otherwise the whole file.
+        """
+        if not (week is None) and self.use_index:
+            return self._raw_time_range(*week_range(self.year, week))
+        return self._raw_file()
+
+    def records_from_raw(self, raws, week=None):
+        """
+        The records __iter__(week) gives, from the pairs of raw_records(week).
+        """
+        return self._timed(self._from_raw(raws, week))
+
+    def _from_raw(self, raws, week=None):
+        for line, byte_string in raws:
+            record_info = self._parse_info(line)
+            if (not week is None) and self._wrong_week(record_info, week):
+                continue
+            if not self._keep(record_info):
+                continue
+            yield self._decode(record_info, byte_string)
+
+    def _keep(self, info):
+        reason = filter_reason(info, self.clean_deleted, self.clean_bots)
+        if not self.stats is None:
+            self.stats.count(self._kind + ".read")
+            if not reason is None:
+                self.stats.count(self._kind + "." + reason)
+        return reason is None
+
+    def _wrong_week(self, info, week):
+        if get_week(info["timestamp"]) == week:
+            return False
+        if not self.stats is None:
+            self.stats.count(self._kind + ".read")
+            self.stats.count(self._kind + ".filtered_week")
+        return True
+
+    def _candidates(self, week=None):
+        """
+        Generates (record number, info) for the records that pass the filters,
+        from the .info file alone.
+        """
+        with open_corpus_file(self.path + ".info")  as info:
+            for position, line in enumerate(info):
+                record_info = self._parse_info(line)
+                if (not week is None) and self._wrong_week(record_info, week):
+                    continue
+                if not self._keep(record_info):
+                    continue
+                yield position, record_info
+
+    def _timed(self, records):
+        if self.stats is None:
+            return records
+        return self.stats.timed_iter(records, "read")
+
+    def _make_record(self, line, byte_string):
+        return self._decode(self._parse_info(line), byte_string)
+
+    def get_record(self, n):
+        return next(self.iter_records([n]))
+
+    def get_records(self, start, stop):
+        return list(self.iter_records(xrange(start, min(stop, len(self.get_index())))))
+
+    def get_records_by_id(self, ids):
+        """
+        Returns a dict from id to record for the ids present in this file.
+        """
+        positions = self.get_index().positions(ids)
+        return {record["id"] : record for record in 
+                self.iter_records(sorted(positions[positions >= 0]))}
+
 class PostMap():
     """
     Map into post data.
     """
     def __init__(self, subreddit, year, month, week=None, path=None,
-            clean_deleted=True, clean_bots=True):
+            clean_deleted=True, clean_bots=True, stats=None):
         if path == None:
             path = constants.DATA_HOME + "spacy_posts/"
         if not week is None:
@@ -59,11 +448,11 @@ class PostMap():
             self.post_map = self._make_map(
                     WeekIterWrapper(PostIterator, week, subreddit, 
                         year, path=path, 
-                        clean_deleted=True, clean_bots=True))
+                        clean_deleted=True, clean_bots=True, stats=stats))
         else:
             self.post_map = self._make_map(
                     PostIterator(subreddit, year, month, path=path, 
-                        clean_deleted=True, clean_bots=True))
+                        clean_deleted=True, clean_bots=True, stats=stats))
 
     def _make_map(self, info_iterator):
         post_map = {}
@@ -81,51 +470,49 @@ class PostMap():
         return id in self.post_map
 
 
-class PostIterator():
+class PostIterator(RandomAccessMixin):
     """
     Iterator over post metadata only
     """
+    _bin_suffix = ".title.bin"
+    _kind = "posts"
+
     def __init__(self, subreddit, year, month, path=None, 
-            clean_deleted=True, clean_bots=True):
+            clean_deleted=True, clean_bots=True, use_index=True, stats=None):
         if path == None:
             path = constants.DATA_HOME + "spacy_posts/"
         path += "{:d}_{:02d}/".format(year, month) + subreddit
-        self._vocab = SPACY_VOCAB
         self.path = path
         self._len = None
         self.clean_bots = clean_bots
         self.clean_deleted = clean_deleted
         self.subreddit = subreddit
+        self.year = year
+        self.use_index = use_index
+        self.stats = stats
 
     def _parse_info(self, line):
         info = json.loads(line)
         info["subreddit"] = self.subreddit
         return info
 
+    def _record_key(self, line):
+        info = json.loads(line)
+        return info["id"], int(info["timestamp"])
+
+    def _decode(self, post_info, byte_string):
+        return LazyRecord(post_info, byte_string)
+
     def __len__(self):
         if self._len == None:
-            i = -1
-            with open(self.path + ".info") as fp:
-                for i, _ in enumerate(fp):
-                    pass
-            self._len = i + 1
+            self._len = count_records(self.path)
         return self._len
 
+    def exists(self):
+        return path_exists(self.path)
+
     def __iter__(self, week=None):
-        with open(self.path + ".info")  as info:
-            with open(self.path + ".title.bin") as title_bin:
-                for byte_string in Doc.read_bytes(title_bin):
-                    info_line = info.readline()
-                    comment_info = self._parse_info(info_line)
-                    if not (week is None) and get_week(comment_info["timestamp"]) != week:
-                        continue
-                    if self.clean_deleted and comment_info["author"] == "[deleted]":
-                        continue
-                    if self.clean_bots and (is_bot(comment_info["author"]) or 
-                        comment_info["author"] in FILTERED_USERS):
-                        continue
-                    comment_info["doc"] = Doc(self._vocab).from_bytes(byte_string)
-                    yield comment_info
+        return self.records_from_raw(self.raw_records(week), week)
 
 
 class InfoIterator():
@@ -133,7 +520,7 @@ class InfoIterator():
     Iterator over comment metadata only
     """
     def __init__(self, subreddit, year, month=None, path=None,
-            clean_deleted=True, clean_bots=True):
+            clean_deleted=True, clean_bots=True, stats=None):
         if path == None:
             path = constants.DATA_HOME + "spacy_comments/"
      #   self._vocab = Vocab.load(path + u"vocab.bin")
@@ -146,6 +533,7 @@ class InfoIterator():
         self._len = None
         self.clean_deleted = clean_deleted
         self.clean_bots = clean_bots
+        self.stats = stats
 
     def _parse_info(self, line):
         info = line.split("\t")
@@ -159,34 +547,47 @@ class InfoIterator():
 
     def __len__(self):
         if self._len == None:
-            i = -1
-            with open(self.path + ".info") as fp:
-                for i, _ in enumerate(fp):
-                    pass
-            self._len = i + 1
+            self._len = count_records(self.path)
         return self._len
 
+    def exists(self):
+        return path_exists(self.path)
+
     def __iter__(self):
-        with open(self.path + ".info")  as info:
+        if self.stats is None:
+            return self._iter_file()
+        return self.stats.timed_iter(self._iter_file(), "read")
+
+    def _iter_file(self):
+        with open_corpus_file(self.path + ".info")  as info:
             for line in info:
                 comment_info = self._parse_info(line)
-                if self.clean_deleted and comment_info["author"] == "[deleted]":
-                    continue
-                if self.clean_bots and (is_bot(comment_info["author"]) or 
-                    comment_info["author"] in FILTERED_USERS):
+                reason = filter_reason(comment_info, self.clean_deleted, self.clean_bots)
+                if not self.stats is None:
+                    self.stats.count("comments.read")
+                    if not reason is None:
+                        self.stats.count("comments." + reason)
+                if not reason is None:
                     continue
                 yield comment_info
 
-class SpacyComments():
+class SpacyComments(RandomAccessMixin):
     """
     Iterator over spacy comments.
     """
+    _bin_suffix = ".bin"
+    _kind = "comments"
 
     def __init__(self, subreddit, year, month=None, path=None, 
-            include_punct=True, down_sample=None, clean_bots=True, clean_deleted=True):
+            include_punct=True, down_sample=None, clean_bots=True, clean_deleted=True,
+            use_index=True, stats=None):
+        """
+        down_sample (see make_sampler) selects a sample of the (filtered) comments
+        from their metadata alone; only the selected docs are then read, through
+        the record index if use_index is set.
+        """
         if path == None:
             path = constants.DATA_HOME + "spacy_comments/"
-        self._vocab = SPACY_VOCAB
         if not month is None:
             path += "{:d}_{:02d}/".format(year, month) + subreddit
         else:
@@ -197,19 +598,16 @@ class SpacyComments():
         self.clean_deleted = clean_deleted
         self.include_punct = include_punct
         self.subreddit = subreddit
+        self.year = year
+        self.use_index = use_index
+        self.stats = stats
+        self.down_sample = make_sampler(down_sample)
 
     def _spacy_string_clean(self, token):
-        if token.like_url:
-            return "<URL>"
-        elif token.like_num:
-            return "<NUM>"
-        elif (not self.include_punct) and token.is_punct and (not token.tag_ == "."):
-            return ""
-        else:
-            return token.lower_
+        return spacy_string_clean(token, self.include_punct)
 
     def _text_from_doc(self, doc):
-        return " ".join([self._spacy_string_clean(token) for token in doc])
+        return text_from_doc(doc, self.include_punct)
 
     def _parse_info(self, line):
         info = line.split("\t")
@@ -222,27 +620,48 @@ class SpacyComments():
                 "post" : info[5].strip()}
         return comment_info
 
+    def _record_key(self, line):
+        info = line.split("\t", 2)
+        return info[0], int(info[1])
+
+    def _decode(self, comment_info, byte_string):
+        return LazyRecord(comment_info, byte_string, with_text=True,
+                include_punct=self.include_punct)
+
     def __len__(self):
         if self._len == None:
-            with open(self.path + ".info") as fp:
-                for i, _ in enumerate(fp):
-                    pass
-            self._len = i + 1
+            self._len = count_records(self.path)
         return self._len
 
+    def exists(self):
+        return path_exists(self.path)
+
     def __iter__(self, week=None):
-        with open(self.path + ".bin", "rb") as bin:
-            with open(self.path + ".info")  as info:
-                for byte_string in Doc.read_bytes(bin):
-                    comment_info = self._parse_info(info.next())
-                    if (not week is None) and get_week(comment_info["timestamp"]) != week:
-                        continue
-                    if self.clean_deleted and comment_info["author"] == "[deleted]":
-                        continue
-                    if self.clean_bots and (is_bot(comment_info["author"]) or 
-                        comment_info["author"] in FILTERED_USERS):
-                        continue
-                    doc = Doc(self._vocab).from_bytes(byte_string)
-                    comment_info["doc"] = doc
-                    comment_info["text"] = self._text_from_doc(doc)
-                    yield comment_info
+        if not self.down_sample is None:
+            return self._timed(self._iter_sampled(week))
+        return self.records_from_raw(self.raw_records(week), week)
+
+    def can_prefetch(self):
+        # the sample is chosen from the metadata first; read as usual
+        return self.down_sample is None
+
+    def _iter_sampled(self, week=None):
+        """
+        Chooses the sample from the .info file, then reads only the chosen docs.
+        """
+        chosen = self.down_sample.select(self._candidates(week), key=self.path)
+        if not self.stats is None:
+            self.stats.count("comments.sampled", len(chosen))
+        if self.use_index:
+            index = self.get_index()
+            with open_corpus_file(self.path + ".bin") as bin:
+                with open_corpus_file(self.path + ".info") as info:
+                    records = index.read(bin, info, [position for position, _ in chosen])
+                    for (_, comment_info), (_, byte_string) in izip(chosen, records):
+                        yield self._decode(comment_info, byte_string)
+            return
+        chosen = dict(chosen)
+        with open_corpus_file(self.path + ".bin") as bin:
+            for position, byte_string in enumerate(Doc.read_bytes(bin)):
+                if position in chosen:
+                    yield self._decode(chosen[position], byte_string)
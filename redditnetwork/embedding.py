@@ -0,0 +1,302 @@
+"""
+Batched SIF embeddings for the word_vecs features.
+
+A document is reduced once (digest_doc) to the orth ids of its tokens that have
+a vector. A block of documents is then embedded with a single sparse
+(docs x distinct words) matrix of SIF weights times the matching vector table,
+with the weight of every distinct word computed once per block.
+"""
+
+import os
+import numpy as np
+import scipy.sparse as sp
+
+from collections import Counter
+
+from spacy.attrs import ORTH, LOWER
+
+from redditnetwork.corpus_reader import get_vocab, vocab_has_vectors, configure_vocab
+from redditnetwork.utils.arrayutils import sorted_lookup
+
+VEC_SIZE=300
+SIF=10e-4
+BLOCK_SIZE=10000
+
+class VocabVectors():
+    """
+    Vector lookups backed by a spacy vocab.
+    Lexemes are resolved once per distinct orth id and cached.
+    """
+    def __init__(self, vocab=None):
+        if vocab is None:
+            if not vocab_has_vectors():
+                raise ValueError("The spacy vocab was configured without vectors")
+            vocab = get_vocab()
+        self.vocab = vocab
+        # -1 not resolved yet, 0 no vector, 1 has a vector (spacy 1.x ids are small ints)
+        self._has_vector = -np.ones(0, dtype=np.int8)
+        self._cache = {}
+
+    def _resolve(self, orth_ids):
+        if len(orth_ids) == 0:
+            return
+        top = int(orth_ids.max()) + 1
+        if top > len(self._has_vector):
+            grown = -np.ones(max(top, 2*len(self._has_vector)), dtype=np.int8)
+            grown[:len(self._has_vector)] = self._has_vector
+            self._has_vector = grown
+        unknown = np.unique(orth_ids[self._has_vector[orth_ids] < 0])
+        for orth in unknown:
+            self._has_vector[orth] = self.vocab[int(orth)].has_vector
+
+    def has_vector(self, orth_ids):
+        orth_ids = np.asarray(orth_ids, dtype=np.int64)
+        self._resolve(orth_ids)
+        return self._has_vector[orth_ids] == 1
+
+    def lookup(self, orth_ids):
+        """
+        Returns the lowercase strings and the (len(orth_ids), VEC_SIZE) vectors
+        of distinct orth ids.
+        """
+        lowers = []
+        vectors = np.zeros((len(orth_ids), VEC_SIZE), dtype=np.float32)
+        for i, orth in enumerate(orth_ids):
+            orth = int(orth)
+            if not orth in self._cache:
+                lexeme = self.vocab[orth]
+                self._cache[orth] = (lexeme.lower_, lexeme.vector)
+            lower, vector = self._cache[orth]
+            lowers.append(lower)
+            vectors[i] = vector
+        return lowers, vectors
+
+class VectorTable():
+    """
+    Vector lookups backed by a table exported once to disk and memory-mapped
+    read-only, so every reader and worker process on a machine shares one copy.
+    The table stores, per word with a vector, its string, the float32 vector and
+    its lowercase form (the strings as utf-8 buffers with offsets). Orth ids differ
+    between a vocab with and without the vectors loaded, so load maps the strings
+    to the orth ids of the reading process's vocab; orths is the sorted array of
+    those ids and order gives the table row of each.
+    """
+    FILES = ["strings.npy", "string_offsets.npy", "vectors.npy", "lowers.npy",
+            "lower_offsets.npy"]
+
+    def __init__(self, orths, order, vectors, lowers, lower_offsets):
+        self.orths = orths
+        self.order = order
+        self.vectors = vectors
+        self.lowers = lowers
+        self.lower_offsets = lower_offsets
+
+    @classmethod
+    def export(cls, directory, vocab=None):
+        """
+        Writes the vectors of every lexeme of vocab (default: the corpus_reader vocab)
+        to directory and returns the memory-mapped table.
+        """
+        vocab = get_vocab() if vocab is None else vocab
+        lexemes = sorted((lexeme.orth, lexeme.orth_.encode("utf-8"), lexeme.lower_.encode("utf-8"))
+                for lexeme in vocab if lexeme.has_vector)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        vectors = np.lib.format.open_memmap(os.path.join(directory, "vectors.npy"),
+                mode="w+", dtype=np.float32, shape=(len(lexemes), VEC_SIZE))
+        for row, (orth, _, _) in enumerate(lexemes):
+            vectors[row] = vocab[orth].vector
+        vectors.flush()
+        del vectors
+        for name, offsets_name, column in [("strings", "string_offsets", 1),
+                ("lowers", "lower_offsets", 2)]:
+            buffer, offsets = _encode_strings([lexeme[column] for lexeme in lexemes])
+            np.save(os.path.join(directory, name + ".npy"), buffer)
+            np.save(os.path.join(directory, offsets_name + ".npy"), offsets)
+        return cls.load(directory, vocab)
+
+    @classmethod
+    def load(cls, directory, vocab=None):
+        """
+        Loads the table in directory, keyed by the orth ids of vocab
+        (default: the corpus_reader vocab).
+        """
+        vocab = get_vocab() if vocab is None else vocab
+        strings, string_offsets, vectors, lowers, lower_offsets = [
+                np.load(os.path.join(directory, name), mmap_mode="r") for name in cls.FILES]
+        # looking a string up interns it, so words only the vectors know get an id too
+        orths = np.array([vocab.strings[string] for string in
+            _decode_strings(strings, string_offsets)], dtype=np.int64)
+        order = np.argsort(orths, kind="mergesort")
+        return cls(orths[order], order, vectors, lowers, lower_offsets)
+
+    def _rows(self, orth_ids):
+        rows = sorted_lookup(self.orths, np.asarray(orth_ids, dtype=np.int64))
+        rows[rows >= 0] = self.order[rows[rows >= 0]]
+        return rows
+
+    def has_vector(self, orth_ids):
+        return self._rows(orth_ids) >= 0
+
+    def lookup(self, orth_ids):
+        """
+        Returns the lowercase strings and the (len(orth_ids), VEC_SIZE) vectors
+        of distinct orth ids that have a vector.
+        """
+        rows = self._rows(orth_ids)
+        if (rows < 0).any():
+            raise KeyError("No vector for orth ids {}".format(orth_ids[rows < 0][:10]))
+        lowers = [self.lowers[self.lower_offsets[row]:self.lower_offsets[row+1]].tobytes()
+                .decode("utf-8") for row in rows]
+        return lowers, np.asarray(self.vectors[rows], dtype=np.float32)
+
+def _encode_strings(values):
+    # utf-8 strings as one uint8 buffer plus the offset of every string in it
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in values])
+    return np.array(bytearray("".join(values)), dtype=np.uint8), offsets
+
+def _decode_strings(buffer, offsets):
+    buffer = buffer.tobytes()
+    return [buffer[offsets[i]:offsets[i+1]].decode("utf-8") for i in xrange(len(offsets) - 1)]
+
+_DEFAULT_VECTORS = None
+
+def use_vector_table(directory):
+    """
+    Makes the memory-mapped VectorTable in directory the default vector source.
+    Call this before forking workers. If the spacy vocab has not been loaded yet,
+    it is then loaded without its own copy of the vectors.
+    """
+    global _DEFAULT_VECTORS
+    try:
+        configure_vocab(vectors=False)
+    except ValueError:
+        # vocab already loaded with vectors; nothing to save any more
+        pass
+    _DEFAULT_VECTORS = VectorTable.load(directory)
+    return _DEFAULT_VECTORS
+
+def default_vectors():
+    """
+    The vector source used when none is given: the table set with use_vector_table,
+    or else a VocabVectors over the corpus_reader vocab.
+    """
+    global _DEFAULT_VECTORS
+    if _DEFAULT_VECTORS is None:
+        _DEFAULT_VECTORS = VocabVectors()
+    return _DEFAULT_VECTORS
+
+
+class LowerCounts():
+    """
+    Counts lowercase lexeme ids with bincounts over batches of tokens.
+    """
+    def __init__(self, flush_size=1000000):
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.total = 0
+        self._pending = []
+        self._pending_size = 0
+        self._flush_size = flush_size
+
+    def add(self, lower_ids):
+        self._pending.append(lower_ids)
+        self._pending_size += len(lower_ids)
+        self.total += len(lower_ids)
+        if self._pending_size >= self._flush_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending_size > 0:
+            counts = np.bincount(np.concatenate(self._pending).astype(np.int64))
+            if len(counts) > len(self.counts):
+                counts[:len(self.counts)] += self.counts
+                self.counts = counts
+            else:
+                self.counts[:len(counts)] += counts
+        self._pending = []
+        self._pending_size = 0
+
+    def to_counter(self, vocab=None):
+        """
+        Counter keyed by the lowercase strings.
+        """
+        vocab = get_vocab() if vocab is None else vocab
+        self._flush()
+        ids = np.flatnonzero(self.counts)
+        return Counter({vocab.strings[int(lower)] : int(self.counts[lower]) for lower in ids})
+
+
+def digest_doc(doc, lower_counts=None, vectors=None):
+    """
+    Single vectorized pass over the tokens of doc.
+    Adds the lowercase ids to lower_counts (a LowerCounts, if given) and returns the
+    orth ids of the tokens that have a vector, which is all the embedding needs.
+    """
+    vectors = default_vectors() if vectors is None else vectors
+    if len(doc) == 0:
+        return np.zeros(0, dtype=np.int64)
+    ids = doc.to_array([ORTH, LOWER]).astype(np.int64)
+    if not lower_counts is None:
+        lower_counts.add(ids[:,1])
+    orths = ids[:,0]
+    return orths[vectors.has_vector(orths)]
+
+
+class SIFEmbedder():
+    """
+    Computes SIF weighted average word vectors for blocks of digested documents.
+    counter maps lowercase words to counts (a Counter, defaultdict or WordFreqs).
+    Gives the same values as averaging word.vector*(SIF / (counter[word.lower_]/total_count + SIF))
+    over the tokens with a vector, and zeros for docs without vectors or with NaNs.
+    With an empty table (total_count 0, e.g. a month without comments) every word
+    weighs 1, as a word that was never counted does.
+    """
+    def __init__(self, counter, total_count, vectors=None):
+        self.counter = counter
+        self.total_count = total_count
+        self.vectors = default_vectors() if vectors is None else vectors
+
+    def _weights(self, lowers):
+        if hasattr(self.counter, "lookup"):
+            counts = self.counter.lookup(lowers).astype(np.float64)
+        else:
+            counts = np.array([self.counter[lower] for lower in lowers], dtype=np.float64)
+        if self.total_count <= 0:
+            return np.ones(len(counts))
+        return SIF / (counts/self.total_count + SIF)
+
+    def embed_block(self, docs_ids):
+        """
+        Embeds a list of orth id arrays (as returned by digest_doc).
+        Returns a (len(docs_ids), VEC_SIZE) float32 matrix.
+        """
+        num_docs = len(docs_ids)
+        lengths = np.array([len(ids) for ids in docs_ids], dtype=np.int64)
+        embeddings = np.zeros((num_docs, VEC_SIZE), dtype=np.float32)
+        if lengths.sum() == 0:
+            return embeddings
+        all_ids = np.concatenate([ids for ids in docs_ids if len(ids) > 0]).astype(np.int64)
+        words, inverse = np.unique(all_ids, return_inverse=True)
+        lowers, vectors = self.vectors.lookup(words)
+        weights = self._weights(lowers)
+        rows = np.repeat(np.arange(num_docs), lengths)
+        matrix = sp.csr_matrix((weights[inverse], (rows, inverse)),
+                shape=(num_docs, len(words)))
+        sums = matrix.dot(vectors.astype(np.float64))
+        nonempty = lengths > 0
+        embeddings[nonempty] = sums[nonempty] / lengths[nonempty][:, np.newaxis]
+        # docs that touch a NaN vector are zeroed, like _get_embedding does
+        nan_words = np.isnan(vectors).any(axis=1)
+        has_nan = np.bincount(rows, weights=nan_words[inverse].astype(np.float64), minlength=num_docs) > 0
+        embeddings[has_nan] = 0.
+        return embeddings
+
+    def embed(self, docs_ids, block_size=BLOCK_SIZE):
+        """
+        Generates the embeddings of docs_ids block by block.
+        """
+        for start in xrange(0, len(docs_ids), block_size):
+            block = self.embed_block(docs_ids[start:start+block_size])
+            for row in block:
+                yield row
@@ -0,0 +1,138 @@
+"""
+Persistent on-disk cache of word_vecs embeddings, keyed by post/comment id.
+
+Embeddings depend on the word frequencies used for the SIF weights, so each
+cache lives in a sub-directory named after a hash of those frequencies
+(freqs_version). Changing the frequencies therefore never returns stale vectors,
+and only the most recently used versions are kept on disk.
+
+Each version directory holds vectors.f32 (raw float32 rows, memory-mapped for
+reading) and ids.txt (the id of every row, in row order).
+"""
+
+import os
+import shutil
+import fcntl
+import hashlib
+import numpy as np
+
+from redditnetwork.embedding import VEC_SIZE, SIF
+from redditnetwork.word_freqs import WordFreqs
+from redditnetwork.utils.ioutils import mkdir
+
+ROW_BYTES = 4 * VEC_SIZE
+
+def freqs_version(counter, total_count):
+    """
+    Hash of the word frequencies (and SIF parameters) an embedding was computed with.
+    counter can be a Counter/defaultdict or a WordFreqs table.
+    """
+    if not isinstance(counter, WordFreqs):
+        # same hash for the same counts, whether counted serially or merged from workers
+        counter = WordFreqs.from_counter(counter)
+    sha = hashlib.sha1()
+    sha.update("{:d} {:.10g} {:.10g}".format(VEC_SIZE, SIF, total_count))
+    word_bytes, word_offsets = counter.encoded()
+    sha.update(word_bytes.tobytes())
+    sha.update(word_offsets.tobytes())
+    sha.update(counter.counts.tobytes())
+    return sha.hexdigest()
+
+
+class EmbeddingCache():
+    """
+    Cache of embeddings for one frequency version under root.
+    Opening a version marks it as recently used and evicts all but the
+    max_versions most recently used versions.
+    """
+    def __init__(self, root, version, max_versions=4):
+        self.root = root
+        self.version = version
+        self.dir = os.path.join(root, version)
+        mkdir(self.dir)
+        self._vectors_file = os.path.join(self.dir, "vectors.f32")
+        self._ids_file = os.path.join(self.dir, "ids.txt")
+        os.utime(self.dir, None)
+        self._evict(max_versions)
+        self._matrix = None
+        self._load_ids()
+
+    def _evict(self, max_versions):
+        versions = [os.path.join(self.root, name) for name in os.listdir(self.root)]
+        versions = [name for name in versions if os.path.isdir(name)]
+        versions.sort(key=os.path.getmtime, reverse=True)
+        for stale in versions[max_versions:]:
+            if stale != self.dir:
+                shutil.rmtree(stale, ignore_errors=True)
+
+    def _load_ids(self, lock=True):
+        """
+        Reads the ids, under a shared lock unless the caller holds the exclusive one,
+        so a put_many of another process is never seen half written.
+        """
+        self._rows = {}
+        # bytes of complete lines; a crashed writer can leave a partial last line
+        self._ids_bytes = 0
+        if not os.path.exists(self._ids_file):
+            return
+        with open(self._ids_file) as fp:
+            if lock:
+                fcntl.flock(fp, fcntl.LOCK_SH)
+            try:
+                for row, line in enumerate(fp):
+                    if not line.endswith("\n"):
+                        break
+                    self._rows[line[:-1]] = row
+                    self._ids_bytes += len(line)
+            finally:
+                if lock:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def _get_matrix(self):
+        if self._matrix is None or len(self._matrix) < len(self._rows):
+            self._matrix = np.memmap(self._vectors_file, dtype=np.float32, mode="r",
+                    shape=(len(self._rows), VEC_SIZE))
+        return self._matrix
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, id):
+        return id in self._rows
+
+    def get_many(self, ids):
+        """
+        Returns a boolean mask of the ids found and a (mask.sum(), VEC_SIZE)
+        matrix with their embeddings.
+        """
+        rows = np.array([self._rows.get(id, -1) for id in ids], dtype=np.int64)
+        found = rows >= 0
+        if not found.any():
+            return found, np.zeros((0, VEC_SIZE), dtype=np.float32)
+        return found, np.array(self._get_matrix()[rows[found]])
+
+    def put_many(self, ids, vectors):
+        """
+        Appends the embeddings of ids that are not cached yet.
+        """
+        new = [i for i, id in enumerate(ids) if not id in self._rows]
+        if len(new) == 0:
+            return
+        with open(self._ids_file, "a") as ids_fp:
+            # one writer at a time; rows and ids must stay aligned
+            fcntl.flock(ids_fp, fcntl.LOCK_EX)
+            try:
+                self._load_ids(lock=False)
+                new = [i for i in new if not ids[i] in self._rows]
+                # drop any partial id or row a crashed writer may have left behind
+                ids_fp.truncate(self._ids_bytes)
+                with open(self._vectors_file, "ab") as vectors_fp:
+                    vectors_fp.truncate(len(self._rows) * ROW_BYTES)
+                    vectors_fp.write(np.asarray(vectors, dtype=np.float32)[new].tobytes())
+                for i in new:
+                    self._rows[ids[i]] = len(self._rows)
+                    ids_fp.write(ids[i] + "\n")
+            finally:
+                ids_fp.flush()
+                fcntl.flock(ids_fp, fcntl.LOCK_UN)
+        self._matrix = None
@@ -0,0 +1,226 @@
+"""
+Graph outputs for extract_network.
+
+extract_network only talks to a builder through add_node, add_edge, has_node,
+set_word_vecs and finish. NetworkXBuilder gives the original networkx DiGraph.
+ArrayGraphBuilder gives an ArrayGraph: integer node ids, one COO edge list per
+edge type and dense feature columns per node type, which takes a fraction of
+the memory and can be handed to numpy/scipy based ML code as is.
+"""
+
+import array
+import numpy as np
+import networkx as nx
+import scipy.sparse as sp
+
+from redditnetwork.embedding import VEC_SIZE
+
+NODE_TYPES = ["user", "post", "comment"]
+EDGE_TYPES = ["user_post", "user_comment", "post_comment", "comment_comment"]
+# (feature, width) in the order used for the dense feature matrices
+POST_FEATS = [("score", 1), ("time", 1), ("num_comments", 1), ("subreddit", 1),
+        ("length", 1), ("word_vecs", VEC_SIZE)]
+COMMENT_FEATS = [("score", 1), ("time", 1), ("post_time_offset", 1), ("length", 1),
+        ("subreddit", 1), ("word_vecs", VEC_SIZE)]
+NODE_FEATS = {"user" : [], "post" : POST_FEATS, "comment" : COMMENT_FEATS}
+COLUMN_DTYPES = {"score" : np.int64, "num_comments" : np.int64, "length" : np.int64,
+        "subreddit" : np.int32, "time" : np.float64, "post_time_offset" : np.float64}
+
+def graph_attributes():
+    """
+    The graph level attributes (feature schemas) of an extracted network.
+    """
+    return {"user_feats" : {},
+            "post_feats" : dict(POST_FEATS),
+            "comment_feats" : dict(COMMENT_FEATS)}
+
+
+class NetworkXBuilder():
+    """
+    Builds the networkx DiGraph returned by extract_network by default.
+    """
+    def __init__(self):
+        self.graph = nx.DiGraph(**graph_attributes())
+
+    def has_node(self, id):
+        return self.graph.has_node(id)
+
+    def add_node(self, id, **attrs):
+        self.graph.add_node(id, **attrs)
+
+    def add_edge(self, source, target, type):
+        self.graph.add_edge(source, target, type=type)
+
+    def set_word_vecs(self, ids, word_vecs):
+        for id, vecs in zip(ids, word_vecs):
+            self.graph.add_node(id, word_vecs=vecs)
+
+    def finish(self):
+        return self.graph
+
+
+class ArrayGraph():
+    """
+    Array backed network.
+    Node i has name node_names[i], type NODE_TYPES[node_types[i]] and its features
+    in row node_rows[i] of the columns in feats[type].
+    edges[edge_type] is a pair of (source, target) integer node id arrays.
+    Subreddit features are codes into subreddits.
+    """
+    def __init__(self, node_names, node_types, node_rows, edges, feats, subreddits):
+        self.node_names = node_names
+        self.node_types = node_types
+        self.node_rows = node_rows
+        self.edges = edges
+        self.feats = feats
+        self.subreddits = subreddits
+        self.graph = graph_attributes()
+
+    def number_of_nodes(self):
+        return len(self.node_types)
+
+    def nodes_of_type(self, node_type):
+        """
+        Integer ids of the nodes of one type, in feature row order.
+        """
+        return np.flatnonzero(self.node_types == NODE_TYPES.index(node_type))
+
+    def adjacency(self, edge_type, format="csr"):
+        """
+        (num nodes x num nodes) sparse adjacency matrix of one edge type.
+        """
+        sources, targets = self.edges[edge_type]
+        n = self.number_of_nodes()
+        matrix = sp.coo_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)),
+                shape=(n, n))
+        return matrix.asformat(format)
+
+    def feature_matrix(self, node_type):
+        """
+        Dense (num nodes of type x total width) float32 matrix with the
+        columns of the type's feature schema, in schema order.
+        """
+        columns = []
+        for feature, width in NODE_FEATS[node_type]:
+            column = np.asarray(self.feats[node_type][feature], dtype=np.float32)
+            columns.append(column.reshape((len(column), width)))
+        return np.hstack(columns)
+
+    def to_networkx(self):
+        """
+        Converts to the DiGraph extract_network would have returned.
+        """
+        graph = nx.DiGraph(**graph_attributes())
+        for i, name in enumerate(self.node_names):
+            node_type = NODE_TYPES[self.node_types[i]]
+            attrs = {"type" : node_type}
+            row = self.node_rows[i]
+            for feature, _ in NODE_FEATS[node_type]:
+                value = self.feats[node_type][feature][row]
+                if feature == "subreddit":
+                    value = self.subreddits[value]
+                elif feature != "word_vecs":
+                    value = value.item()
+                attrs[feature] = value
+            graph.add_node(name, **attrs)
+        for edge_type in EDGE_TYPES:
+            sources, targets = self.edges[edge_type]
+            for source, target in zip(sources, targets):
+                graph.add_edge(self.node_names[source], self.node_names[target], type=edge_type)
+        return graph
+
+    @classmethod
+    def from_networkx(cls, graph):
+        builder = ArrayGraphBuilder()
+        word_vecs = []
+        for name, attrs in graph.nodes(data=True):
+            attrs = dict(attrs)
+            if "word_vecs" in attrs:
+                word_vecs.append((name, attrs.pop("word_vecs")))
+            builder.add_node(name, **attrs)
+        for source, target, attrs in graph.edges(data=True):
+            builder.add_edge(source, target, attrs["type"])
+        builder.set_word_vecs([name for name, _ in word_vecs], [vecs for _, vecs in word_vecs])
+        return builder.finish()
+
+
+class ArrayGraphBuilder():
+    """
+    Builds an ArrayGraph without ever holding per node attribute dicts.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._names = []
+        self._types = array.array("b")
+        self._rows = array.array("l")
+        self._counts = [0] * len(NODE_TYPES)
+        self._columns = {node_type : {feature : [] for feature, _ in NODE_FEATS[node_type]
+            if feature != "word_vecs"} for node_type in NODE_TYPES}
+        self._word_vecs = {}
+        self._edges = {edge_type : (array.array("l"), array.array("l")) for edge_type in EDGE_TYPES}
+        self._subreddits = {}
+
+    def has_node(self, id):
+        return id in self._ids
+
+    def add_node(self, id, type, **attrs):
+        type_code = NODE_TYPES.index(type)
+        if "subreddit" in attrs:
+            attrs["subreddit"] = self._subreddits.setdefault(attrs["subreddit"], len(self._subreddits))
+        columns = self._columns[type]
+        if id in self._ids:
+            node = self._ids[id]
+            if self._types[node] != type_code:
+                raise ValueError("Node {} added as both {} and {}".format(
+                    id, NODE_TYPES[self._types[node]], type))
+            for feature, value in attrs.iteritems():
+                columns[feature][self._rows[node]] = value
+            return
+        self._ids[id] = len(self._names)
+        self._names.append(id)
+        self._types.append(type_code)
+        self._rows.append(self._counts[type_code])
+        self._counts[type_code] += 1
+        for feature, values in columns.iteritems():
+            values.append(attrs.get(feature, 0))
+
+    def add_edge(self, source, target, type):
+        sources, targets = self._edges[type]
+        sources.append(self._ids[source])
+        targets.append(self._ids[target])
+
+    def set_word_vecs(self, ids, word_vecs):
+        # may be called several times, as blocks of nodes get embedded
+        for id, vecs in zip(ids, word_vecs):
+            node = self._ids[id]
+            node_type = NODE_TYPES[self._types[node]]
+            matrix = self._word_vecs.get(node_type, np.zeros((0, VEC_SIZE), dtype=np.float32))
+            count = self._counts[self._types[node]]
+            if len(matrix) < count:
+                grown = np.zeros((max(count, 2*len(matrix)), VEC_SIZE), dtype=np.float32)
+                grown[:len(matrix)] = matrix
+                matrix = grown
+                self._word_vecs[node_type] = matrix
+            matrix[self._rows[node]] = vecs
+
+    def finish(self):
+        feats = {}
+        for node_type in NODE_TYPES:
+            feats[node_type] = {feature : np.array(values, dtype=COLUMN_DTYPES[feature])
+                    for feature, values in self._columns[node_type].iteritems()}
+            if any(feature == "word_vecs" for feature, _ in NODE_FEATS[node_type]):
+                count = self._counts[NODE_TYPES.index(node_type)]
+                word_vecs = np.zeros((count, VEC_SIZE), dtype=np.float32)
+                if node_type in self._word_vecs:
+                    filled = min(count, len(self._word_vecs[node_type]))
+                    word_vecs[:filled] = self._word_vecs[node_type][:filled]
+                feats[node_type]["word_vecs"] = word_vecs
+        edges = {edge_type : (np.frombuffer(sources, dtype=np.int_).astype(np.int64),
+            np.frombuffer(targets, dtype=np.int_).astype(np.int64))
+            for edge_type, (sources, targets) in self._edges.iteritems()}
+        subreddits = sorted(self._subreddits, key=self._subreddits.get)
+        return ArrayGraph(self._names, np.frombuffer(self._types, dtype=np.int8).copy(),
+                np.frombuffer(self._rows, dtype=np.int_).astype(np.int64),
+                edges, feats, subreddits)
+
+BUILDERS = {"networkx" : NetworkXBuilder, "arrays" : ArrayGraphBuilder}
@@ -0,0 +1,209 @@
+"""
+Streaming graph output: a graph builder for extract_network that writes nodes,
+edges and features to disk in chunks instead of holding the graph in memory,
+and a loader that memory-maps the result as an ArrayGraph.
+
+Layout of an output directory:
+    node_names.txt                 one node name per line, in integer id order
+    node_types.i8, node_rows.i64   type code and feature row of every node
+    edges_<edge type>.i64          (source, target) integer id pairs
+    <node type>_<feature>.<dtype>  one raw column file per scalar feature
+    <node type>_word_vecs.f32      (rows, VEC_SIZE) float32 word vectors
+    subreddits.txt                 the subreddit of every subreddit code
+    meta.json                      node counts per type
+Only the node name -> id map (needed to resolve edges) and one chunk of
+buffered records are kept in memory.
+"""
+
+import os
+import json
+import numpy as np
+
+from redditnetwork.embedding import VEC_SIZE
+from redditnetwork.graph_builders import (NODE_TYPES, EDGE_TYPES, NODE_FEATS,
+        COLUMN_DTYPES, ArrayGraph)
+from redditnetwork.utils.ioutils import mkdir
+
+CHUNK_SIZE = 100000
+
+def _column_file(directory, node_type, feature):
+    return os.path.join(directory, "{}_{}.{}".format(node_type, feature,
+        np.dtype(COLUMN_DTYPES[feature]).str.lstrip("<>|=")))
+
+def _word_vecs_file(directory, node_type):
+    return os.path.join(directory, "{}_word_vecs.f32".format(node_type))
+
+
+class _ChunkedFile():
+    """
+    Append-only raw array file with an in-memory buffer of up to chunk_size values.
+    Values already flushed can be overwritten in place.
+    """
+    def __init__(self, filename, dtype, chunk_size):
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.flushed = 0
+        self._buffer = []
+        open(filename, "wb").close()
+
+    def append(self, value):
+        self._buffer.append(value)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def __len__(self):
+        return self.flushed + len(self._buffer)
+
+    def set(self, index, value):
+        if index >= self.flushed:
+            self._buffer[index - self.flushed] = value
+        else:
+            with open(self.filename, "r+b") as fp:
+                fp.seek(index * self.dtype.itemsize)
+                fp.write(np.array([value], dtype=self.dtype).tobytes())
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            with open(self.filename, "ab") as fp:
+                fp.write(np.array(self._buffer, dtype=self.dtype).tobytes())
+            self.flushed += len(self._buffer)
+            self._buffer = []
+
+
+class StreamingGraphWriter():
+    """
+    Graph builder (see graph_builders) that streams the network to directory.
+    Pass it as extract_network(..., output=StreamingGraphWriter(directory)); together
+    with word_freqs (so that word_vecs can be written as nodes are added) memory stays
+    bounded. finish() returns the memory-mapped ArrayGraph.
+    """
+    def __init__(self, directory, chunk_size=CHUNK_SIZE):
+        mkdir(directory)
+        self.directory = directory
+        self._ids = {}
+        self._counts = [0] * len(NODE_TYPES)
+        self._subreddits = {}
+        self._names = open(os.path.join(directory, "node_names.txt"), "w")
+        self._types = _ChunkedFile(os.path.join(directory, "node_types.i8"), np.int8, chunk_size)
+        self._rows = _ChunkedFile(os.path.join(directory, "node_rows.i64"), np.int64, chunk_size)
+        self._edges = {edge_type : _ChunkedFile(
+            os.path.join(directory, "edges_{}.i64".format(edge_type)), np.int64, 2*chunk_size)
+            for edge_type in EDGE_TYPES}
+        self._columns = {node_type : {feature : _ChunkedFile(
+            _column_file(directory, node_type, feature), COLUMN_DTYPES[feature], chunk_size)
+            for feature, _ in NODE_FEATS[node_type] if feature != "word_vecs"}
+            for node_type in NODE_TYPES}
+        self._word_vecs = {}
+        for node_type in NODE_TYPES:
+            if any(feature == "word_vecs" for feature, _ in NODE_FEATS[node_type]):
+                open(_word_vecs_file(directory, node_type), "wb").close()
+                self._word_vecs[node_type] = None
+
+    def has_node(self, id):
+        return id in self._ids
+
+    def add_node(self, id, type, **attrs):
+        type_code = NODE_TYPES.index(type)
+        if "subreddit" in attrs:
+            attrs["subreddit"] = self._subreddits.setdefault(attrs["subreddit"], len(self._subreddits))
+        columns = self._columns[type]
+        if id in self._ids:
+            node, node_type_code, row = self._ids[id]
+            if node_type_code != type_code:
+                raise ValueError("Node {} added as both {} and {}".format(
+                    id, NODE_TYPES[node_type_code], type))
+            for feature, value in attrs.iteritems():
+                columns[feature].set(row, value)
+            return
+        row = self._counts[type_code]
+        self._ids[id] = (len(self._ids), type_code, row)
+        self._counts[type_code] += 1
+        self._names.write(id.encode("utf-8") if isinstance(id, unicode) else id)
+        self._names.write("\n")
+        self._types.append(type_code)
+        self._rows.append(row)
+        for feature, values in columns.iteritems():
+            values.append(attrs.get(feature, 0))
+
+    def add_edge(self, source, target, type):
+        edges = self._edges[type]
+        edges.append(self._ids[source][0])
+        edges.append(self._ids[target][0])
+
+    def set_word_vecs(self, ids, word_vecs):
+        """
+        Writes word_vecs rows in place; the files grow to the number of nodes added so far.
+        """
+        by_type = {}
+        for id, vecs in zip(ids, word_vecs):
+            _, type_code, row = self._ids[id]
+            by_type.setdefault(NODE_TYPES[type_code], []).append((row, vecs))
+        for node_type, entries in by_type.iteritems():
+            filename = _word_vecs_file(self.directory, node_type)
+            count = self._counts[NODE_TYPES.index(node_type)]
+            if os.path.getsize(filename) < count * VEC_SIZE * 4:
+                with open(filename, "r+b") as fp:
+                    fp.truncate(count * VEC_SIZE * 4)
+            matrix = np.memmap(filename, dtype=np.float32, mode="r+", shape=(count, VEC_SIZE))
+            for row, vecs in entries:
+                matrix[row] = vecs
+            matrix.flush()
+            del matrix
+
+    def finish(self):
+        self._names.close()
+        for chunked in [self._types, self._rows] + self._edges.values() + \
+                [column for columns in self._columns.values() for column in columns.values()]:
+            chunked.flush()
+        for node_type in self._word_vecs:
+            filename = _word_vecs_file(self.directory, node_type)
+            count = self._counts[NODE_TYPES.index(node_type)]
+            # nodes that never got word_vecs keep zero rows
+            with open(filename, "r+b") as fp:
+                fp.truncate(count * VEC_SIZE * 4)
+        with open(os.path.join(self.directory, "subreddits.txt"), "w") as fp:
+            for subreddit in sorted(self._subreddits, key=self._subreddits.get):
+                fp.write(subreddit + "\n")
+        with open(os.path.join(self.directory, "meta.json"), "w") as fp:
+            json.dump({"counts" : dict(zip(NODE_TYPES, self._counts)),
+                "vec_size" : VEC_SIZE}, fp)
+        self._ids = None
+        return load_graph(self.directory)
+
+
+def _memmap(filename, dtype, shape):
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r", shape=shape)
+
+def load_graph(directory):
+    """
+    Memory-maps a network written by StreamingGraphWriter as an ArrayGraph.
+    """
+    with open(os.path.join(directory, "meta.json")) as fp:
+        counts = json.load(fp)["counts"]
+    with open(os.path.join(directory, "node_names.txt")) as fp:
+        node_names = [line.rstrip("\n").decode("utf-8") for line in fp]
+    with open(os.path.join(directory, "subreddits.txt")) as fp:
+        subreddits = [line.rstrip("\n") for line in fp]
+    num_nodes = len(node_names)
+    node_types = _memmap(os.path.join(directory, "node_types.i8"), np.int8, (num_nodes,))
+    node_rows = _memmap(os.path.join(directory, "node_rows.i64"), np.int64, (num_nodes,))
+    edges = {}
+    for edge_type in EDGE_TYPES:
+        filename = os.path.join(directory, "edges_{}.i64".format(edge_type))
+        pairs = _memmap(filename, np.int64, (os.path.getsize(filename) / 16, 2))
+        edges[edge_type] = (pairs[:,0], pairs[:,1])
+    feats = {}
+    for node_type in NODE_TYPES:
+        count = counts[node_type]
+        feats[node_type] = {}
+        for feature, _ in NODE_FEATS[node_type]:
+            if feature == "word_vecs":
+                feats[node_type][feature] = _memmap(_word_vecs_file(directory, node_type),
+                        np.float32, (count, VEC_SIZE))
+            else:
+                feats[node_type][feature] = _memmap(_column_file(directory, node_type, feature),
+                        COLUMN_DTYPES[feature], (count,))
+    return ArrayGraph(node_names, node_types, node_rows, edges, feats, subreddits)
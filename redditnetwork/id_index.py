@@ -0,0 +1,245 @@
+"""
+Corpus wide index from comment/post id to where the record lives, stored under
+DATA_HOME/id_index/.
+
+For every record of the monthly spacy_comments/ and spacy_posts/ files it keeps
+the id, the file (subreddit-month) and the record number within that file, so
+single comments or posts can be fetched by id (through the files' record indexes)
+without reading the month they are in. Comment and post ids are separate
+namespaces and are looked up separately.
+
+Each kind is a set of plain .npy arrays sorted by id, opened memory-mapped, so a
+lookup only touches the pages its binary searches land on. build_id_index sorts
+the ids in shards of SHARD_RECORDS and merges the shards on disk, so it never holds
+more than a shard in memory. Rebuild it whenever the corpus changes.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+from collections import defaultdict
+
+from redditnetwork import constants
+from redditnetwork.corpus_reader import SpacyComments, PostIterator, filter_reason
+from redditnetwork.manifest import info_names
+from redditnetwork.block_compression import open_corpus_file
+from redditnetwork.utils.arrayutils import sorted_lookup
+
+ID_INDEX_DIR = "id_index"
+# kind -> (record directory, reader class, function returning the id of an info line)
+KINDS = {"comments" : ("spacy_comments", SpacyComments, lambda line : line.split("\t", 1)[0]),
+        "posts" : ("spacy_posts", PostIterator, lambda line : str(json.loads(line)["id"]))}
+# sorted arrays per kind, the files (period/subreddit) are indexed by file_numbers
+COLUMNS = ["ids", "file_numbers", "positions"]
+# ids sorted in memory at once while building
+SHARD_RECORDS = 20000000
+# ids held in memory at once while merging the shards
+MERGE_RECORDS = 2000000
+
+def _monthly_files(kind_dir):
+    """
+    Generates (period, subreddit) for the monthly .info files under kind_dir.
+    The yearly files repeat the monthly records and are left out.
+    """
+    for period in sorted(os.listdir(kind_dir)):
+        if not "_" in period or not os.path.isdir(os.path.join(kind_dir, period)):
+            continue
+        for subreddit in info_names(os.path.join(kind_dir, period)):
+            yield period, subreddit
+
+def _column_file(directory, prefix, column):
+    return os.path.join(directory, "{}_{}.npy".format(prefix, column))
+
+def _write_shard(directory, prefix, ids, file_numbers, positions):
+    ids = np.concatenate(ids)
+    order = np.argsort(ids, kind="mergesort")
+    for column, values in zip(COLUMNS, [ids, np.concatenate(file_numbers),
+            np.concatenate(positions)]):
+        np.save(_column_file(directory, prefix, column), values[order])
+
+def _load_columns(directory, prefix):
+    return [np.load(_column_file(directory, prefix, column), mmap_mode="r") for column in COLUMNS]
+
+def _merge_shards(shards, directory, prefix):
+    """
+    Merges sorted shards (lists of column arrays) into the sorted columns
+    directory/prefix_*.npy, MERGE_RECORDS ids at a time.
+    """
+    total = sum(len(shard[0]) for shard in shards)
+    width = max([shard[0].dtype.itemsize for shard in shards] + [1])
+    dtypes = ["S{:d}".format(width), np.int32, np.int64]
+    if total == 0:
+        for column, dtype in zip(COLUMNS, dtypes):
+            np.save(_column_file(directory, prefix, column), np.zeros(0, dtype=dtype))
+        return
+    outputs = [np.lib.format.open_memmap(_column_file(directory, prefix, column), mode="w+",
+        dtype=dtype, shape=(total,)) for column, dtype in zip(COLUMNS, dtypes)]
+    starts = [0] * len(shards)
+    step = max(1, MERGE_RECORDS / max(1, len(shards)))
+    written = 0
+    while written < total:
+        stops = [min(start + step, len(shard[0])) for start, shard in zip(starts, shards)]
+        # everything up to the smallest last id of the shards that continue past
+        # their chunk can be written; the shard giving it contributes its whole chunk
+        cutoffs = [shard[0][stop - 1] for shard, start, stop in zip(shards, starts, stops)
+                if stop < len(shard[0])]
+        if len(cutoffs) > 0:
+            cutoff = min(cutoffs)
+            stops = [start + np.searchsorted(shard[0][start:stop], cutoff, side="right")
+                    for shard, start, stop in zip(shards, starts, stops)]
+        columns = [np.concatenate([np.asarray(shard[column][start:stop]) for shard, start, stop
+            in zip(shards, starts, stops)]).astype(dtype) for column, dtype in enumerate(dtypes)]
+        order = np.argsort(columns[0], kind="mergesort")
+        for output, values in zip(outputs, columns):
+            output[written:written + len(order)] = values[order]
+        written += len(order)
+        starts = stops
+    for output in outputs:
+        output.flush()
+
+def build_id_index(data_home=None):
+    """
+    Scans the .info files of the corpus under data_home (default: constants.DATA_HOME)
+    once and writes the index; returns it.
+    """
+    data_home = constants.DATA_HOME if data_home is None else data_home
+    directory = os.path.join(data_home, ID_INDEX_DIR)
+    build_dir = directory + ".tmp"
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+    for kind, (record_dir, _, id_func) in KINDS.iteritems():
+        kind_dir = os.path.join(data_home, record_dir)
+        files = []
+        buffers = ([], [], [])
+        num_buffered = 0
+        shards = []
+        if os.path.isdir(kind_dir):
+            for period, subreddit in _monthly_files(kind_dir):
+                with open_corpus_file(os.path.join(kind_dir, period, subreddit + ".info")) as fp:
+                    ids = np.array([id_func(line) for line in fp], dtype=np.string_)
+                buffers[0].append(ids)
+                buffers[1].append(np.repeat(np.int32(len(files)), len(ids)))
+                buffers[2].append(np.arange(len(ids), dtype=np.int64))
+                num_buffered += len(ids)
+                files.append("{}/{}".format(period, subreddit))
+                if num_buffered >= SHARD_RECORDS:
+                    shards.append("{}_shard{:d}".format(kind, len(shards)))
+                    _write_shard(build_dir, shards[-1], *buffers)
+                    buffers = ([], [], [])
+                    num_buffered = 0
+        if num_buffered > 0:
+            shards.append("{}_shard{:d}".format(kind, len(shards)))
+            _write_shard(build_dir, shards[-1], *buffers)
+        _merge_shards([_load_columns(build_dir, shard) for shard in shards], build_dir, kind)
+        for shard in shards:
+            for column in COLUMNS:
+                os.remove(_column_file(build_dir, shard, column))
+        np.save(os.path.join(build_dir, kind + "_files.npy"), np.array(files, dtype=np.string_))
+    # swap the new index in; readers of the old one keep their open memory maps
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(build_dir, directory)
+    reset_id_index()
+    return IdIndex.load(data_home)
+
+
+class _IdTable():
+    """
+    The ids of one kind sorted, with the file number and record number of each.
+    """
+    def __init__(self, ids, file_numbers, positions, files):
+        self.ids = ids
+        self.file_numbers = file_numbers
+        self.positions = positions
+        self.files = files
+
+    def lookup(self, ids):
+        """
+        Rows of the given ids in the table, -1 for unknown ids.
+        """
+        return sorted_lookup(self.ids, np.asarray(ids, dtype=np.string_))
+
+
+class IdIndex():
+    """
+    The id index of one corpus; tables maps "comments" and "posts" to their _IdTable.
+    """
+    def __init__(self, data_home, tables):
+        self.data_home = data_home
+        self.tables = tables
+
+    @classmethod
+    def load(cls, data_home=None):
+        data_home = constants.DATA_HOME if data_home is None else data_home
+        directory = os.path.join(data_home, ID_INDEX_DIR)
+        tables = {}
+        for kind in KINDS:
+            columns = _load_columns(directory, kind)
+            files = np.load(os.path.join(directory, kind + "_files.npy"))
+            tables[kind] = _IdTable(*(columns + [files]))
+        return cls(data_home, tables)
+
+    def __len__(self):
+        return sum(len(table.ids) for table in self.tables.itervalues())
+
+    def locate(self, kind, ids):
+        """
+        Returns a dict from id to (subreddit, year, month, record number) for the
+        ids of kind ("comments" or "posts") that are in the corpus.
+        """
+        table = self.tables[kind]
+        ids = list(ids)
+        locations = {}
+        for id, row in zip(ids, table.lookup(ids)):
+            if row < 0:
+                continue
+            period, subreddit = table.files[table.file_numbers[row]].split("/", 1)
+            year, month = period.split("_")
+            locations[id] = (subreddit, int(year), int(month), int(table.positions[row]))
+        return locations
+
+    def fetch(self, kind, ids, clean_deleted=True, clean_bots=True):
+        """
+        Reads the records of kind with the given ids, each month's through its
+        record index, and returns a dict from id to record. Ids that are not in
+        the corpus, or whose records are filtered out, are left out.
+        """
+        directory, reader_cls, _ = KINDS[kind]
+        by_file = defaultdict(list)
+        for subreddit, year, month, position in self.locate(kind, ids).itervalues():
+            by_file[(subreddit, year, month)].append(position)
+        records = {}
+        for (subreddit, year, month), positions in sorted(by_file.iteritems()):
+            reader = reader_cls(subreddit, year, month,
+                    path=os.path.join(self.data_home, directory, ""))
+            for record in reader.iter_records(sorted(positions)):
+                if filter_reason(record, clean_deleted, clean_bots) is None:
+                    records[record["id"]] = record
+        return records
+
+_ID_INDEX = None
+_ID_INDEX_HOME = None
+
+def get_id_index():
+    """
+    The id index of constants.DATA_HOME, loaded on first use (also when
+    DATA_HOME changes); None if the corpus has no id index.
+    """
+    global _ID_INDEX, _ID_INDEX_HOME
+    if _ID_INDEX_HOME != constants.DATA_HOME:
+        _ID_INDEX_HOME = constants.DATA_HOME
+        try:
+            _ID_INDEX = IdIndex.load()
+        except IOError:
+            _ID_INDEX = None
+    return _ID_INDEX
+
+def reset_id_index():
+    """
+    Forgets the loaded id index, e.g. after build_id_index.
+    """
+    global _ID_INDEX_HOME
+    _ID_INDEX_HOME = None
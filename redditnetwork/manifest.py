@@ -0,0 +1,200 @@
+"""
+Catalog of the corpus files, built once and stored as DATA_HOME/manifest.json.
+
+Every .info/.bin pair under spacy_comments/ and spacy_posts/ gets an entry keyed
+by its path relative to DATA_HOME without suffix (e.g. "spacy_comments/2014_03/AskReddit"),
+with its record count, byte sizes and [start, end] timestamp range. Listings,
+iterator lengths, valid_subreddits and existence checks are answered from it
+without touching the (network) file system; without a manifest they fall back
+to listing and scanning the files. Rebuild it with build_manifest whenever the
+corpus changes.
+"""
+
+import os
+import json
+import time
+
+from redditnetwork import constants
+from redditnetwork.utils.ioutils import load_json
+from redditnetwork.block_compression import COMPRESSED_SUFFIX, corpus_filename, open_corpus_file
+
+MANIFEST_FILE = "manifest.json"
+# record directory -> (data file suffix, function returning the timestamp of an info line)
+KINDS = {"spacy_comments" : (".bin", lambda line : int(line.split("\t", 2)[1])),
+        "spacy_posts" : (".title.bin", lambda line : int(json.loads(line)["timestamp"]))}
+
+def _scan_info(filename, timestamp_func):
+    count = 0
+    start = end = None
+    with open_corpus_file(filename) as fp:
+        for line in fp:
+            count += 1
+            timestamp = timestamp_func(line)
+            start = timestamp if start is None else min(start, timestamp)
+            end = timestamp if end is None else max(end, timestamp)
+    return count, start, end
+
+def info_names(directory):
+    """
+    Sorted names of the record files in directory, from their plain or compressed .info files.
+    """
+    names = set()
+    for name in os.listdir(directory):
+        if name.endswith(".info" + COMPRESSED_SUFFIX):
+            name = name[:-len(COMPRESSED_SUFFIX)]
+        if name.endswith(".info"):
+            names.add(name[:-len(".info")])
+    return sorted(names)
+
+def build_manifest(data_home=None, save=True):
+    """
+    Scans the corpus under data_home (default: constants.DATA_HOME) once.
+    """
+    data_home = constants.DATA_HOME if data_home is None else data_home
+    entries = {}
+    for kind, (bin_suffix, timestamp_func) in KINDS.iteritems():
+        kind_dir = os.path.join(data_home, kind)
+        if not os.path.isdir(kind_dir):
+            continue
+        for period in sorted(os.listdir(kind_dir)):
+            period_dir = os.path.join(kind_dir, period)
+            if not os.path.isdir(period_dir):
+                continue
+            for subreddit in info_names(period_dir):
+                prefix = os.path.join(period_dir, subreddit)
+                count, start, end = _scan_info(prefix + ".info", timestamp_func)
+                bin_file = corpus_filename(prefix + bin_suffix)
+                # sizes on disk, i.e. compressed for compressed files
+                entries["{}/{}/{}".format(kind, period, subreddit)] = {
+                        "records" : count, "start" : start, "end" : end,
+                        "info_bytes" : os.path.getsize(corpus_filename(prefix + ".info")),
+                        "bin_bytes" : None if bin_file is None else os.path.getsize(bin_file)}
+    valid = None
+    counts_file = os.path.join(data_home, "total_comment_counts.tsv")
+    if os.path.exists(counts_file):
+        with open(counts_file) as fp:
+            valid = [line.split("\t")[0] for line in fp]
+    manifest = Manifest(data_home, entries, valid, time.time())
+    if save:
+        manifest.save()
+        reset_manifest()
+    return manifest
+
+
+class Manifest():
+    """
+    The catalog of one corpus. entries maps relative paths to their metadata.
+    """
+    def __init__(self, data_home, entries, valid_subreddits=None, built=None):
+        self.data_home = data_home
+        self.entries = entries
+        self.valid_subreddits = valid_subreddits
+        self.built = built
+
+    @classmethod
+    def load(cls, data_home=None):
+        data_home = constants.DATA_HOME if data_home is None else data_home
+        data = load_json(os.path.join(data_home, MANIFEST_FILE))
+        # json gives unicode; paths and subreddit names are byte strings everywhere else
+        entries = {str(key) : entry for key, entry in data["entries"].iteritems()}
+        valid = data["valid_subreddits"]
+        if not valid is None:
+            valid = [str(subreddit) for subreddit in valid]
+        return cls(data_home, entries, valid, data["built"])
+
+    def save(self):
+        filename = os.path.join(self.data_home, MANIFEST_FILE)
+        with open(filename + ".tmp", "w") as fp:
+            json.dump({"entries" : self.entries, "valid_subreddits" : self.valid_subreddits,
+                "built" : self.built}, fp, sort_keys=True)
+        os.rename(filename + ".tmp", filename)
+
+    def _key(self, path):
+        data_home = os.path.join(self.data_home, "")
+        if not path.startswith(data_home):
+            return None
+        return path[len(data_home):]
+
+    def entry(self, path):
+        """
+        Metadata of the files at path (an iterator's path attribute), or None
+        if path is outside the corpus or not in it.
+        """
+        key = self._key(path)
+        return None if key is None else self.entries.get(key)
+
+    def covers(self, path):
+        """
+        True if the manifest can tell whether path exists.
+        """
+        key = self._key(path)
+        return not key is None and key.split("/", 1)[0] in KINDS
+
+    def exists(self, kind, subreddit, year, month=None):
+        return self._period_key(kind, subreddit, year, month) in self.entries
+
+    def _period_key(self, kind, subreddit, year, month=None):
+        period = "{:d}".format(year) if month is None else "{:d}_{:02d}".format(year, month)
+        return "{}/{}/{}".format(kind, period, subreddit)
+
+    def record_count(self, kind, subreddit, year, month=None):
+        entry = self.entries.get(self._period_key(kind, subreddit, year, month))
+        return 0 if entry is None else entry["records"]
+
+    def periods(self, kind="spacy_comments"):
+        return sorted(set(key.split("/")[1] for key in self.entries if key.startswith(kind + "/")))
+
+    def subreddits(self, kind="spacy_comments", period=None):
+        """
+        Subreddits with files of kind, in one period ("2014", "2014_03") or any.
+        """
+        subreddits = set()
+        for key in self.entries:
+            entry_kind, entry_period, subreddit = key.split("/", 2)
+            if entry_kind == kind and (period is None or entry_period == str(period)):
+                subreddits.add(subreddit)
+        return subreddits
+
+_MANIFEST = None
+_MANIFEST_HOME = None
+
+def get_manifest():
+    """
+    The manifest of constants.DATA_HOME, loaded on first use (also when
+    DATA_HOME changes); None if the corpus has no manifest.
+    """
+    global _MANIFEST, _MANIFEST_HOME
+    if _MANIFEST_HOME != constants.DATA_HOME:
+        _MANIFEST_HOME = constants.DATA_HOME
+        try:
+            _MANIFEST = Manifest.load()
+        except IOError:
+            _MANIFEST = None
+    return _MANIFEST
+
+def reset_manifest():
+    """
+    Forgets the loaded manifest, e.g. after build_manifest.
+    """
+    global _MANIFEST_HOME
+    _MANIFEST_HOME = None
+
+def manifest_len(path):
+    """
+    Number of records of the files at path according to the manifest, or None.
+    """
+    manifest = get_manifest()
+    if manifest is None:
+        return None
+    entry = manifest.entry(path)
+    return None if entry is None else entry["records"]
+
+def path_exists(path):
+    """
+    Whether the .info file of an iterator path exists, answered from the
+    manifest when it covers path.
+    """
+    manifest = get_manifest()
+    if not manifest is None and manifest.covers(path):
+        return not manifest.entry(path) is None
+    return not corpus_filename(path + ".info") is None
@@ -0,0 +1,147 @@
+"""
+Columnar access to comment and post metadata.
+
+Loads whole .info files into pandas DataFrames instead of building one dict per line.
+String columns (id, author, parent, post, subreddit) are stored as categoricals,
+so every distinct string is held once and the cleaning filters only have to look
+at each distinct author once.
+"""
+
+import csv
+import numpy as np
+import pandas as pd
+
+from redditnetwork import corpus_reader
+from redditnetwork.corpus_reader import InfoIterator, PostIterator
+from redditnetwork.block_compression import open_corpus_file
+from redditnetwork.utils.stringutils import is_bot
+
+COMMENT_COLUMNS = ["id", "timestamp", "author", "score", "parent", "post"]
+COMMENT_DTYPES = {"id" : str, "timestamp" : np.int64, "author" : str,
+        "score" : np.int64, "parent" : str, "post" : str}
+# the post fields every .info line has (and an empty file gives)
+POST_COLUMNS = ["id", "timestamp", "author", "score", "num_comments"]
+POST_DTYPES = {"id" : str, "timestamp" : np.int64, "author" : str,
+        "score" : np.int64, "num_comments" : np.int64}
+STRING_COLUMNS = ["id", "author", "parent", "post", "subreddit"]
+
+def _categorical_mask(column, func):
+    """
+    Evaluates func once per category and broadcasts the result to the rows.
+    """
+    categories = column.cat.categories
+    flags = np.array([func(value) for value in categories], dtype=bool)
+    codes = column.cat.codes.values
+    # missing values have code -1 and are never flagged
+    return np.where(codes >= 0, flags[codes] if len(flags) > 0 else False, False)
+
+def filter_masks(frame):
+    """
+    Boolean masks for the rows that the iterators would drop.
+    Returns a dict with "deleted", "bot" and "filtered" masks.
+    """
+    filtered_users = corpus_reader.get_filtered_users()
+    author = frame["author"]
+    return {"deleted" : (author == "[deleted]").values,
+            "bot" : _categorical_mask(author, is_bot),
+            "filtered" : _categorical_mask(author, lambda name : name in filtered_users)}
+
+def clean_frame(frame, clean_deleted=True, clean_bots=True):
+    """
+    Drops the rows that InfoIterator/PostIterator would skip with the same arguments.
+    """
+    masks = filter_masks(frame)
+    drop = np.zeros(len(frame), dtype=bool)
+    if clean_deleted:
+        drop |= masks["deleted"]
+    if clean_bots:
+        drop |= masks["bot"] | masks["filtered"]
+    return frame[~drop].reset_index(drop=True)
+
+def _intern(frame):
+    for column in STRING_COLUMNS:
+        if column in frame:
+            frame[column] = frame[column].astype("category")
+    return frame
+
+def _is_empty(fp):
+    empty = len(fp.read(1)) == 0
+    fp.seek(0)
+    return empty
+
+def _empty_frame(columns, dtypes):
+    """
+    A frame without rows, with the columns and dtypes a non-empty file gives.
+    """
+    return pd.DataFrame({column : pd.Series([], dtype=object if dtypes[column] is str
+        else dtypes[column]) for column in columns}, columns=columns)
+
+def load_comment_info(subreddit, year, month=None, path=None,
+        clean_deleted=True, clean_bots=True):
+    """
+    Loads the comment metadata of one subreddit-month (or year) as a DataFrame
+    with the same fields as InfoIterator records, plus the subreddit.
+    """
+    info_path = InfoIterator(subreddit, year, month, path=path).path + ".info"
+    with open_corpus_file(info_path) as fp:
+        if _is_empty(fp):
+            frame = _empty_frame(COMMENT_COLUMNS, COMMENT_DTYPES)
+        else:
+            frame = pd.read_csv(fp, sep="\t", header=None, names=COMMENT_COLUMNS,
+                    dtype=COMMENT_DTYPES, quoting=csv.QUOTE_NONE, na_filter=False, engine="c")
+    frame["post"] = frame["post"].str.strip()
+    frame["subreddit"] = subreddit
+    frame = _intern(frame)
+    return clean_frame(frame, clean_deleted, clean_bots)
+
+def load_post_info(subreddit, year, month, path=None,
+        clean_deleted=True, clean_bots=True):
+    """
+    Loads the post metadata of one subreddit-month as a DataFrame.
+    """
+    info_path = PostIterator(subreddit, year, month, path=path).path + ".info"
+    with open_corpus_file(info_path) as fp:
+        if _is_empty(fp):
+            frame = _empty_frame(POST_COLUMNS, POST_DTYPES)
+        else:
+            frame = pd.read_json(fp, lines=True, convert_dates=False, dtype=False)
+    frame["timestamp"] = frame["timestamp"].astype(np.int64)
+    frame["subreddit"] = subreddit
+    frame = _intern(frame)
+    return clean_frame(frame, clean_deleted, clean_bots)
+
+def _load_many(load_func, subreddits, year, months, **kw_args):
+    frames = [load_func(subreddit, year, month, **kw_args)
+            for subreddit in subreddits for month in months]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    # concatenating categoricals with different categories gives object columns
+    frame = pd.concat(frames, ignore_index=True)
+    return _intern(frame)
+
+def load_comment_info_many(subreddits, year, months=range(1,13), **kw_args):
+    """
+    Loads and concatenates comment metadata for every subreddit/month pair.
+    """
+    return _load_many(load_comment_info, subreddits, year, months, **kw_args)
+
+def load_post_info_many(subreddits, year, months=range(1,13), **kw_args):
+    """
+    Loads and concatenates post metadata for every subreddit/month pair.
+    """
+    return _load_many(load_post_info, subreddits, year, months, **kw_args)
+
+def as_arrays(frame):
+    """
+    Converts a metadata frame into a dict of NumPy arrays.
+    Categorical columns become integer codes, with their distinct values
+    stored under "<column>_values".
+    """
+    arrays = {}
+    for column in frame.columns:
+        if str(frame[column].dtype) == "category":
+            arrays[column] = frame[column].cat.codes.values
+            arrays[column + "_values"] = np.asarray(frame[column].cat.categories)
+        else:
+            arrays[column] = frame[column].values
+    return arrays
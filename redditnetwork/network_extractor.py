@@ -1,77 +1,173 @@
-import networkx as nx
+import time
 import numpy as np
+import multiprocessing
 
-from collections import Counter, defaultdict
+from collections import defaultdict, Counter
 
-from redditnetwork.corpus_reader import PostMap, WeekIterWrapper, SpacyComments, MultiIterWrapper
+from redditnetwork import constants
+from redditnetwork.corpus_reader import PostMap, PostIterator, WeekIterWrapper, SpacyComments, MultiIterWrapper, \
+        LazyRecord, decode_doc
 from redditnetwork.utils.dateutils import get_week_timestamp
+from redditnetwork.word_freqs import WordFreqs, get_word_freqs
+from redditnetwork.embedding import VEC_SIZE, SIF, BLOCK_SIZE, LowerCounts, SIFEmbedder, digest_doc
+from redditnetwork.embedding_cache import EmbeddingCache, freqs_version
+from redditnetwork.graph_builders import BUILDERS
+from redditnetwork.stats import ExtractionStats
+from redditnetwork.compiled_corpus import CompiledComments, CompiledPosts, compiled_word_freqs
+from redditnetwork.id_index import get_id_index
 
-VEC_SIZE=300
-SIF=10e-4
-
-def extract_month_network_multisubreddits(subreddits, year, month):
+def extract_month_network_multisubreddits(subreddits, year, month, precomputed_freqs=False,
+        processes=None, **kw_args):
     """
     Extracts a multilayer network of users comments and posts for
     multiple subreddits from the specified month.
+    With precomputed_freqs the word frequencies are read from the persisted
+    per subreddit-month tables instead of being counted (same values).
+    With processes the subreddits are read, decoded (and, with precomputed_freqs,
+    embedded) in a pool of that many worker processes; the result is the same.
+    Pass stats=ExtractionStats() to collect timings and counts (see stats),
+    down_sample=... to extract from a sample of the comments (see SpacyComments), and
+    prefetch=<records> to read the comment files ahead in a background thread
+    (see MultiIterWrapper; not used with processes or compiled files).
     """
+    stats = kw_args.get("stats")
+    down_sample = kw_args.pop("down_sample", None)
+    prefetch = kw_args.pop("prefetch", 0)
+    if precomputed_freqs:
+        kw_args["word_freqs"] = _timed_call(stats, "idf", get_word_freqs, subreddits, year, [month])
+    if processes:
+        return _extract_parallel([("month", subreddit, year, month) for subreddit in subreddits],
+                0, processes, down_sample=down_sample, **kw_args)
     post_map = {}
     for subreddit in subreddits:
-        post_map.update(PostMap(subreddit, year, month).post_map)
-    comment_iter = MultiIterWrapper([SpacyComments(subreddit, year, month) for
-        subreddit in subreddits])
-    return extract_network(post_map, comment_iter, 0)
+        post_map.update(PostMap(subreddit, year, month, stats=stats).post_map)
+    comment_iter = MultiIterWrapper([SpacyComments(subreddit, year, month, stats=stats,
+        down_sample=down_sample) for subreddit in subreddits], prefetch=prefetch)
+    return extract_network(post_map, comment_iter, 0, **kw_args)
 
 
-def extract_week_network_multisubreddits(subreddits, year, week):
+def extract_week_network_multisubreddits(subreddits, year, week, precomputed_freqs=False,
+        processes=None, **kw_args):
     """
     Extracts a multilayer network of users comments and posts for
     multiple subreddits from the specified week.
+    With precomputed_freqs the word frequencies are taken from the persisted
+    tables of the two months the week is read from, rather than from the week itself.
+    With processes the subreddits are handled in a pool of worker processes.
     """
+    stats = kw_args.get("stats")
+    down_sample = kw_args.pop("down_sample", None)
+    prefetch = kw_args.pop("prefetch", 0)
+    if precomputed_freqs:
+        kw_args["word_freqs"] = _timed_call(stats, "idf", get_word_freqs,
+                subreddits, year, [week/4+1, week/4+2])
+    if processes:
+        return _extract_parallel([("week", subreddit, year, week) for subreddit in subreddits],
+                0, processes, down_sample=down_sample, **kw_args)
     post_map = {}
     for subreddit in subreddits:
-        post_map.update(PostMap(subreddit, year, -1, week=week).post_map)
-    comment_iter = MultiIterWrapper([WeekIterWrapper(SpacyComments, week, subreddit, year) for
-        subreddit in subreddits])
-    return extract_network(post_map, comment_iter, 0)
+        post_map.update(PostMap(subreddit, year, -1, week=week, stats=stats).post_map)
+    comment_iter = MultiIterWrapper([WeekIterWrapper(SpacyComments, week, subreddit, year,
+        stats=stats, down_sample=down_sample) for subreddit in subreddits], prefetch=prefetch)
+    return extract_network(post_map, comment_iter, 0, **kw_args)
 
-def extract_year_network(subreddit, year):
+def extract_year_network(subreddit, year, precomputed_freqs=False, processes=None, **kw_args):
     """
     Extracts a multi-layer network of users, comments, and posts.
     Data is taken from a specific month (num between 1 and 12) in a specific year.
+    With precomputed_freqs the word frequencies are read from the persisted
+    per subreddit-month tables instead of being counted (same values).
+    With processes the months are handled in a pool of worker processes.
     """
+    base_time = get_week_timestamp(year,0)
+    stats = kw_args.get("stats")
+    down_sample = kw_args.pop("down_sample", None)
+    prefetch = kw_args.pop("prefetch", 0)
+    if precomputed_freqs:
+        kw_args["word_freqs"] = _timed_call(stats, "idf", get_word_freqs,
+                [subreddit], year, range(1,13))
+    if processes:
+        return _extract_parallel([("month", subreddit, year, month) for month in range(1,13)],
+                base_time, processes, down_sample=down_sample, **kw_args)
     post_map = {}
     for month in range(1,13):
-        post_map.update(PostMap(subreddit, year, month).post_map)
-    comment_iter = MultiIterWrapper([SpacyComments(subreddit, year, month) for
-        month in range(1,13)])
-    base_time = get_week_timestamp(year,0)
-    return extract_network(post_map, comment_iter, base_time)
+        post_map.update(PostMap(subreddit, year, month, stats=stats).post_map)
+    comment_iter = MultiIterWrapper([SpacyComments(subreddit, year, month, stats=stats,
+        down_sample=down_sample) for month in range(1,13)], prefetch=prefetch)
+    return extract_network(post_map, comment_iter, base_time, **kw_args)
 
 
-def extract_month_network(subreddit, year, month):
+def extract_month_network(subreddit, year, month, precomputed_freqs=False, **kw_args):
     """
     Extracts a multi-layer network of users, comments, and posts.
     Data is taken from a specific month (num between 1 and 12) in a specific year.
+    With precomputed_freqs the word frequencies are read from the persisted
+    subreddit-month table instead of being counted (same values).
     """
-    post_map = PostMap(subreddit, year, month)
-    comment_iter = SpacyComments(subreddit, year, month)
+    stats = kw_args.get("stats")
+    down_sample = kw_args.pop("down_sample", None)
+    prefetch = kw_args.pop("prefetch", 0)
+    post_map = PostMap(subreddit, year, month, stats=stats)
+    comment_iter = MultiIterWrapper([SpacyComments(subreddit, year, month, stats=stats,
+        down_sample=down_sample)], prefetch=prefetch)
     #TODO: Actually do this... It is not a big deal since the values
     # will be internally consistent, but still...
     month_base_time = get_week_timestamp(year, month/4-2)
-    return extract_network(post_map.post_map, comment_iter, month_base_time)
+    if precomputed_freqs:
+        kw_args["word_freqs"] = _timed_call(stats, "idf", get_word_freqs, [subreddit], year, [month])
+    return extract_network(post_map.post_map, comment_iter, month_base_time, **kw_args)
 
-def extract_week_network(subreddit, year, week):
+def extract_week_network(subreddit, year, week, precomputed_freqs=False, **kw_args):
     """
     Extracts a multi-layer network of users, comments, and posts.
     Data is taken from a specific week (num between 1 and 50) in a specific year.
+    With precomputed_freqs the word frequencies are taken from the persisted
+    tables of the two months the week is read from, rather than from the week itself.
     """
-    post_map = PostMap(subreddit, year, -1, week=week)
-    comment_iter = WeekIterWrapper(SpacyComments, week, subreddit, year)
+    stats = kw_args.get("stats")
+    down_sample = kw_args.pop("down_sample", None)
+    prefetch = kw_args.pop("prefetch", 0)
+    if precomputed_freqs:
+        kw_args["word_freqs"] = _timed_call(stats, "idf", get_word_freqs,
+                [subreddit], year, [week/4+1, week/4+2])
+    post_map = PostMap(subreddit, year, -1, week=week, stats=stats)
+    comment_iter = WeekIterWrapper(SpacyComments, week, subreddit, year, stats=stats,
+            down_sample=down_sample, prefetch=prefetch)
     week_base_time = get_week_timestamp(year, week)
 
-    return extract_network(post_map.post_map, comment_iter, week_base_time)
+    return extract_network(post_map.post_map, comment_iter, week_base_time, **kw_args)
+
+def extract_compiled_network(subreddits, year, months, base_time=0, week=None, **kw_args):
+    """
+    Extracts the network of the given subreddits and months (optionally only one
+    week of them) from compiled files (see compiled_corpus), without decoding any doc.
+    The word frequencies are counted from the compiled arrays up front, unless
+    word_freqs is given; the network is the same as from the spacy files.
+    """
+    if isinstance(subreddits, basestring):
+        subreddits = [subreddits]
+    stats = kw_args.get("stats")
+    down_sample = kw_args.pop("down_sample", None)
+    # compiled files are memory mapped, there is nothing to read ahead
+    kw_args.pop("prefetch", None)
+    post_map = {}
+    comment_iters = []
+    for subreddit in subreddits:
+        for month in months:
+            for post in CompiledPosts(subreddit, year, month, stats=stats).__iter__(week=week):
+                post_map[post["id"]] = post
+            comment_iters.append(CompiledComments(subreddit, year, month, stats=stats,
+                down_sample=down_sample))
+    if kw_args.get("idf", True) and kw_args.get("word_freqs") is None:
+        kw_args["word_freqs"] = _timed_call(stats, "idf", compiled_word_freqs, comment_iters, week)
+    comments = (comment for comment_iter in comment_iters
+            for comment in comment_iter.__iter__(week=week))
+    return extract_network(post_map, comments, base_time, **kw_args)
 
 def _get_embedding(doc, counter, total_count):
+    """
+    Reference per-doc embedding; extract_network uses the batched SIFEmbedder.
+    """
     vecs = [word.vector*(SIF / (counter[word.lower_]/total_count + SIF)) for word in doc if word.has_vector]
     if len(vecs) == 0 or np.isnan(np.sum(np.array(vecs))):
         return np.zeros((VEC_SIZE,))
@@ -80,40 +176,356 @@ def _get_embedding(doc, counter, total_count):
         vecs = np.mean(vecs, axis=0)
         return vecs
 
-def extract_network(post_map, comment_iter, base_time, idf=True):
+def _timed_call(stats, stage, func, *args):
+    if stats is None:
+        return func(*args)
+    start = time.time()
+    result = func(*args)
+    stats.add_time(stage, time.time() - start)
+    return result
+
+def _embed_block(pending, embedder, cache=None):
+    """
+    (len(pending), VEC_SIZE) embeddings for a block of (node id, vector ids) pairs.
+    With an EmbeddingCache, cached rows are reused and the newly computed ones stored.
+    """
+    if cache is None:
+        return embedder.embed_block([vector_ids for _, vector_ids in pending])
+    node_ids = [node_id for node_id, _ in pending]
+    found, cached = cache.get_many(node_ids)
+    missing = np.flatnonzero(~found)
+    computed = embedder.embed_block([pending[i][1] for i in missing])
+    cache.put_many([node_ids[i] for i in missing], computed)
+    word_vecs = np.zeros((len(pending), VEC_SIZE), dtype=np.float32)
+    word_vecs[found] = cached
+    word_vecs[missing] = computed
+    return word_vecs
+
+def _flush_pending(graph, pending, embedder, cache=None, stats=None):
+    """
+    Embeds pending block by block, hands the rows to the graph builder and empties it.
+    """
+    for start in xrange(0, len(pending), BLOCK_SIZE):
+        block = pending[start:start+BLOCK_SIZE]
+        word_vecs = _timed_call(stats, "embed", _embed_block, block, embedder, cache)
+        _timed_call(stats, "graph", graph.set_word_vecs,
+                [node_id for node_id, _ in block], word_vecs)
+    del pending[:]
+
+def _flush_embedded(graph, embedded, stats=None):
+    _timed_call(stats, "graph", graph.set_word_vecs,
+            [node_id for node_id, _ in embedded], [vecs for _, vecs in embedded])
+    del embedded[:]
+
+def _record_doc(record):
+    """
+    The doc of a record. Lazy records are decoded without caching the doc in
+    them, so records that stay around (e.g. in the post map) do not keep it.
+    """
+    if isinstance(record, LazyRecord) and not dict.__contains__(record, "doc"):
+        return decode_doc(record.byte_string)
+    return record["doc"]
+
+def _digest_record(record, lower_counts=None, stats=None):
+    """
+    Returns the length and vector token ids of a post/comment record,
+    decoding its doc unless it was already digested (e.g. by a worker process).
+    """
+    if "vector_ids" in record:
+        return record["length"], record["vector_ids"]
+    if stats is None:
+        doc = _record_doc(record)
+        return len(doc), digest_doc(doc, lower_counts)
+    start = time.time()
+    doc = _record_doc(record)
+    decoded = time.time()
+    vector_ids = digest_doc(doc, lower_counts)
+    stats.add_time("decode", decoded - start)
+    stats.add_time("digest", time.time() - decoded)
+    return len(doc), vector_ids
+
+def _digested(record, lower_counts=None, stats=None):
+    """
+    Copy of record with the doc replaced by what extract_network needs.
+    """
+    digest = {key : value for key, value in record.iteritems() if not key in ("doc", "text")}
+    digest["length"], digest["vector_ids"] = _digest_record(record, lower_counts, stats)
+    return digest
+
+def _embed_digests(digests, embedder, cache=None, stats=None):
+    """
+    Sets the word_vecs of digested records, embedding them BLOCK_SIZE at a time
+    (through the EmbeddingCache, if given).
+    """
+    for start in xrange(0, len(digests), BLOCK_SIZE):
+        block = digests[start:start+BLOCK_SIZE]
+        word_vecs = _timed_call(stats, "embed", _embed_block,
+                [(digest["id"], digest["vector_ids"]) for digest in block], embedder, cache)
+        for digest, vecs in zip(block, word_vecs):
+            digest["word_vecs"] = vecs
 
-    if idf:
-        df = Counter()
-        total_count = 0.
-        for comment in comment_iter:
-            for word in comment["doc"]:
-                df[word.lower_] += 1
-                total_count += 1.
+def _add_pending(record, pending, embedded, vector_ids):
+    if "word_vecs" in record:
+        embedded.append((record["id"], record["word_vecs"]))
     else:
-        df = defaultdict(float)
-        total_count = 1.
+        pending.append((record["id"], vector_ids))
+
+def _add_post(graph, post, base_time, length, vector_ids, pending, embedded):
+    graph.add_node(post["id"], 
+            type="post",
+            score=post["score"],
+            num_comments=post["num_comments"],
+            subreddit=post["subreddit"],
+            time=(int(post["timestamp"])-base_time)/3600.,
+            length=length)
+    _add_pending(post, pending, embedded, vector_ids)
+    if not graph.has_node(post["author"]):
+        graph.add_node(post["author"], type="user")
+    graph.add_edge(post["author"], post["id"], "user_post")
+
+def _add_comment(graph, comment, post, base_time, length, vector_ids, pending, embedded):
+    # add author node if necessary
+    if not graph.has_node(comment["author"]):
+        graph.add_node(comment["author"], type="user")
+
+    # add comment node
+    graph.add_node(comment["id"],
+            type="comment",
+            score=comment["score"],
+            subreddit=comment["subreddit"],
+            time=(comment["timestamp"]-base_time)/3600.,
+            post_time_offset=(comment["timestamp"]-int(post["timestamp"]))/3600.,
+            length=length)
+    _add_pending(comment, pending, embedded, vector_ids)
+
+    # Add edges
+    graph.add_edge(comment["author"], comment["id"], "user_comment")
+    if comment["parent"] != comment["post"]:
+        if graph.has_node(comment["parent"]):
+            graph.add_edge(comment["parent"], comment["id"], "comment_comment")
+    elif graph.has_node(comment["post"]):
+        graph.add_edge(comment["post"], comment["id"], "post_comment")
+
+def _deferred(comment, length, vector_ids):
+    """
+    The metadata and digest of a comment kept for resolution, without its doc.
+    """
+    record = {key : comment[key] for key in
+            ("id", "timestamp", "author", "score", "parent", "post", "subreddit")}
+    record["length"], record["vector_ids"] = length, vector_ids
+    if "word_vecs" in comment:
+        record["word_vecs"] = comment["word_vecs"]
+    return record
 
-    graph = nx.DiGraph(user_feats={},
-            post_feats = {"score" : 1, "time": 1, "num_comments": 1, "subreddit" : 1, "length" : 1, "word_vecs" : VEC_SIZE},
-            comment_feats = {"score" : 1, "time" : 1, "post_time_offset": 1, "length" : 1, "subreddit" : 1, "word_vecs" : VEC_SIZE})
+def _attachable(comment, graph, posts):
+    return comment["post"] in posts and (comment["parent"] == comment["post"]
+            or graph.has_node(comment["parent"]))
+
+def _add_attachable(graph, deferred, posts, base_time, pending, embedded):
+    """
+    Adds the deferred comments whose post and parent are now present, repeatedly
+    (a parent can itself be deferred), and returns the ones that are still missing one.
+    """
+    while True:
+        remaining = []
+        for comment in deferred:
+            if _attachable(comment, graph, posts):
+                _add_comment(graph, comment, posts[comment["post"]], base_time,
+                        comment["length"], comment["vector_ids"], pending, embedded)
+            else:
+                remaining.append(comment)
+        if len(remaining) == len(deferred):
+            return remaining
+        deferred = remaining
+
+def _resolve_deferred(graph, deferred, post_map, id_index, base_time, pending, embedded,
+        stats=None):
+    """
+    Adds the deferred comments (those whose post or parent was missing when they
+    were read). Parents that are later in the stream are taken from the graph; the
+    posts and parent comments that are not in the stream at all are fetched from
+    id_index and added as boundary nodes. Boundary nodes do not count towards
+    the word frequencies, and their own missing parents are not fetched.
+    Returns the comments that still miss a post or parent, and all posts.
+    """
+    posts = dict(post_map)
+    deferred = _add_attachable(graph, deferred, posts, base_time, pending, embedded)
+    if len(deferred) == 0:
+        return deferred, posts
+    if not stats is None:
+        stats.start_stage("resolve")
+    deferred_ids = set(comment["id"] for comment in deferred)
+    parent_ids = set(comment["parent"] for comment in deferred
+            if comment["parent"] != comment["post"] and not comment["parent"] in deferred_ids
+            and not graph.has_node(comment["parent"]))
+    parents = id_index.fetch("comments", parent_ids)
+    post_ids = set(record["post"] for record in deferred + parents.values()
+            if not record["post"] in posts)
+    boundary_posts = id_index.fetch("posts", post_ids)
+    for post in boundary_posts.itervalues():
+        length, vector_ids = _digest_record(post, stats=stats)
+        _add_post(graph, post, base_time, length, vector_ids, pending, embedded)
+    posts.update(boundary_posts)
+    num_parents = 0
+    for parent in parents.itervalues():
+        if not parent["post"] in posts:
+            continue
+        length, vector_ids = _digest_record(parent, stats=stats)
+        _add_comment(graph, parent, posts[parent["post"]], base_time, length, vector_ids,
+                pending, embedded)
+        num_parents += 1
+    deferred = _add_attachable(graph, deferred, posts, base_time, pending, embedded)
+    if not stats is None:
+        stats.end_stage("resolve")
+        stats.count("posts.resolved", len(boundary_posts))
+        stats.count("comments.resolved_parent", num_parents)
+    return deferred, posts
+
+def _partition_iters(kind, subreddit, year, period, stats=None, down_sample=None):
+    if kind == "month":
+        return (PostIterator(subreddit, year, period, stats=stats),
+                SpacyComments(subreddit, year, period, stats=stats, down_sample=down_sample))
+    else:
+        return (WeekIterWrapper(PostIterator, period, subreddit, year, stats=stats),
+                WeekIterWrapper(SpacyComments, period, subreddit, year, stats=stats,
+                    down_sample=down_sample))
+
+def _digest_partition(args):
+    """
+    Worker: reads and digests the posts and comments of one subreddit-month/week.
+    Returns the digested posts and comments, the word counts (None if the
+    frequencies are given, in which case the word_vecs are computed here, in
+    blocks and through the embedding cache if there is one) and the worker's
+    ExtractionStats (None unless with_stats).
+    """
+    (kind, subreddit, year, period), idf, word_freqs, with_stats, down_sample, \
+            embedding_cache = args
+    stats = ExtractionStats() if with_stats else None
+    post_iter, comment_iter = _partition_iters(kind, subreddit, year, period, stats, down_sample)
+    lower_counts = LowerCounts() if idf and word_freqs is None else None
+    posts = [_digested(post, stats=stats) for post in post_iter]
+    comments = [_digested(comment, lower_counts, stats) for comment in comment_iter]
+    if idf and not word_freqs is None:
+        embedder = SIFEmbedder(word_freqs, word_freqs.total)
+        cache = None
+        if not embedding_cache is None:
+            cache = EmbeddingCache(embedding_cache,
+                    freqs_version(embedder.counter, embedder.total_count))
+        _embed_digests(posts + comments, embedder, cache, stats)
+    counts = None
+    if not lower_counts is None:
+        counts = (_timed_call(stats, "idf", lower_counts.to_counter), lower_counts.total)
+    return posts, comments, counts, stats
+
+def _map_partitions(partitions, processes):
+    if not processes:
+        return [_digest_partition(partition) for partition in partitions]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_digest_partition, partitions, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _extract_parallel(partitions, base_time, processes, idf=True, word_freqs=None,
+        down_sample=None, **kw_args):
+    """
+    Digests the partitions in a process pool and builds the network from the results,
+    in partition order, exactly as the serial extraction would.
+    """
+    stats = kw_args.get("stats")
+    results = _map_partitions([(partition, idf, word_freqs, not stats is None, down_sample,
+        kw_args.get("embedding_cache")) for partition in partitions], processes)
+    post_map = {}
+    comments = []
+    df = Counter()
+    for posts, partition_comments, counts, partition_stats in results:
+        for post in posts:
+            post_map[post["id"]] = post
+        comments.extend(partition_comments)
+        if not counts is None:
+            df.update(counts[0])
+        if not partition_stats is None:
+            stats.merge(partition_stats)
+    if idf and word_freqs is None:
+        # the summed counts (and their total) equal what the serial pass counts
+        word_freqs = _timed_call(stats, "idf", WordFreqs.from_counter, df)
+    return extract_network(post_map, comments, base_time, idf=idf, word_freqs=word_freqs, **kw_args)
+
+def extract_network(post_map, comment_iter, base_time, idf=True, word_freqs=None,
+        embedding_cache=None, output="networkx", stats=None, resolve=False):
+    """
+    Builds the user/post/comment network in a single pass over comment_iter.
+    Every doc is decoded once: the word counts are accumulated while the graph
+    is built, and the (count dependent) word_vecs features are filled in at the end
+    from the vector token ids kept for each node.
+    If word_freqs (a WordFreqs table) is given, it is used for the SIF weights
+    and nothing is counted.
+    embedding_cache is an optional directory for an EmbeddingCache; embeddings are
+    only reused for identical word frequencies, so sweeps over overlapping windows
+    should pass the same word_freqs (e.g. a year table) to every call.
+    output selects the result: "networkx" for a DiGraph, "arrays" for an ArrayGraph,
+    or any builder object (see graph_builders), e.g. a StreamingGraphWriter.
+    When the frequencies are known up front (word_freqs given or idf=False) the
+    word_vecs are computed and handed to the builder every BLOCK_SIZE nodes, so
+    memory stays bounded with a streaming builder.
+    stats is an optional ExtractionStats that gets the stage times and the
+    processed/skipped counts.
+    By default comments whose post is not in post_map, or whose parent is not in the
+    graph yet, are skipped. With resolve=True (or an IdIndex) they are kept back
+    instead and added at the end: parents later in the stream are found in the graph,
+    and the missing posts and parents are fetched through the id index (see id_index)
+    and added as boundary nodes, without reading the rest of their months.
+    """
+    count_words = idf and word_freqs is None
+    lower_counts = LowerCounts() if count_words else None
+    embedder = None
+    if not idf:
+        embedder = SIFEmbedder(defaultdict(float), 1.)
+    elif not word_freqs is None:
+        embedder = SIFEmbedder(word_freqs, word_freqs.total)
+    cache = None
+    if not embedder is None and not embedding_cache is None:
+        cache = EmbeddingCache(embedding_cache,
+                freqs_version(embedder.counter, embedder.total_count))
+
+    id_index = None
+    if resolve is True:
+        id_index = get_id_index()
+        if id_index is None:
+            raise ValueError("No id index in {}, build one with build_id_index".format(
+                constants.DATA_HOME))
+    elif resolve:
+        id_index = resolve
+    # comments kept back for resolution
+    deferred = []
+
+    graph = BUILDERS[output]() if isinstance(output, basestring) else output
+    # (node id, vector token ids) for every node that needs word_vecs
+    pending = []
+    # (node id, word_vecs) for nodes embedded by a worker process
+    embedded = []
 
     ## Add all posts as nodes connected to their authors
+    if not stats is None:
+        stats.start_stage("posts")
     for post in post_map.values():
-        graph.add_node(post["id"], 
-                type="post",
-                score=post["score"],
-                num_comments=post["num_comments"],
-                subreddit=post["subreddit"],
-                time=(int(post["timestamp"])-base_time)/3600.,
-                length=len(post["doc"]),
-                word_vecs=_get_embedding(post["doc"], df, total_count))
-        if not graph.has_node(post["author"]):
-            graph.add_node(post["author"], type="user")
-        graph.add_edge(post["author"], post["id"], type="user_post")
+        length, vector_ids = _digest_record(post, stats=stats)
+        _add_post(graph, post, base_time, length, vector_ids, pending, embedded)
+    if not stats is None:
+        stats.end_stage("posts")
+        stats.count("posts.added", len(post_map))
 
+    num_comments = 0
     skipped_missing_parent = 0
     skipped_missing_post = 0
-    for i, comment in enumerate(comment_iter):
+    for comment in comment_iter:
+        num_comments += 1
+        # every comment counts towards the word frequencies, even skipped ones
+        length, vector_ids = _digest_record(comment, lower_counts, stats)
+        if not id_index is None and not _attachable(comment, graph, post_map):
+            deferred.append(_deferred(comment, length, vector_ids))
+            continue
         # skip comments that don't respond to a post from this week
         if not comment["post"] in post_map:
             skipped_missing_post += 1
@@ -122,28 +534,144 @@ def extract_network(post_map, comment_iter, base_time, idf=True):
         if comment["parent"] != comment["post"] and not graph.has_node(comment["parent"]):
             skipped_missing_parent += 1
             continue
+        if not stats is None:
+            start = time.time()
+        _add_comment(graph, comment, post_map[comment["post"]], base_time, length, vector_ids,
+                pending, embedded)
+        if not stats is None:
+            stats.add_time("graph", time.time() - start)
 
-        # add author node if necessary
-        if not graph.has_node(comment["author"]):
-            graph.add_node(comment["author"], type="user")
-
-        # add comment node
-        graph.add_node(comment["id"],
-                type="comment",
-                score=comment["score"],
-                subreddit=comment["subreddit"],
-                time=(comment["timestamp"]-base_time)/3600.,
-                post_time_offset=(comment["timestamp"]-int(post["timestamp"]))/3600.,
-                length=len(comment["doc"]),
-                word_vecs=_get_embedding(comment["doc"], df, total_count))
-
-        # Add edges
-        graph.add_edge(comment["author"], comment["id"], type="user_comment")
-        if comment["parent"] != comment["post"]:
-            graph.add_edge(comment["parent"], comment["id"], type="comment_comment")
-        else:
-            graph.add_edge(comment["post"], comment["id"], type="post_comment")
+        if not embedder is None and len(pending) >= BLOCK_SIZE:
+            _flush_pending(graph, pending, embedder, cache, stats)
+        if len(embedded) >= BLOCK_SIZE:
+            _flush_embedded(graph, embedded, stats)
+
+    if len(deferred) > 0:
+        deferred, posts = _resolve_deferred(graph, deferred, post_map, id_index, base_time,
+                pending, embedded, stats)
+        for comment in deferred:
+            if not comment["post"] in posts:
+                skipped_missing_post += 1
+            else:
+                skipped_missing_parent += 1
+
+    if embedder is None:
+        if not stats is None:
+            stats.start_stage("idf")
+        embedder = SIFEmbedder(lower_counts.to_counter(), float(lower_counts.total))
+        if not embedding_cache is None:
+            cache = EmbeddingCache(embedding_cache,
+                    freqs_version(embedder.counter, embedder.total_count))
+        if not stats is None:
+            stats.end_stage("idf")
+    _flush_pending(graph, pending, embedder, cache, stats)
+    _flush_embedded(graph, embedded, stats)
+
+    if not stats is None:
+        stats.count("comments.processed", num_comments)
+        stats.count("comments.skipped_missing_post", skipped_missing_post)
+        stats.count("comments.skipped_missing_parent", skipped_missing_parent)
 
     print "Processed {:d} comments, of which {:d} were removed for missing post and {:d} for missing parent".format(
-            i, skipped_missing_post, skipped_missing_parent)
-    return graph 
+            num_comments, skipped_missing_post, skipped_missing_parent)
+    return graph.finish()
+
+
+class SlidingWeekExtractor():
+    """
+    Incremental extraction of week networks over a sliding window of weeks.
+
+    Each week is read and decoded exactly once, when it enters the window, and kept
+    as digested posts/comments plus its word counts; the week that falls out of the
+    window is evicted together with its counts. Every network is then assembled from
+    the digests of the weeks in the window, without touching the corpus again, and is
+    the same as a fresh extract_network over the window's posts and comments
+    (the missing post/parent rules and the SIF weights depend on the whole window,
+    so they are re-evaluated, which only costs metadata work and one batched embedding).
+    With a fixed word_freqs the embeddings are computed once per week as well.
+    With window=1 and base_time=None the networks match extract_week_network
+    (for a single subreddit).
+    """
+    def __init__(self, subreddits, year, window=1, idf=True, word_freqs=None,
+            base_time=None, processes=None, **kw_args):
+        if isinstance(subreddits, basestring):
+            subreddits = [subreddits]
+        self.subreddits = subreddits
+        self.year = year
+        self.window = window
+        self.idf = idf
+        self.word_freqs = word_freqs
+        self.base_time = base_time
+        self.processes = processes
+        self.down_sample = kw_args.pop("down_sample", None)
+        # weeks are read by _map_partitions, not through the wrappers
+        kw_args.pop("prefetch", None)
+        self.kw_args = kw_args
+        # (week, posts, comments, word counts) for the weeks in the window, oldest first
+        self._weeks = []
+        self._counts = Counter()
+
+    def _read_week(self, week):
+        stats = self.kw_args.get("stats")
+        partitions = [(("week", subreddit, self.year, week), self.idf, self.word_freqs,
+            not stats is None, self.down_sample, self.kw_args.get("embedding_cache"))
+            for subreddit in self.subreddits]
+        results = _map_partitions(partitions, self.processes)
+        posts = []
+        comments = []
+        counts = Counter()
+        for partition_posts, partition_comments, partition_counts, partition_stats in results:
+            posts.extend(partition_posts)
+            comments.extend(partition_comments)
+            if not partition_counts is None:
+                counts.update(partition_counts[0])
+            if not partition_stats is None:
+                stats.merge(partition_stats)
+        return week, posts, comments, counts
+
+    def advance_to(self, week):
+        """
+        Moves the window so that it ends at week and returns its network.
+        Weeks already in the window are not read again; weeks outside it
+        (before or, when moving backwards, after it) are evicted.
+        """
+        first_week = max(1, week - self.window + 1)
+        kept = []
+        for entry in self._weeks:
+            if first_week <= entry[0] <= week:
+                kept.append(entry)
+            else:
+                self._counts.subtract(entry[3])
+        self._weeks = kept
+        loaded = set(entry[0] for entry in self._weeks)
+        for new_week in range(first_week, week + 1):
+            if not new_week in loaded:
+                entry = self._read_week(new_week)
+                self._counts.update(entry[3])
+                self._weeks.append(entry)
+        self._weeks.sort(key=lambda entry : entry[0])
+        return self._extract(first_week)
+
+    def _extract(self, first_week):
+        post_map = {}
+        comments = []
+        for _, posts, week_comments, _ in self._weeks:
+            for post in posts:
+                post_map[post["id"]] = post
+            comments.extend(week_comments)
+        word_freqs = self.word_freqs
+        if self.idf and word_freqs is None:
+            word_freqs = _timed_call(self.kw_args.get("stats"), "idf",
+                    WordFreqs.from_counter, +self._counts)
+        base_time = self.base_time
+        if base_time is None:
+            base_time = get_week_timestamp(self.year, first_week)
+        return extract_network(post_map, comments, base_time, idf=self.idf,
+                word_freqs=word_freqs, **self.kw_args)
+
+    def sweep(self, first_week=1, last_week=50):
+        """
+        Generates (week, network) for every window end from first_week to last_week.
+        """
+        for week in range(first_week, last_week + 1):
+            yield week, self.advance_to(week)
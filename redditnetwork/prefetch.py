@@ -0,0 +1,113 @@
+"""
+Background read-ahead for MultiIterWrapper/WeekIterWrapper.
+
+A Prefetcher runs the raw reads of a list of sources (one per file) in a
+background thread, in order, and hands the (info line, byte string) pairs
+to the consumer through a bounded queue, so the next files are read (and, for
+compressed files, decompressed) while the current one is parsed and decoded.
+File reads and zlib release the GIL, so a thread is enough for the overlap.
+The queue holds at most `size` records; the reader blocks when it is full.
+"""
+
+import sys
+import threading
+import Queue
+
+# records handed over per queue item
+BATCH_SIZE = 256
+
+_END = object()
+
+class Prefetcher():
+    """
+    Reads raw_funcs (functions returning iterables of raw records) one after
+    another in a background thread. Iterating gives one iterator per raw_func,
+    which must be consumed in order.
+    """
+    def __init__(self, raw_funcs, size):
+        self.raw_funcs = raw_funcs
+        self._queue = Queue.Queue(max(1, size / BATCH_SIZE))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # gives up once the consumer has stopped, so the thread never blocks forever
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for raw_func in self.raw_funcs:
+                batch = []
+                for raw in raw_func():
+                    batch.append(raw)
+                    if len(batch) == BATCH_SIZE:
+                        if not self._put(batch):
+                            return
+                        batch = []
+                if not self._put(batch) or not self._put(_END):
+                    return
+        except Exception:
+            self._put(sys.exc_info())
+
+    def _source(self):
+        while True:
+            item = self._queue.get()
+            if item is _END:
+                return
+            if isinstance(item, tuple):
+                # an exception in the reader thread
+                raise item[0], item[1], item[2]
+            for raw in item:
+                yield raw
+
+    def __iter__(self):
+        for _ in self.raw_funcs:
+            yield self._source()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def prefetch_sources(iterator):
+    """
+    The (reader, week) pairs an iterator reads, in order (week is None for whole files).
+    """
+    if hasattr(iterator, "sources"):
+        return iterator.sources()
+    return [(iterator, None)]
+
+def _can_prefetch(reader):
+    return hasattr(reader, "raw_records") and reader.can_prefetch()
+
+def _iter_plain(reader, week):
+    return iter(reader) if week is None else reader.__iter__(week=week)
+
+def iter_prefetched(sources, size):
+    """
+    Generates the records of the (reader, week) sources, as iterating the readers
+    in order would, with their raw reads done ahead by a Prefetcher holding at
+    most size records. Readers that cannot prefetch are read as usual.
+    """
+    raw_funcs = [(lambda reader=reader, week=week : reader.raw_records(week))
+            for reader, week in sources if _can_prefetch(reader)]
+    prefetcher = Prefetcher(raw_funcs, size)
+    raw_iters = iter(prefetcher)
+    try:
+        for reader, week in sources:
+            if not _can_prefetch(reader):
+                records = _iter_plain(reader, week)
+            else:
+                records = reader.records_from_raw(next(raw_iters), week)
+            for record in records:
+                yield record
+    finally:
+        prefetcher.close()
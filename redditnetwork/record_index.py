@@ -0,0 +1,156 @@
+"""
+Byte-offset sidecar indices for the per subreddit-month .bin/.info files.
+
+An index records where every record starts in both the binary spacy file
+and the matching .info file, so that single records (or ranges of records)
+can be read without streaming the whole month through Doc.read_bytes.
+"""
+
+import struct
+import zipfile
+import numpy as np
+
+from redditnetwork.block_compression import open_corpus_file
+from redditnetwork.utils.arrayutils import sorted_lookup
+from redditnetwork.utils.ioutils import save_npz
+
+INDEX_SUFFIX = ".idx.npz"
+
+# Doc.to_bytes (spacy 1.x) prefixes every record with its length as a
+# little-endian int32; Doc.from_bytes expects to see that prefix again.
+_HEADER = struct.Struct("<i")
+
+def read_record_offsets(fp):
+    """
+    Returns the start offset of every spacy record in a .bin file,
+    followed by the end offset of the file.
+    """
+    offsets = [0]
+    pos = 0
+    while True:
+        header = fp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            break
+        n_bytes = _HEADER.unpack(header)[0]
+        pos += _HEADER.size + n_bytes
+        fp.seek(pos)
+        offsets.append(pos)
+    return np.array(offsets, dtype=np.int64)
+
+def read_line_offsets(fp):
+    """
+    Returns the start offset of every line in an .info file,
+    followed by the end offset of the file.
+    """
+    offsets = [0]
+    pos = 0
+    for line in fp:
+        pos += len(line)
+        offsets.append(pos)
+    return np.array(offsets, dtype=np.int64)
+
+
+class RecordIndex():
+    """
+    Offsets, record ids and timestamps for one .bin/.info file pair.
+    Record n lives in bin_offsets[n]:bin_offsets[n+1] and
+    info_offsets[n]:info_offsets[n+1].
+    Records sorted by time are given by time_order, so that any [start, end)
+    time window is a contiguous block of time_order.
+    """
+    def __init__(self, bin_offsets, info_offsets, ids, timestamps, time_order=None):
+        if len(bin_offsets) != len(info_offsets):
+            raise ValueError("Found {:d} binary records but {:d} info lines".format(
+                len(bin_offsets)-1, len(info_offsets)-1))
+        self.bin_offsets = bin_offsets
+        self.info_offsets = info_offsets
+        self.ids = ids
+        self.timestamps = timestamps
+        if time_order is None:
+            time_order = np.argsort(timestamps, kind="mergesort")
+        self.time_order = time_order
+        self._sorted_times = timestamps[time_order]
+        self._id_order = None
+
+    @classmethod
+    def build(cls, path, bin_suffix, key_func):
+        """
+        Scans the files at path once.
+        key_func maps an info line to its (record id, timestamp).
+        """
+        with open_corpus_file(path + bin_suffix) as bin:
+            bin_offsets = read_record_offsets(bin)
+        ids = []
+        timestamps = []
+        with open_corpus_file(path + ".info") as info:
+            info_offsets = read_line_offsets(info)
+            info.seek(0)
+            for line in info:
+                id, timestamp = key_func(line)
+                ids.append(id)
+                timestamps.append(timestamp)
+        return cls(bin_offsets, info_offsets, np.array(ids, dtype=np.string_),
+                np.array(timestamps, dtype=np.int64))
+
+    def source_sizes(self):
+        """
+        Sizes of the .bin and .info files the index was built from (their end offsets).
+        """
+        return int(self.bin_offsets[-1]), int(self.info_offsets[-1])
+
+    @classmethod
+    def load(cls, filename, source_sizes=None):
+        """
+        Raises IOError if the index is missing or unreadable, or, with
+        source_sizes (of the .bin and .info files), was built from other files;
+        so that callers rebuild it.
+        """
+        try:
+            data = np.load(filename)
+            index = cls(data["bin_offsets"], data["info_offsets"], data["ids"],
+                    data["timestamps"], data["time_order"])
+        except (zipfile.BadZipfile, KeyError, ValueError, EOFError) as e:
+            raise IOError("Unreadable record index {}: {}".format(filename, e))
+        if not source_sizes is None and index.source_sizes() != tuple(source_sizes):
+            raise IOError("Stale record index " + filename)
+        return index
+
+    def save(self, filename):
+        save_npz(filename, bin_offsets=self.bin_offsets, info_offsets=self.info_offsets,
+                ids=self.ids, timestamps=self.timestamps, time_order=self.time_order)
+
+    def __len__(self):
+        return len(self.bin_offsets) - 1
+
+    def positions(self, ids):
+        """
+        Maps record ids to record numbers. Unknown ids map to -1.
+        """
+        if self._id_order is None:
+            self._id_order = np.argsort(self.ids, kind="mergesort")
+        positions = sorted_lookup(self.ids[self._id_order], np.asarray(ids, dtype=np.string_))
+        found = positions >= 0
+        positions[found] = self._id_order[positions[found]]
+        return positions
+
+    def time_range(self, start, end):
+        """
+        Record numbers, in file order, of records with start <= timestamp < end.
+        Found with two binary searches over the sorted timestamps.
+        """
+        lo = np.searchsorted(self._sorted_times, start, side="left")
+        hi = np.searchsorted(self._sorted_times, end, side="left")
+        return np.sort(self.time_order[lo:hi])
+
+    def read(self, bin_fp, info_fp, positions):
+        """
+        Generates (info_line, byte_string) pairs for the given record numbers.
+        """
+        for n in positions:
+            if n < 0 or n >= len(self):
+                raise IndexError("Record {:d} out of range".format(n))
+            info_fp.seek(self.info_offsets[n])
+            info_line = info_fp.read(self.info_offsets[n+1] - self.info_offsets[n])
+            bin_fp.seek(self.bin_offsets[n])
+            byte_string = bin_fp.read(self.bin_offsets[n+1] - self.bin_offsets[n])
+            yield info_line, byte_string
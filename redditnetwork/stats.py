@@ -0,0 +1,93 @@
+"""
+Timing and counting instrumentation for the corpus readers and extract_network.
+
+Pass an ExtractionStats as stats=... to an iterator or extractor and read it
+afterwards; nothing is collected when stats is None.
+
+Stages (wall time in seconds):
+    read    parsing and filtering records in the corpus iterators
+    posts   adding the post nodes (includes decoding and digesting their titles)
+    decode  decoding spacy docs
+    digest  extracting token ids and counting words
+    idf     building the word frequencies used for the SIF weights
+    embed   computing (or fetching cached) word_vecs
+    graph   adding comment nodes and edges, and storing word_vecs
+    resolve fetching and adding boundary posts/parents (extract_network with resolve)
+Counters are named "<kind>.<event>", e.g. comments.read, comments.filtered_bot,
+comments.filtered_week, comments.skipped_missing_post, posts.added.
+With worker processes, the workers' times and counts are summed, so stage times
+can exceed the wall time of the run.
+"""
+
+import time
+
+from collections import Counter, defaultdict
+
+STAGES = ["read", "posts", "decode", "digest", "resolve", "idf", "embed", "graph"]
+
+class ExtractionStats():
+    """
+    Accumulates per stage wall times and event counters.
+    callback, if given, is called as callback(stats, stage) whenever a stage
+    started with start_stage is ended, e.g. for progress logging.
+    """
+    def __init__(self, callback=None):
+        self.times = defaultdict(float)
+        self.counters = Counter()
+        self.callback = callback
+        self._started = {}
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+
+    def start_stage(self, stage):
+        self._started[stage] = time.time()
+
+    def end_stage(self, stage):
+        self.times[stage] += time.time() - self._started.pop(stage)
+        if not self.callback is None:
+            self.callback(self, stage)
+
+    def timed_iter(self, iterable, stage):
+        """
+        Yields from iterable, adding the time spent producing each item to stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.times[stage] += time.time() - start
+                return
+            self.times[stage] += time.time() - start
+            yield item
+
+    def merge(self, other):
+        for stage, seconds in other.times.iteritems():
+            self.times[stage] += seconds
+        self.counters.update(other.counters)
+
+    def as_dict(self):
+        return {"times" : dict(self.times), "counters" : dict(self.counters)}
+
+    def __getstate__(self):
+        # worker stats are sent back to the parent; callbacks stay behind
+        return {"times" : self.times, "counters" : self.counters, "callback" : None,
+                "_started" : {}}
+
+    def report(self):
+        """
+        Human readable summary of the times and counters.
+        """
+        lines = []
+        stages = [stage for stage in STAGES if stage in self.times] + \
+                sorted(stage for stage in self.times if not stage in STAGES)
+        for stage in stages:
+            lines.append("{:<10} {:>10.2f}s".format(stage, self.times[stage]))
+        for name in sorted(self.counters):
+            lines.append("{:<40} {:>10d}".format(name, self.counters[name]))
+        return "\n".join(lines)
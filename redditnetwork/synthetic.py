@@ -0,0 +1,174 @@
+"""
+Generates a synthetic corpus in the on-disk layout of the Stanford Reddit data,
+so that readers and extractors can be run (and benchmarked) without it.
+
+    <root>/spacy_comments/YYYY_MM/<sub>.bin/.info   monthly comments
+    <root>/spacy_comments/YYYY/<sub>.bin/.info      yearly comments (all months)
+    <root>/spacy_posts/YYYY_MM/<sub>.info/.title.bin
+    <root>/filtered_users.txt
+    <root>/total_comment_counts.tsv
+
+Set constants.DATA_HOME to root (with a trailing slash) to read it.
+Words are drawn with Zipfian frequencies from the lexemes of the spacy vocab that
+have a vector, so the word_vecs features are exercised as on the real data.
+Some authors are deleted, bots or filtered, some comments reply to posts of
+another month and some replies have a missing parent, so every filter and skip
+path is taken.
+"""
+
+import json
+import calendar
+import datetime
+import numpy as np
+
+from redditnetwork.corpus_reader import get_vocab
+from redditnetwork.utils.ioutils import mkdir
+
+from spacy.tokens.doc import Doc
+
+BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def _base36(number):
+    digits = []
+    while True:
+        number, digit = divmod(number, 36)
+        digits.append(BASE36[digit])
+        if number == 0:
+            return "".join(reversed(digits))
+
+def _month_bounds(year, month):
+    start = calendar.timegm(datetime.date(year, month, 1).timetuple())
+    days = calendar.monthrange(year, month)[1]
+    return start, start + days*24*3600
+
+
+class SyntheticCorpus():
+    """
+    Random but reproducible (for a given seed) corpus generator.
+    comments_per_month and posts_per_month are per subreddit.
+    """
+    def __init__(self, root, subreddits=("sub_a", "sub_b"), year=2014, months=range(1,13),
+            comments_per_month=2000, posts_per_month=200, num_users=500,
+            num_words=20000, comment_length=30, title_length=10, seed=0):
+        self.root = root if root.endswith("/") else root + "/"
+        self.subreddits = list(subreddits)
+        self.year = year
+        self.months = list(months)
+        self.comments_per_month = comments_per_month
+        self.posts_per_month = posts_per_month
+        self.comment_length = comment_length
+        self.title_length = title_length
+        self._rng = np.random.RandomState(seed)
+        self._next_id = 0
+        self.vocab = get_vocab()
+        self._words = self._pick_words(num_words)
+        ranks = np.arange(1, len(self._words) + 1, dtype=np.float64)
+        self._word_probs = 1. / ranks / (1. / ranks).sum()
+        self.users = ["user_" + _base36(i) for i in xrange(num_users)]
+        self.filtered_users = self.users[:max(1, num_users / 50)]
+        self.users += ["[deleted]", "auto_bot", "helper_bot2"]
+
+    def _pick_words(self, num_words):
+        lexemes = [lexeme for lexeme in self.vocab if lexeme.has_vector and lexeme.is_alpha]
+        lexemes.sort(key=lambda lexeme : -lexeme.prob)
+        words = [lexeme.orth_ for lexeme in lexemes[:num_words]]
+        if len(words) == 0:
+            raise ValueError("The spacy vocab has no words with vectors")
+        return words + [u".", u",", u"http://www.reddit.com", u"42"]
+
+    def _new_id(self):
+        self._next_id += 1
+        return _base36(self._next_id + 36**5)
+
+    def _doc_bytes(self, mean_length):
+        length = self._rng.poisson(mean_length) + 1
+        words = [self._words[i] for i in
+                self._rng.choice(len(self._words), size=length, p=self._word_probs)]
+        return Doc(self.vocab, words=words).to_bytes()
+
+    def _author(self):
+        return self.users[self._rng.randint(len(self.users))]
+
+    def _timestamps(self, count, start, end):
+        return np.sort(self._rng.randint(start, end, size=count))
+
+    def _write_month(self, subreddit, month, posts):
+        """
+        Writes the posts and comments of one subreddit-month.
+        posts holds (id, timestamp) of the posts of the previous month, so that
+        some comments reply to posts outside of this month.
+        Returns this month's posts and the comment .bin/.info contents.
+        """
+        start, end = _month_bounds(self.year, month)
+        month_dir = "{:d}_{:02d}/".format(self.year, month)
+        new_posts = []
+        post_dir = self.root + "spacy_posts/" + month_dir
+        mkdir(post_dir)
+        with open(post_dir + subreddit + ".info", "w") as info:
+            with open(post_dir + subreddit + ".title.bin", "wb") as bin:
+                for timestamp in self._timestamps(self.posts_per_month, start, end):
+                    post = {"id" : self._new_id(), "timestamp" : int(timestamp),
+                            "author" : self._author(), "score" : int(self._rng.randint(-5, 100)),
+                            "num_comments" : int(self._rng.poisson(10))}
+                    info.write(json.dumps(post) + "\n")
+                    bin.write(self._doc_bytes(self.title_length))
+                    new_posts.append((post["id"], post["timestamp"]))
+        # a quarter of the previous month's posts still get replies
+        candidates = posts[-max(1, len(posts)/4):] + new_posts if len(posts) > 0 else new_posts
+        replies = {}
+        info_lines = []
+        docs = []
+        for timestamp in self._timestamps(self.comments_per_month, start, end):
+            post, _ = candidates[self._rng.randint(len(candidates))]
+            comment_id = self._new_id()
+            thread = replies.setdefault(post, [])
+            if len(thread) > 0 and self._rng.rand() < 0.6:
+                # one reply in twenty points at a comment that is not in the data
+                parent = thread[self._rng.randint(len(thread))] if self._rng.rand() > 0.05 \
+                        else self._new_id()
+            else:
+                parent = post
+            thread.append(comment_id)
+            info_lines.append("\t".join([comment_id, str(timestamp), self._author(),
+                str(self._rng.randint(-5, 50)), parent, post]) + "\n")
+            docs.append(self._doc_bytes(self.comment_length))
+        comment_dir = self.root + "spacy_comments/" + month_dir
+        mkdir(comment_dir)
+        with open(comment_dir + subreddit + ".info", "w") as info:
+            info.writelines(info_lines)
+        with open(comment_dir + subreddit + ".bin", "wb") as bin:
+            bin.writelines(docs)
+        return new_posts, info_lines, docs
+
+    def write(self):
+        """
+        Writes the corpus under root and returns the number of posts and comments.
+        """
+        mkdir(self.root)
+        year_dir = self.root + "spacy_comments/{:d}/".format(self.year)
+        mkdir(year_dir)
+        counts = {}
+        for subreddit in self.subreddits:
+            posts = []
+            with open(year_dir + subreddit + ".info", "w") as year_info:
+                with open(year_dir + subreddit + ".bin", "wb") as year_bin:
+                    for month in self.months:
+                        posts, info_lines, docs = self._write_month(subreddit, month, posts)
+                        year_info.writelines(info_lines)
+                        year_bin.writelines(docs)
+            counts[subreddit] = len(self.months) * self.comments_per_month
+        with open(self.root + "filtered_users.txt", "w") as fp:
+            for user in self.filtered_users:
+                fp.write(user + "\tspam\n")
+        with open(self.root + "total_comment_counts.tsv", "w") as fp:
+            for subreddit in self.subreddits:
+                fp.write("{}\t{:d}\n".format(subreddit, counts[subreddit]))
+        num_subreddit_months = len(self.subreddits) * len(self.months)
+        return {"posts" : num_subreddit_months * self.posts_per_month,
+                "comments" : num_subreddit_months * self.comments_per_month}
+
+def write_corpus(root, **kw_args):
+    """
+    Writes a synthetic corpus under root; see SyntheticCorpus for the options.
+    """
+    return SyntheticCorpus(root, **kw_args).write()
@@ -0,0 +1,21 @@
+import numpy as np
+
+def sorted_lookup(sorted_values, values):
+    """
+    Positions of values in the sorted array sorted_values, -1 for values not in it.
+    Strings are compared as python objects, so values longer than a fixed-width
+    array's width (which the binary search sees truncated) never match.
+    """
+    values = np.asarray(values)
+    positions = -np.ones(len(values), dtype=np.int64)
+    if len(sorted_values) == 0 or len(values) == 0:
+        return positions
+    keys = values if values.dtype == sorted_values.dtype else values.astype(sorted_values.dtype)
+    found = np.minimum(np.searchsorted(sorted_values, keys), len(sorted_values) - 1)
+    if sorted_values.dtype.kind in "SUO" or values.dtype.kind in "SUO":
+        matches = np.array([a == b for a, b in zip(sorted_values[found].tolist(), values.tolist())],
+                dtype=bool)
+    else:
+        matches = sorted_values[found] == values
+    positions[matches] = found[matches]
+    return positions
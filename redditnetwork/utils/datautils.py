@@ -1,72 +1,183 @@
-import collections
 import pandas as pd
 import numpy as np
 import os
+import hashlib
+import multiprocessing
 
 from redditnetwork import constants
-from redditnetwork.utils.ioutils import load_json
+from redditnetwork.utils.ioutils import load_json, load_pickle, write_pickle, mkdir
+from redditnetwork.manifest import get_manifest
 
 
 DATA = constants.DATA_HOME
 
-def make_data_frame(communities, feature_dict):
+# feature functions of the running evaluation; worker processes inherit them
+# when they are forked, so lambdas and closures need not be picklable
+_FEATURES = {}
+
+def _code_version(code):
+    # nested code objects (inner lambdas) have addresses in their repr
+    consts = [_code_version(const) if hasattr(const, "co_code") else repr(const)
+            for const in code.co_consts]
+    return hashlib.sha1(code.co_code + repr(consts) + repr(code.co_names)).hexdigest()
+
+def _func_version(func):
     """
-    Makes a pandas dataframe for name, months, and dictionary of feature funcs.
-    Each feature func should take name and return feature value.
-    Constructed dataframe has flat csv style structure and missing values are removed.
+    Hash of the code of a feature function, so that cached values are dropped
+    when the function is edited (values it closes over are not tracked).
     """
+    code = getattr(func, "func_code", None)
+    return None if code is None else _code_version(code)
 
-    temp = collections.defaultdict(list)
-    feature_dict["name"] = lambda name : name
-    for name in communities:
+def _evaluate_cell(cell):
+    feature, args = cell
+    return _FEATURES[feature](*args)
+
+class FeatureCache():
+    """
+    On-disk memo of feature values, one pickle per feature under cache_dir,
+    keyed by the (community,) or (community, time) arguments.
+    """
+    def __init__(self, cache_dir):
+        mkdir(cache_dir)
+        self.cache_dir = cache_dir
+
+    def _filename(self, feature):
+        return os.path.join(self.cache_dir, "{}.pkl".format(feature))
+
+    def load(self, feature, version):
+        """
+        Cached values of feature; empty if they were computed by another version.
+        """
+        try:
+            cached = load_pickle(self._filename(feature))
+        except (IOError, EOFError):
+            return {}
+        if cached["version"] != version:
+            return {}
+        return cached["values"]
+
+    def save(self, feature, version, values):
+        filename = self._filename(feature)
+        write_pickle({"version" : version, "values" : values}, filename + ".tmp")
+        os.rename(filename + ".tmp", filename)
+
+    def invalidate(self, feature):
+        if os.path.exists(self._filename(feature)):
+            os.remove(self._filename(feature))
+
+def evaluate_features(feature_dict, cells, processes=None, cache_dir=None, recompute=()):
+    """
+    Evaluates every feature function on every argument tuple in cells.
+    Returns a dict from feature name to the list of values, in cell order.
+    With cache_dir, values are memoized on disk and only missing cells (or all cells of
+    the features named in recompute, or of features whose code changed) are computed.
+    With processes, the cells are computed in a pool of that many forked processes.
+    """
+    global _FEATURES
+    cache = None if cache_dir is None else FeatureCache(cache_dir)
+    results = {}
+    pool = None
+    _FEATURES = feature_dict
+    try:
+        if processes:
+            pool = multiprocessing.Pool(processes)
         for feature, feature_func in feature_dict.iteritems():
-            temp[feature].append(feature_func(name))
+            version = _func_version(feature_func)
+            values = {}
+            if not cache is None and not feature in recompute:
+                values = cache.load(feature, version)
+            missing = [args for args in set(cells) if not args in values]
+            if len(missing) > 0:
+                jobs = [(feature, args) for args in missing]
+                if pool is None:
+                    computed = map(_evaluate_cell, jobs)
+                else:
+                    computed = pool.map(_evaluate_cell, jobs,
+                            chunksize=max(1, len(jobs) / (4 * processes)))
+                values.update(zip(missing, computed))
+                if not cache is None:
+                    cache.save(feature, version, values)
+            results[feature] = [values[args] for args in cells]
+    finally:
+        _FEATURES = {}
+        if not pool is None:
+            pool.close()
+            pool.join()
+    return results
+
+def _clean_frame(temp):
     df = pd.DataFrame(temp)
     df = df.replace([np.inf, -np.inf], np.nan)
     df = df.dropna()
     return df
 
-def make_data_frame_time(communities, time_range, feature_dict):
+def make_data_frame(communities, feature_dict, processes=None, cache_dir=None, recompute=()):
+    """
+    Makes a pandas dataframe for name, months, and dictionary of feature funcs.
+    Each feature func should take name and return feature value.
+    Constructed dataframe has flat csv style structure and missing values are removed.
+    processes, cache_dir and recompute are passed to evaluate_features.
+    """
+
+    cells = [(name,) for name in communities]
+    feature_dict.pop("name", None)
+    temp = evaluate_features(feature_dict, cells, processes, cache_dir, recompute)
+    temp["name"] = [name for name, in cells]
+    feature_dict["name"] = lambda name : name
+    return _clean_frame(temp)
+
+def make_data_frame_time(communities, time_range, feature_dict,
+        processes=None, cache_dir=None, recompute=()):
     """
     Makes a pandas dataframe for name, months, and dictionary of feature funcs.
     Each feature func should take (name, month) and return feature value.
     Constructed dataframe has flat csv style structure and missing values are removed.
+    processes, cache_dir and recompute are passed to evaluate_features; values are
+    cached per feature, community and time.
     """
 
-    temp = collections.defaultdict(list)
+    cells = [(name, time) for name in communities for time in time_range]
+    feature_dict.pop("name", None)
+    feature_dict.pop("time", None)
+    temp = evaluate_features(feature_dict, cells, processes, cache_dir, recompute)
+    temp["name"] = [name for name, _ in cells]
+    temp["time"] = [time for _, time in cells]
     feature_dict["name"] = lambda name, time : name
     feature_dict["time"] = lambda name, time : time
-    for name in communities:
-        for time in time_range:
-            for feature, feature_func in feature_dict.iteritems():
-                temp[feature].append(feature_func(name, time))
-    df = pd.DataFrame(temp)
-    df = df.replace([np.inf, -np.inf], np.nan)
-    df = df.dropna()
-    return df
+    return _clean_frame(temp)
 
 
 def read_filtered_users():
     users = set()
-    with open(DATA + 'filtered_users.txt') as fp:
+    with open(constants.DATA_HOME + 'filtered_users.txt') as fp:
         for line in fp:
             x = line.strip().split('\t')
             users.add(x[0])
     return users
 
+def _listed_subreddits(year):
+    manifest = get_manifest()
+    if not manifest is None:
+        return manifest.subreddits("spacy_comments", year)
+    return [e.split(".")[0] for e in os.listdir(constants.DATA_HOME + "spacy_comments/" + str(year))]
+
 def read_subreddit_names(year=None):
     exclude_set = set(load_json(constants.DATA_HOME + "exclude_set.json"))
     subs = set([])
     if year == None:
         for year in constants.YEARS:
-            subs.update([e.split(".")[0] for e in os.listdir(constants.DATA_HOME + "spacy_comments/" + str(year))])
+            subs.update(_listed_subreddits(year))
     else:
-        subs.update([e.split(".")[0] for e in os.listdir(constants.DATA_HOME + "spacy_comments/" + str(year))])
+        subs.update(_listed_subreddits(year))
     return subs-exclude_set
 
 def valid_subreddits():
+    manifest = get_manifest()
+    if not manifest is None and not manifest.valid_subreddits is None:
+        return list(manifest.valid_subreddits)
     subreddits = []
-    with open(DATA + "total_comment_counts.tsv") as fp:
+    with open(constants.DATA_HOME + "total_comment_counts.tsv") as fp:
         for line in fp:
             subreddits.append(line.split("\t")[0])
     return subreddits
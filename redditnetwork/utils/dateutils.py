@@ -13,6 +13,14 @@ def get_week_timestamp(year, week):
     d = Week(year, week).monday()
     return calendar.timegm(d.timetuple())
 
+def week_range(year, week):
+    """
+    The [start, end) timestamps of the records for which get_week returns week
+    in the given year (our week w is ISO week w+1).
+    """
+    start = get_week_timestamp(year, week+1)
+    return start, start + 7*24*3600
+
 def day_week(timestamp):
     timestamp = datetime.datetime.utcfromtimestamp(float(timestamp))
     date = timestamp.date()
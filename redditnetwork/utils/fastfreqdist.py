@@ -1,6 +1,12 @@
 from nltk.probability import FreqDist, MLEProbDist
 import numpy as np
 
+from redditnetwork.utils.arrayutils import sorted_lookup
+from redditnetwork.utils.ioutils import save_npz
+
+# largest number of individual draws held in memory at once by generate_batches
+MAX_DRAWS = 10000000
+
 class CachedFreqDist(FreqDist):
     """
     A read only version of nltk's FreqDist that caches the sample size for speed.
@@ -20,19 +26,296 @@ class CachedFreqDist(FreqDist):
             return 0
         return float(self[sample]) / self.N()
 
+    def as_arrays(self):
+        """
+        Returns the samples (list) and their counts (float64 array), in matching order.
+        """
+        return list(self.keys()), np.array(self.values(), dtype=np.float64)
+
 class MultiGenMLEProbDist(MLEProbDist):
     """
-    An extension of nltk's MLEProbDist that allows for fast sampling for larger sample sizes
+    An extension of nltk's MLEProbDist that allows for fast sampling for larger sample sizes.
+    Samples are drawn by inverting the cumulative counts (searchsorted over uniform draws)
+    or, when a batch has more draws than there are samples, from a multinomial; results
+    are sparse (indices, counts) arrays into self._samples.
+    random_state is an optional np.random.RandomState (default: the global numpy one).
     """
 
-    def __init__(self, freqdist, bins=None):
+    def __init__(self, freqdist, bins=None, random_state=None):
         MLEProbDist.__init__(self, freqdist, bins)
-        self._probarray = np.zeros((len(freqdist),))
-        self._probmap = {}
-        for i, item in enumerate(freqdist.keys()):
-            self._probarray[i] = freqdist.freq(item)
-            self._probmap[i] = item
+        if hasattr(freqdist, "as_arrays"):
+            self._samples, counts = freqdist.as_arrays()
+        else:
+            self._samples = list(freqdist.keys())
+            counts = np.array(freqdist.values(), dtype=np.float64)
+        self._cumulative = np.cumsum(counts, dtype=np.float64)
+        total = self._cumulative[-1] if len(counts) > 0 else 0.
+        self._probarray = counts / total if total > 0 else counts
+        # rounding can push a draw up to the total; it then goes to the last drawable sample
+        nonzero = np.flatnonzero(counts)
+        self._last = nonzero[-1] if len(nonzero) > 0 else 0
+        self._rng = np.random if random_state is None else random_state
+
+    def _check(self):
+        if len(self._cumulative) == 0 or self._cumulative[-1] <= 0:
+            raise ValueError("Cannot sample from an empty distribution")
+
+    def generate_indices(self, n):
+        """
+        n independent draws, as indices into self._samples.
+        """
+        self._check()
+        draws = self._rng.random_sample(n) * self._cumulative[-1]
+        return np.minimum(np.searchsorted(self._cumulative, draws, side="right"), self._last)
+
+    def generate_arrays(self, n):
+        """
+        Counts of n independent draws as sparse arrays: the sorted sample indices
+        drawn at least once and how often each was drawn.
+        """
+        self._check()
+        if n > len(self._cumulative):
+            counts = self._rng.multinomial(n, self._probarray)
+            indices = np.flatnonzero(counts)
+            return indices, counts[indices]
+        return np.unique(self.generate_indices(n), return_counts=True)
+
+    def generate_batches(self, n, num_batches):
+        """
+        num_batches independent samples of n draws each, as sparse arrays
+        (batch, index, count), sorted by batch and then index.
+        """
+        self._check()
+        num_samples = len(self._cumulative)
+        if n > num_samples:
+            results = [self.generate_arrays(n) for _ in xrange(num_batches)]
+            batches = np.repeat(np.arange(num_batches), [len(indices) for indices, _ in results])
+            if num_batches == 0:
+                return batches, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+            return (batches, np.concatenate([indices for indices, _ in results]),
+                    np.concatenate([counts for _, counts in results]))
+        all_batches, all_indices, all_counts = [], [], []
+        step = max(1, MAX_DRAWS / max(n, 1))
+        for first in xrange(0, num_batches, step):
+            chunk = min(step, num_batches - first)
+            keys = np.repeat(np.arange(first, first + chunk, dtype=np.int64), n) * num_samples
+            keys += self.generate_indices(n * chunk)
+            keys, counts = np.unique(keys, return_counts=True)
+            all_batches.append(keys / num_samples)
+            all_indices.append(keys % num_samples)
+            all_counts.append(counts)
+        if len(all_counts) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        return np.concatenate(all_batches), np.concatenate(all_indices), np.concatenate(all_counts)
 
     def generate_many(self, n):
-        return {self._probmap[i]:count for i, count in 
-                enumerate(np.random.multinomial(n, self._probarray)) if count != 0}
+        """
+        Counts of n independent draws as a dict from sample to count.
+        """
+        indices, counts = self.generate_arrays(n)
+        return {self._samples[i] : count for i, count in zip(indices, counts)}
+
+class VocabIndex():
+    """
+    Sorted vocabulary shared by ArrayFreqDists, so that distributions over the
+    same index are plain aligned count arrays.
+    """
+    def __init__(self, samples, is_sorted=False):
+        samples = np.asarray(samples)
+        self.samples = samples if is_sorted else np.unique(samples)
+
+    @classmethod
+    def union(cls, vocabs):
+        return cls(np.concatenate([vocab.samples for vocab in vocabs]))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __eq__(self, other):
+        return self is other or (isinstance(other, VocabIndex) and
+                len(self) == len(other) and bool((self.samples == other.samples).all()))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def indices(self, samples):
+        """
+        Positions of an array of samples in the vocabulary (-1 for unknown samples).
+        """
+        return sorted_lookup(self.samples, samples)
+
+    def save(self, filename):
+        with open(filename, "wb") as fp:
+            np.save(fp, self.samples)
+
+    @classmethod
+    def load(cls, filename):
+        return cls(np.load(filename), is_sorted=True)
+
+class ArrayFreqDist():
+    """
+    Frequency distribution stored as a count array aligned with a VocabIndex.
+    Behaves like a read only CachedFreqDist (counts by indexing, probabilities by freq(),
+    N()), and also answers for whole arrays of samples. Distributions over one shared
+    vocab are merged and subtracted as arrays.
+    """
+    def __init__(self, vocab, counts=None):
+        self.vocab = vocab
+        if counts is None:
+            counts = np.zeros(len(vocab), dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        if len(self.counts) != len(vocab):
+            raise ValueError("Got {:d} counts for a vocab of size {:d}".format(
+                len(self.counts), len(vocab)))
+        self._N = int(self.counts.sum())
+
+    @classmethod
+    def from_freqdist(cls, freqdist, vocab=None):
+        """
+        Converts a FreqDist/Counter (or any sample -> count mapping).
+        Without a vocab, one is built from the samples of freqdist.
+        """
+        samples = list(freqdist.keys())
+        counts = np.array(freqdist.values(), dtype=np.int64)
+        if vocab is None:
+            vocab = VocabIndex(samples)
+        return cls.from_arrays(vocab, samples, counts)
+
+    @classmethod
+    def from_arrays(cls, vocab, samples, counts):
+        indices = vocab.indices(samples)
+        if (indices < 0).any():
+            raise KeyError("Samples not in the vocab: {}".format(
+                np.asarray(samples)[indices < 0][:10]))
+        return cls(vocab, np.bincount(indices, weights=counts,
+            minlength=len(vocab)).astype(np.int64))
+
+    def N(self):
+        return self._N
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+    def keys(self):
+        return self.vocab.samples[self.counts > 0].tolist()
+
+    def lookup(self, samples):
+        """
+        Counts for an array of samples (0 for samples outside the vocab).
+        """
+        indices = self.vocab.indices(samples)
+        if len(self.counts) == 0:
+            return np.zeros(len(indices), dtype=np.int64)
+        return np.where(indices >= 0, self.counts[indices], 0)
+
+    def __getitem__(self, sample):
+        return int(self.lookup([sample])[0])
+
+    def __contains__(self, sample):
+        return self[sample] > 0
+
+    def freq(self, samples):
+        """
+        Probability of one sample, or an array of probabilities for an array of samples.
+        """
+        if np.isscalar(samples):
+            return float(self[samples]) / self._N if self._N > 0 else 0
+        if self._N == 0:
+            return np.zeros(len(samples))
+        return self.lookup(samples) / float(self._N)
+
+    def max(self):
+        return self.vocab.samples[np.argmax(self.counts)]
+
+    def as_arrays(self):
+        """
+        Returns the samples with a non-zero count (list) and their counts (float64 array).
+        """
+        nonzero = np.flatnonzero(self.counts)
+        return self.vocab.samples[nonzero].tolist(), self.counts[nonzero].astype(np.float64)
+
+    def to_freqdist(self):
+        samples, counts = self.as_arrays()
+        return CachedFreqDist(dict(zip(samples, counts.astype(np.int64).tolist())))
+
+    def reindex(self, vocab):
+        """
+        The same counts over another vocab, which must contain every counted sample.
+        """
+        if vocab == self.vocab:
+            return ArrayFreqDist(vocab, self.counts)
+        samples, counts = self.as_arrays()
+        return ArrayFreqDist.from_arrays(vocab, samples, counts)
+
+    @staticmethod
+    def align(dists):
+        """
+        Reindexes dists to one shared vocab (the union of theirs, unless they already share one).
+        """
+        dists = list(dists)
+        vocabs = [dist.vocab for dist in dists]
+        if all(vocab == vocabs[0] for vocab in vocabs[1:]):
+            return dists
+        vocab = VocabIndex.union(vocabs)
+        return [dist.reindex(vocab) for dist in dists]
+
+    @staticmethod
+    def stack(dists):
+        """
+        Returns the shared vocab and a (len(dists) x vocab size) count matrix,
+        e.g. one row per subreddit-month.
+        """
+        dists = ArrayFreqDist.align(dists)
+        if len(dists) == 0:
+            return VocabIndex([]), np.zeros((0, 0), dtype=np.int64)
+        return dists[0].vocab, np.vstack([dist.counts for dist in dists])
+
+    @classmethod
+    def merge(cls, dists):
+        """
+        Sums the counts of several distributions.
+        """
+        vocab, matrix = cls.stack(dists)
+        return cls(vocab, matrix.sum(axis=0) if len(matrix) > 0 else None)
+
+    def subtract(self, other, clip=True):
+        """
+        Removes the counts of other, e.g. one subreddit-month from a year total.
+        With clip, counts that would go negative become 0.
+        """
+        this, other = ArrayFreqDist.align([self, other])
+        counts = this.counts - other.counts
+        if clip:
+            counts = np.maximum(counts, 0)
+        return ArrayFreqDist(this.vocab, counts)
+
+    def __add__(self, other):
+        return ArrayFreqDist.merge([self, other])
+
+    def __sub__(self, other):
+        return self.subtract(other)
+
+    def save(self, filename, with_vocab=True):
+        """
+        Stores the non-zero counts only. Without the vocab, load needs the same
+        vocab passed back in.
+        """
+        nonzero = np.flatnonzero(self.counts)
+        arrays = {"indices" : nonzero.astype(np.uint32 if len(self.vocab) < 2**32 else np.int64),
+                "counts" : self.counts[nonzero], "vocab_size" : np.array([len(self.vocab)])}
+        if with_vocab:
+            arrays["samples"] = self.vocab.samples
+        save_npz(filename, compressed=True, **arrays)
+
+    @classmethod
+    def load(cls, filename, vocab=None):
+        data = np.load(filename)
+        if vocab is None:
+            vocab = VocabIndex(data["samples"], is_sorted=True)
+        if len(vocab) != int(data["vocab_size"][0]):
+            raise ValueError("{} was saved with a vocab of size {:d}, not {:d}".format(
+                filename, int(data["vocab_size"][0]), len(vocab)))
+        counts = np.zeros(len(vocab), dtype=np.int64)
+        counts[data["indices"].astype(np.int64)] = data["counts"]
+        return cls(vocab, counts)
@@ -1,6 +1,7 @@
 import os
 import cPickle as pickle
 import json
+import numpy as np
 
 def mkdir(directory):
     if not os.path.exists(directory):
@@ -21,3 +22,20 @@ def write_json(data, filename):
 def load_json(filename):
     fp = open(filename, "rb")
     return json.load(fp)
+
+def save_npz(filename, compressed=False, **arrays):
+    """
+    Writes arrays to filename (as np.savez or np.savez_compressed) under a per
+    process temporary name and renames it, so concurrent readers and writers never
+    see a partial file. np.savez would append .npz to a string name, so it gets a file.
+    """
+    tmp_filename = "{}.{:d}.tmp".format(filename, os.getpid())
+    savez = np.savez_compressed if compressed else np.savez
+    try:
+        with open(tmp_filename, "wb") as fp:
+            savez(fp, **arrays)
+        os.rename(tmp_filename, filename)
+    except:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
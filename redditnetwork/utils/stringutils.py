@@ -1,6 +1,7 @@
 import string
 import nltk
 import re
+import numpy as np
 
 NLTK_STOP = set(nltk.corpus.stopwords.words('english'))
 PUNCTUATION = set(string.punctuation)
@@ -8,6 +9,8 @@ URL = ['www', '.com', '.net', '.org', '.edu', '//', '/u/', '/r/', 'http']
 lemmatizer = nltk.stem.wordnet.WordNetLemmatizer()
 HTTP = re.compile("https?$")
 BOT = re.compile("bot\d*$")
+# entries kept by the clean_word/clean_word_replace memos before they are emptied
+CACHE_SIZE = 1000000
 
 def is_bot(word):
     word = word.lower()
@@ -34,7 +37,7 @@ def is_url(word):
     b = [1 if t in word else 0 for t in URL]
     return sum(b) > 0
 
-def clean_word_replace(word):
+def _clean_word_replace(word):
     word = word.strip()
     word = word.strip(string.punctuation)
     word = word.lower()
@@ -47,7 +50,7 @@ def clean_word_replace(word):
     else:
         return word
 
-def clean_word(word, lower=True, stem=True, remove_stop=True):
+def _clean_word(word, lower=True, stem=True, remove_stop=True):
     word = word.strip()
     word = word.strip(string.punctuation)
     w = word.lower()
@@ -68,6 +71,102 @@ def clean_word(word, lower=True, stem=True, remove_stop=True):
         w = lemmatizer.lemmatize(w, pos = 'v') # for verbs
     return w
 
+_REPLACE_CACHE = {}
+_CLEAN_CACHE = {}
+
+def _memoized(cache, key, func, *args):
+    try:
+        return cache[key]
+    except KeyError:
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        value = cache[key] = func(*args)
+        return value
+
+def clean_word_replace(word):
+    """
+    Memoized; see WordCleaner for cleaning whole vocabularies.
+    """
+    return _memoized(_REPLACE_CACHE, word, _clean_word_replace, word)
+
+def clean_word(word, lower=True, stem=True, remove_stop=True):
+    """
+    Memoized per (word, options); see WordCleaner for cleaning whole vocabularies.
+    """
+    return _memoized(_CLEAN_CACHE, (word, lower, stem, remove_stop),
+            _clean_word, word, lower, stem, remove_stop)
+
+class WordCleaner():
+    """
+    Cleans each distinct word once, with fixed options: clean_word(word, **options),
+    or clean_word_replace(word) with replace=True.
+    Cleaned words are numbered (codes index self.words), so token arrays of
+    spacy string ids (orth or lower ids, as given by Doc.to_array) map straight to
+    arrays of codes; words cleaned away ("") get code -1. The id -> code table
+    is only valid for one spacy StringStore.
+    """
+    def __init__(self, replace=False, max_size=CACHE_SIZE, **options):
+        self.replace = replace
+        self.options = options
+        self.max_size = max_size
+        self.words = []
+        self._codes = {"" : -1}
+        self._cache = {}
+        # -2: id not resolved yet
+        self._id_codes = -2 * np.ones(0, dtype=np.int64)
+
+    def clean(self, word):
+        try:
+            return self._cache[word]
+        except KeyError:
+            if self.replace:
+                value = _clean_word_replace(word)
+            else:
+                value = _clean_word(word, **self.options)
+            if len(self._cache) >= self.max_size:
+                self._cache.clear()
+            self._cache[word] = value
+            return value
+
+    def clean_vocabulary(self, words):
+        """
+        Dict from every distinct word of words to its cleaned form.
+        """
+        return {word : self.clean(word) for word in set(words)}
+
+    def code(self, word):
+        """
+        Code of the cleaned form of word.
+        """
+        cleaned = self.clean(word)
+        if not cleaned in self._codes:
+            self._codes[cleaned] = len(self.words)
+            self.words.append(cleaned)
+        return self._codes[cleaned]
+
+    def map_ids(self, ids, strings):
+        """
+        Codes of the cleaned words for an array of spacy string ids,
+        looked up in strings (e.g. vocab.strings) once per distinct id.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return np.zeros(0, dtype=np.int64)
+        top = int(ids.max()) + 1
+        if top > len(self._id_codes):
+            grown = -2 * np.ones(max(top, 2*len(self._id_codes)), dtype=np.int64)
+            grown[:len(self._id_codes)] = self._id_codes
+            self._id_codes = grown
+        for string_id in np.unique(ids[self._id_codes[ids] == -2]):
+            self._id_codes[string_id] = self.code(strings[int(string_id)])
+        return self._id_codes[ids]
+
+    def map_words(self, words):
+        """
+        Codes of the cleaned forms of a sequence of words.
+        """
+        return np.array([self.code(word) for word in words], dtype=np.int64)
+
 def is_stop(word):
     if len(word) == 1:
         return True
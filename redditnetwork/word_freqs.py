@@ -0,0 +1,170 @@
+"""
+Persisted word frequency tables, one per subreddit-month.
+
+The SIF weights used for the word_vecs features only depend on how often each
+lowercase word occurs, so the counts can be computed once per subreddit-month,
+stored next to the corpus, and summed for any set of months or subreddits.
+"""
+
+import zipfile
+import numpy as np
+
+from collections import Counter
+
+from redditnetwork.corpus_reader import SpacyComments, get_vocab
+from redditnetwork.utils.arrayutils import sorted_lookup
+from redditnetwork.utils.ioutils import save_npz
+
+FREQS_SUFFIX = ".freqs.npz"
+
+def _as_words(words):
+    """
+    Object array of unicode words. A fixed-width string array would give every
+    entry the width of the longest (junk) token.
+    """
+    words = [word if isinstance(word, unicode) else str(word).decode("utf-8") for word in words]
+    array = np.empty(len(words), dtype=object)
+    array[:] = words
+    return array
+
+class WordFreqs():
+    """
+    Counts of lowercase words, stored as a sorted (object) array of words
+    and a matching array of counts; saved as one utf-8 buffer with offsets.
+    Indexing with a word that is not in the table returns 0, like a Counter.
+    """
+    def __init__(self, words, counts):
+        words = _as_words(words)
+        counts = np.asarray(counts, dtype=np.int64)
+        order = np.argsort(words, kind="mergesort")
+        self.words = words[order]
+        self.counts = counts[order]
+        self.total = float(self.counts.sum())
+
+    @classmethod
+    def from_counter(cls, counter):
+        words = counter.keys()
+        return cls(words, [counter[word] for word in words])
+
+    @classmethod
+    def load(cls, filename, source_sizes=None):
+        """
+        Raises IOError if the table is missing or unreadable, or, with source_sizes
+        (of the .bin and .info files), was counted from other files; so that callers
+        rebuild it.
+        """
+        try:
+            data = np.load(filename)
+            if not source_sizes is None and tuple(data["source_sizes"]) != tuple(source_sizes):
+                raise IOError("Stale word frequency table " + filename)
+            buffer = data["word_bytes"].tobytes()
+            offsets = data["word_offsets"]
+            return cls([buffer[offsets[i]:offsets[i+1]] for i in xrange(len(offsets) - 1)],
+                    data["counts"])
+        except (zipfile.BadZipfile, KeyError, ValueError, EOFError) as e:
+            raise IOError("Unreadable word frequency table {}: {}".format(filename, e))
+
+    def encoded(self):
+        """
+        The words as one utf-8 byte buffer (uint8 array) and the offsets of every word in it.
+        """
+        encoded = [word.encode("utf-8") for word in self.words]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(word) for word in encoded])
+        return np.array(bytearray("".join(encoded)), dtype=np.uint8), offsets
+
+    def save(self, filename, source_sizes=(-1, -1)):
+        """
+        source_sizes are the sizes of the files the table was counted from (see load).
+        """
+        word_bytes, word_offsets = self.encoded()
+        save_npz(filename, compressed=True, word_bytes=word_bytes, word_offsets=word_offsets,
+                counts=self.counts, source_sizes=np.array(source_sizes, dtype=np.int64))
+
+    @classmethod
+    def merge(cls, tables):
+        """
+        Sums the counts of several tables.
+        """
+        tables = list(tables)
+        if len(tables) == 0:
+            return cls([], [])
+        words = np.concatenate([table.words for table in tables])
+        counts = np.concatenate([table.counts for table in tables])
+        merged_words, inverse = np.unique(words, return_inverse=True)
+        merged_counts = np.bincount(inverse, weights=counts, minlength=len(merged_words))
+        return cls(merged_words, merged_counts.astype(np.int64))
+
+    def lookup(self, words):
+        """
+        Counts for an array of words (0 for unknown words).
+        """
+        rows = sorted_lookup(self.words, _as_words(words))
+        counts = np.zeros(len(rows), dtype=np.int64)
+        counts[rows >= 0] = self.counts[rows[rows >= 0]]
+        return counts
+
+    def __getitem__(self, word):
+        return self.lookup([word])[0]
+
+    def __contains__(self, word):
+        return self[word] > 0
+
+    def __len__(self):
+        return len(self.words)
+
+    def as_counter(self):
+        return Counter(dict(zip(self.words.tolist(), self.counts.tolist())))
+
+
+def count_words(comment_iter):
+    """
+    Counts the lowercase tokens of every comment doc, as extract_network does.
+    """
+    lower_counts = Counter()
+    for comment in comment_iter:
+        for word in comment["doc"]:
+            lower_counts[word.lower] += 1
+    strings = get_vocab().strings
+    return WordFreqs([strings[lower] for lower in lower_counts.keys()],
+            lower_counts.values())
+
+def freqs_path(subreddit, year, month, path=None):
+    return SpacyComments(subreddit, year, month, path=path).path + FREQS_SUFFIX
+
+def build_word_freqs(subreddit, year, month, path=None):
+    """
+    Counts the words of one subreddit-month (with the default bot/deleted filtering)
+    and writes the table next to the corpus files.
+    """
+    comments = SpacyComments(subreddit, year, month, path=path)
+    word_freqs = count_words(comments)
+    word_freqs.save(freqs_path(subreddit, year, month, path=path), comments.source_sizes())
+    return word_freqs
+
+def load_word_freqs(subreddit, year, month, path=None, build=True):
+    """
+    Loads the table of one subreddit-month, building it first if it is missing,
+    unreadable or stale.
+    """
+    comments = SpacyComments(subreddit, year, month, path=path)
+    filename = comments.path + FREQS_SUFFIX
+    try:
+        return WordFreqs.load(filename, comments.source_sizes())
+    except IOError:
+        if not build:
+            raise
+    word_freqs = count_words(comments)
+    try:
+        word_freqs.save(filename, comments.source_sizes())
+    except IOError:
+        # read-only corpus location, use the table without persisting it
+        pass
+    return word_freqs
+
+def get_word_freqs(subreddits, year, months, path=None, build=True):
+    """
+    Merged table for every subreddit/month pair.
+    """
+    return WordFreqs.merge(load_word_freqs(subreddit, year, month, path=path, build=build)
+            for subreddit in subreddits for month in months)
@@ -10,6 +10,7 @@ setup(name='redditnetwork',
       install_requires=['spacy==1.2.0',
                         'networkx',
                         'numpy',
+                        'scipy',
                         'isoweek',
                         'pandas',
                         'nltk'